@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Adaptive batch size and number of in-flight batches of the loader, driven by observed latency
+import logging
+import os
+import threading
+from collections import defaultdict
+
+WINDOW: int = 8  # number of stored batches between decisions
+TARGET_LATENCY: float = 0.25  # seconds per set_multi of a batch
+MIN_BATCH_SIZE: int = 1000
+MAX_BATCH_SIZE: int = 100000
+MAX_INFLIGHT: int = 16
+
+
+class AutoTuner:
+    """
+    AIMD controller. Each WINDOW batches stored, it looks at the mean set_multi latency of the slowest server:
+    * no failures and latency under the target - the batch size grows by MIN_BATCH_SIZE (additive increase),
+      and one more batch is let in flight when senders are slower than the parser;
+    * failures or latency above the target - the batch size and the batches in flight are halved (multiplicative
+      decrease).
+    Values are kept within the configured bounds. Sender threads and the parser report to the same tuner
+    """
+
+    def __init__(self, batch_size, inflight, min_batch_size=MIN_BATCH_SIZE, max_batch_size=MAX_BATCH_SIZE,
+                 max_inflight=MAX_INFLIGHT, target_latency=TARGET_LATENCY):
+        self.min_batch_size, self.max_batch_size = min_batch_size, max_batch_size
+        self.max_inflight = max_inflight
+        self.target_latency = target_latency
+        self.batch_size = min(max(batch_size, min_batch_size), max_batch_size)
+        self.inflight = min(max(inflight, 1), max_inflight)
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.sends = 0
+        self.errors = 0
+        self.latency = defaultdict(float)  # sum of latencies by server
+        self.batches = defaultdict(int)  # number of batches by server
+        self.records_sent = 0
+        self.send_time = 0.0
+        self.records_parsed = 0
+        self.parse_time = 0.0
+
+    def record_parse(self, records, seconds):
+        with self._lock:
+            self.records_parsed += records
+            self.parse_time += seconds
+
+    def record_send(self, server, records, seconds, errors):
+        """
+        :param server: address of the memcached instance
+        :param records: number of records of the batch
+        :param seconds: time to store the batch, retries included
+        :param errors: number of records not stored
+        """
+        with self._lock:
+            self.sends += 1
+            self.errors += errors
+            self.latency[server] += seconds
+            self.batches[server] += 1
+            self.records_sent += records
+            self.send_time += seconds
+            if self.sends >= WINDOW:
+                self._decide()
+                self._reset()
+
+    def _decide(self):
+        server, latency = max(((server, self.latency[server] / self.batches[server]) for server in self.latency),
+                              key=lambda item: item[1])
+        # records per second of all servers together vs records per second of the parser
+        send_rate = self.records_sent / self.send_time * len(self.latency) if self.send_time else float('inf')
+        parse_rate = self.records_parsed / self.parse_time if self.parse_time else float('inf')
+        batch_size, inflight = self.batch_size, self.inflight
+        if self.errors or latency > self.target_latency:
+            reason = f"{self.errors} errors" if self.errors else f"latency of {server} {latency:.3f}s"
+            self.batch_size = max(self.min_batch_size, batch_size // 2)
+            self.inflight = max(1, inflight // 2)
+        else:
+            reason = f"latency of {server} {latency:.3f}s"
+            self.batch_size = min(self.max_batch_size, batch_size + self.min_batch_size)
+            if send_rate < parse_rate:
+                self.inflight = min(self.max_inflight, inflight + 1)
+        logging.info(f"Autotune: batch size {batch_size} -> {self.batch_size}, in flight {inflight} -> "
+                     f"{self.inflight}: {reason}, target {self.target_latency}s, records/s sent {send_rate:.0f}, "
+                     f"parsed {parse_rate:.0f}")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Throughput benchmark of the loaders against in-process fake memcached servers, with a JSON report
+import glob
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser, SUPPRESS_HELP, Values
+
+import budget
+import fake_memc
+import gen_data
+
+DEV_TYPES = ('idfa', 'gaid', 'adid', 'dvid')
+RSS_INTERVAL: float = 0.05  # seconds between measures of the total RSS of the loader
+# command-line options of memc_load.py for each configuration, None stands for memc_load_serial.py
+CONFIGS = {
+    'serial': None,
+    'threads-memcache-protobuf': ['--parser', 'protobuf'],
+    'threads-memcache-fast': [],
+    'threads-meta-binary': ['--backend', 'meta', '--binary'],
+    'asyncio-meta-binary': ['--engine', 'asyncio', '--binary'],
+    'split-meta-binary': ['--split-files', '--backend', 'meta', '--binary'],
+    'split-shm-meta-binary': ['--split-files', '--shm', '--backend', 'meta', '--binary'],
+    'threads-memcache-fast-256M': ['--max-memory', '256M'],
+    'executor-threads-fast': ['--executor', 'threads'],
+}
+
+
+def percentile(values, p):
+    if not values:
+        return
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def restore_files(directory):
+    """Undo dot_rename of the loaders, to load the same files again"""
+    for path in glob.glob(os.path.join(directory, '.*.tsv.gz')):
+        head, fn = os.path.split(path)
+        os.rename(path, os.path.join(head, fn[1:]))
+
+
+def tree_rss(pid):
+    """
+    RSS of the process and all its descendants in bytes, 0 if it has exited. Linux only
+    :return: total RSS, RSS of the largest process
+    """
+    rss, children = {}, {}
+    for stat_path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as f:
+                fields = f.read().rpartition(')')[2].split()  # from the state, the name may have spaces
+        except OSError:
+            continue
+        proc = int(stat_path.split('/')[2])
+        rss[proc] = int(fields[21])
+        children.setdefault(int(fields[1]), []).append(proc)
+    total, largest, stack = 0, 0, [pid]
+    while stack:
+        proc = stack.pop()
+        total += rss.get(proc, 0)
+        largest = max(largest, rss.get(proc, 0))
+        stack.extend(children.get(proc, ()))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return total * page_size, largest * page_size
+
+
+class PeakRss(threading.Thread):
+    """
+    Peak of the total RSS of a process and its descendants, and of the largest of them, measured every RSS_INTERVAL
+    seconds. ru_maxrss of the child would count the pages of the parent it was forked from
+    """
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak = self.peak_largest = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(RSS_INTERVAL):
+            total, largest = tree_rss(self.pid)
+            self.peak = max(self.peak, total)
+            self.peak_largest = max(self.peak_largest, largest)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _run_loader(config, args, pattern, addrs, log):
+    """Body of the child process of run_config"""
+    if args is None:
+        import memc_load_serial
+        memc_load_serial.main(Values(dict(pattern=pattern, dry=False, **addrs)))
+        return {}
+    import memc_load
+    memc_load.configure(['--pattern', pattern, '--log', log] + args +
+                        [f'--{dev_type}={addr}' for dev_type, addr in addrs.items()])
+    memc_load.setup_logging()
+    return memc_load.main()
+
+
+def run_config(config, args, directory, servers, extra_args=()):
+    """
+    Load all the files of the directory in a child process
+    :return: dict of results: rows/sec, p50/p99 latency of storing a batch, peak RSS of the largest process
+    and of all of them together, sampled every RSS_INTERVAL seconds, and if it stayed within --max-memory
+    """
+    restore_files(directory)
+    for server in servers:
+        server.store.clear()
+    args_all = (args or []) + list(extra_args)
+    max_memory = budget.parse_size(args_all[args_all.index('--max-memory') + 1]) if '--max-memory' in args_all else 0
+    read_fd, write_fd = os.pipe()
+    start = time.monotonic()
+    pid = os.fork()
+    if not pid:  # child
+        # a new interpreter, so that memory of this process (the fake servers) is not counted for the loader
+        os.close(read_fd)
+        os.set_inheritable(write_fd, True)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)  # the serial loader prints progress
+        addrs = {dev_type: server.address for dev_type, server in zip(DEV_TYPES, servers)}
+        job = [config, None if args is None else args + list(extra_args), os.path.join(directory, '*.tsv.gz'), addrs,
+               os.path.join(directory, f'{config}.log')]
+        try:
+            os.execv(sys.executable, [sys.executable, os.path.abspath(__file__), '--run-loader', json.dumps(job),
+                                      '--result-fd', str(write_fd)])
+        finally:
+            os._exit(1)
+    os.close(write_fd)
+    peak_rss = PeakRss(pid)
+    peak_rss.start()
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    peak_rss.stop()
+    _, status = os.waitpid(pid, 0)
+    seconds = time.monotonic() - start
+    stored = sum(len(server.store) for server in servers)
+    result = json.loads(output) if output else {}
+    latencies = result.get('latencies', [])
+    return {
+        'config': config,
+        'ok': os.waitstatus_to_exitcode(status) == 0,
+        'seconds': round(seconds, 3),
+        'rows_stored': stored,
+        'rows_per_sec': round(stored / seconds),
+        'processed': result.get('processed'),
+        'errors': result.get('errors'),
+        'batches': len(latencies),
+        'batch_latency_p50': percentile(latencies, 0.5),
+        'batch_latency_p99': percentile(latencies, 0.99),
+        'batch_latency_mean': statistics.mean(latencies) if latencies else None,
+        'peak_rss_mb': round(peak_rss.peak_largest / 2 ** 20, 1),  # of the largest process
+        'peak_total_rss_mb': round(peak_rss.peak / 2 ** 20, 1),  # of the loader and its workers together
+        'max_memory_mb': round(max_memory / 2 ** 20, 1) if max_memory else None,
+        'under_budget': peak_rss.peak <= max_memory if max_memory else None,
+    }
+
+
+def main(options):
+    directory = options.data or tempfile.mkdtemp(prefix='memc_bench_')
+    try:
+        if not glob.glob(os.path.join(directory, '*.tsv.gz')):
+            gen_data.generate_files(directory, options.files, options.rows, seed=options.seed,
+                                    dev_types=options.dev_types, apps_mean=options.apps_mean,
+                                    dirty_rate=options.dirty_rate)
+        servers = [fake_memc.FakeMemcached(latency=options.latency, fail_rate=options.fail_rate, seed=options.seed)
+                   for _ in DEV_TYPES]
+        for server in servers:
+            server.start()
+        report = {'rows': options.rows * options.files, 'files': options.files, 'latency': options.latency,
+                  'fail_rate': options.fail_rate, 'results': []}
+        scaling = [int(workers) for workers in options.scaling.split(',')] if options.scaling else [None]
+        try:
+            for config in options.configs.split(','):
+                base = None
+                for workers in scaling if CONFIGS[config] is not None else [None]:
+                    extra_args = options.extra_args.split() + ([] if workers is None else ['--workers', str(workers)])
+                    result = run_config(config, CONFIGS[config], directory, servers, extra_args)
+                    if workers is not None:
+                        base = base or result['rows_per_sec']
+                        result.update(workers=workers, speedup=round(result['rows_per_sec'] / base, 2))
+                    report['results'].append(result)
+                    print(json.dumps(result), file=sys.stderr)
+        finally:
+            for server in servers:
+                server.stop()
+            restore_files(directory)
+    finally:
+        if not options.data:
+            shutil.rmtree(directory)
+    return report
+
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option("--configs", action="store", default=','.join(CONFIGS),
+                  help=f"comma-separated configurations: {', '.join(CONFIGS)}")
+    op.add_option("--extra-args", action="store", default="", help="more options of memc_load.py for all the runs")
+    op.add_option("--data", action="store", default=None,
+                  help="directory with .tsv.gz files, generated there if empty. A temporary directory by default")
+    op.add_option("--files", action="store", type="int", default=2)
+    op.add_option("--rows", action="store", type="int", default=100000, help="rows per generated file")
+    op.add_option("--dev-types", action="store", default=gen_data.DEV_TYPES)
+    op.add_option("--apps-mean", action="store", type="int", default=gen_data.APPS_MEAN)
+    op.add_option("--dirty-rate", action="store", type="float", default=0.0)
+    op.add_option("--seed", action="store", type="int", default=1)
+    op.add_option("--latency", action="store", type="float", default=0.0, help="seconds added to each round-trip")
+    op.add_option("--fail-rate", action="store", type="float", default=0.0, help="share of failed sets")
+    op.add_option("--scaling", action="store", default="",
+                  help="comma-separated numbers of workers, e.g. 1,2,4,8,16: each configuration is run with each "
+                       "--workers, and the speedup over the first one is reported")
+    op.add_option("--out", action="store", default=None, help="JSON report file, stdout by default")
+    op.add_option("--run-loader", action="store", default=None, help=SUPPRESS_HELP)  # in the child of run_config
+    op.add_option("--result-fd", action="store", type="int", default=None, help=SUPPRESS_HELP)
+    opts, args = op.parse_args()
+    if opts.run_loader:
+        try:
+            loader_result = _run_loader(*json.loads(opts.run_loader))
+            with os.fdopen(opts.result_fd, 'w') as out:
+                json.dump(loader_result, out)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            sys.exit(1)
+        sys.exit(0)
+    bench_report = main(opts)
+    if opts.out:
+        with open(opts.out, 'w') as out:
+            json.dump(bench_report, out, indent=2)
+    else:
+        print(json.dumps(bench_report, indent=2))
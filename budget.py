@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Memory budget of a loader process: batches sized by bytes, and backpressure on the reader by bytes in flight
+import logging
+import os
+import re
+import resource
+import threading
+
+UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+LINE_OVERHEAD: int = 56  # bytes of a str object and its slot in the batch list, besides the characters
+# a parsed record in a dict takes about 130 bytes besides its key and value, and set_multi of python-memcached
+# builds a command of about 4 times key and value, on top of the record
+RECORD_OVERHEAD: int = 250
+RECORD_FACTOR: int = 5
+PARSED_FACTOR: float = 1.25  # bytes of parsed records of a batch per byte of its lines
+BATCHES_IN_BUDGET: int = 8  # a batch of lines is 1/8 of the budget, the batch parsed from it is about 1/6 more
+MIN_BUDGET: int = 4 * 2 ** 20
+
+
+def parse_size(value):
+    """
+    :param value: number of bytes, with an optional K, M or G suffix, e.g. `512M`
+    :return: number of bytes
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def rss():
+    """Resident set size of the current process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, in KiB on Linux
+
+
+def records_size(data):
+    """
+    Estimated memory of parsed records being sent: the objects, and the buffer of the commands of a send
+    :param data: dict of key -> packed value
+    """
+    return (sum(map(len, data)) + sum(map(len, data.values()))) * RECORD_FACTOR + len(data) * RECORD_OVERHEAD
+
+
+class MemoryBudget:
+    """
+    Bytes a process may hold in batches: the size of a batch of lines read, and the bytes of parsed records which
+    are queued or being sent. The memory of the process at start is taken out of its share of the budget.
+    Room for the next batch, its lines and its parsed records, is kept, and hold() blocks while the records
+    in flight would take the rest of the budget, so the reader waits for the senders. A single part larger than
+    the budget is let through when nothing else is in flight
+    :param limit: bytes of the process, all included
+    """
+
+    def __init__(self, limit, baseline=None):
+        self.pid = os.getpid()
+        baseline = rss() if baseline is None else baseline
+        self.limit = max(MIN_BUDGET, limit - baseline)
+        if limit - baseline < MIN_BUDGET:
+            logging.warning(f"Memory budget of process {self.pid} is {limit / 2 ** 20:.0f} MiB, and "
+                            f"{baseline / 2 ** 20:.0f} MiB of it is already used, holding {MIN_BUDGET / 2 ** 20:.0f} "
+                            f"MiB of batches anyway")
+        self.batch_bytes = self.limit // BATCHES_IN_BUDGET
+        self.reserve = int(self.batch_bytes * (1 + PARSED_FACTOR))  # for the next batch
+        self.inflight = 0
+        self.peak = 0
+        self._space = threading.Condition()
+
+    def hold(self, size, done=None):
+        """
+        Wait until there is room for the records, and take it
+        :param size: bytes, see records_size
+        :param done: function called with no arguments after the records are sent
+        :return: function to call after the records are sent instead of done, which gives the room back
+        """
+        with self._space:
+            self._space.wait_for(lambda: not self.inflight or self.inflight + size <= self.limit - self.reserve)
+            self.inflight += size
+            self.peak = max(self.peak, self.inflight)
+
+        def release():
+            with self._space:
+                self.inflight -= size
+                self._space.notify_all()
+            if done is not None:
+                done()
+        return release
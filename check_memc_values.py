@@ -1,6 +1,9 @@
 # Utility script to check if a value was set correctly to memcached
 import memcache
 
+import appsinstalled_pb2
+import compact
+
 addrs = ['127.0.0.1:33013', '127.0.0.1:33014', '127.0.0.1:33015', '127.0.0.1:33016']
 
 # for addr in addrs:
@@ -19,8 +22,26 @@ addrs = ['127.0.0.1:33013', '127.0.0.1:33014', '127.0.0.1:33015', '127.0.0.1:330
 key = "idfa:659d72082e52be9719d33f33d69b568f"
 # key = "idfa:e7e1a50c0ec2747ca56cd9e1558c0d7c"
 
+
+def decode_value(value, dictionary=None):
+    """
+    UserApps of a value stored either in UserApps wire format, or in the compact format (--encoding compact),
+    where apps are sorted
+    :param dictionary: zstd dictionary of --zstd-dict, see compact.load_dictionary
+    """
+    ua = appsinstalled_pb2.UserApps()
+    if compact.is_compact(value):
+        apps, ua.lat, ua.lon = compact.decode(value, dictionary)
+        ua.apps.extend(apps)
+    else:
+        ua.ParseFromString(value)
+    return ua
+
+
 if __name__ == "__main__":
     memc = memcache.Client(['127.0.0.1:33013'], debug=1)
     # memc.set(key, b'Blah')
     val = memc.get(key)  # depends on if flushed above!
     print(val)
+    if val is not None:
+        print(decode_value(val))
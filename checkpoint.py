@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Per-file checkpoints of the lines stored in memcached, to resume an interrupted load
+import io
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import deque
+
+BLOCK_SIZE: int = 2 ** 20  # bytes of compressed data inflated at a time
+CHECKPOINT_INTERVAL: float = 1.0  # seconds between writes of the checkpoint of a file
+GZIP_WBITS: int = 16 + zlib.MAX_WBITS
+
+
+def checkpoint_path(path):
+    head, fn = os.path.split(path)
+    return os.path.join(head, f".{fn}.checkpoint")
+
+
+def load_state(path):
+    """
+    :return: the checkpoint of the file as a dict, None if there is none, or the file has changed since
+    """
+    try:
+        with open(checkpoint_path(path)) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    stat = os.stat(path)
+    if (state.get('size'), state.get('mtime')) != (stat.st_size, stat.st_mtime_ns):
+        logging.warning(f"File {path} has changed since its checkpoint, loading it from the start")
+        return
+    return state
+
+
+def save_state(path, state):
+    stat = os.stat(path)
+    state = dict(state, size=stat.st_size, mtime=stat.st_mtime_ns)
+    tmp = checkpoint_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, checkpoint_path(path))
+
+
+def remove_state(path):
+    try:
+        os.remove(checkpoint_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def text_lines(data):
+    """
+    Lines of the bytes decoded, without line ends, split with universal newlines as by gzip.open in text mode
+    (and memc_load.chunk_lines): a line ends with \n, \r or \r\n
+    """
+    return [line.removesuffix('\n') for line in io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')]
+
+
+class GzipLines:
+    """
+    Lines of a gzip file, without line ends, which know their position: the offset of the gzip member they are in
+    and the number of lines of the member up to them. Inflating can only restart at the beginning of a member, so
+    a load is resumed by seeking to the member and skipping lines already stored, without parsing or sending them.
+    Files written by gzip have a single member, while files concatenated from gzipped parts (pigz --independent,
+    bgzip, `cat a.gz b.gz`) can be resumed close to the checkpoint
+    :param position: dict with member_offset, member_line and line (lines of the file up to the position)
+    :param text: decode lines to str, otherwise lines are bytes
+    """
+
+    def __init__(self, path, position=None, text=True, block_size=BLOCK_SIZE):
+        position = position or {}
+        self.text = text
+        self.block_size = block_size
+        self.member_offset = position.get('member_offset', 0)
+        self.skip_lines = position.get('member_line', 0)
+        self.member_line = 0
+        self.line = position.get('line', 0) - self.skip_lines
+        self.fileobj = open(path, 'rb')  # tell() of it is the progress, as for gzip.open
+        self._lines = self._read()
+
+    def position(self):
+        """Position after the last line yielded"""
+        return {'member_offset': self.member_offset, 'member_line': self.member_line, 'line': self.line}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+    def _read(self):
+        f = self.fileobj
+        f.seek(self.member_offset)
+        offset = self.member_offset  # of the compressed data in buf
+        skip = self.skip_lines
+        d = zlib.decompressobj(GZIP_WBITS)
+        new_member = True
+        tail = b''
+        buf = b''
+        while True:
+            if not buf:
+                buf = f.read(self.block_size)
+                if not buf:
+                    break
+            if new_member:
+                data = buf.lstrip(b'\0')  # padding after the last member
+                offset += len(buf) - len(data)
+                buf = data
+                if not buf:
+                    continue
+                self.member_offset, self.member_line = offset, 0
+                new_member = False
+            data = tail + d.decompress(buf)
+            if d.eof:
+                unused = d.unused_data
+                offset += len(buf) - len(unused)
+                buf = unused
+                d = zlib.decompressobj(GZIP_WBITS)
+                new_member = True
+            else:
+                offset += len(buf)
+                buf = b''
+            end = data.rfind(b'\n')
+            if self.text:  # a \r at the end may be followed by the \n of its line end
+                end = max(end, data.rfind(b'\r', 0, len(data) - 1))
+            if end < 0:
+                tail = data
+                continue
+            tail = data[end + 1:]
+            lines = text_lines(data[:end + 1]) if self.text else data[:end].split(b'\n')
+            if skip:
+                n = min(skip, len(lines))
+                skip -= n
+                self.member_line += n
+                self.line += n
+                del lines[:n]
+            for line in lines:
+                self.member_line += 1
+                self.line += 1
+                yield line
+        if not new_member:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        if tail and not skip:
+            self.member_line += 1
+            self.line += 1
+            yield text_lines(tail)[0] if self.text else tail
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Batch:
+    """
+    Counts of a batch, passed to the sender pipeline instead of the LoadCounter of the file, which it updates too.
+    The batch is stored when all its parts, one per memcached instance, are done
+    """
+
+    def __init__(self, tracker, counter, position):
+        self.tracker = tracker
+        self.counter = counter
+        self.position = position
+        self.processed = self.errors = 0
+        self.parts = None  # unknown until expect() is called
+
+    def add(self, errors, total, latency=None):
+        self.counter.add(errors, total, latency)
+        with self.tracker.lock:
+            self.errors += errors
+            self.processed += total - errors
+
+    def skip(self, n):
+        self.counter.skip(n)
+        with self.tracker.lock:
+            self.processed += n
+
+    def coalesce(self, n):
+        self.counter.coalesce(n)
+        with self.tracker.lock:
+            self.processed += n
+
+    def submitted(self):
+        self.counter.submitted()
+
+    def inserted(self):
+        self.counter.inserted()
+
+    def expect(self, parts):
+        """Set the number of parts submitted for the batch"""
+        with self.tracker.lock:
+            self.parts = parts
+        if not parts:
+            self.tracker.commit()
+
+    def part_done(self):
+        with self.tracker.lock:
+            self.parts -= 1
+            parts = self.parts
+        if not parts:
+            self.tracker.commit()
+
+
+class Tracker:
+    """
+    Checkpoint of a file being loaded. Batches are stored out of order by the senders of different memcached
+    instances, so the checkpoint is the end of the last batch which is stored along with all the batches before it.
+    It is written at most once in CHECKPOINT_INTERVAL seconds, and on close()
+    :param lines: GzipLines the batches are read from
+    :param state: checkpoint to resume from, or None
+    """
+
+    def __init__(self, path, lines, state=None, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.lines = lines
+        self.interval = interval
+        self.state = dict(state) if state else dict(lines.position(), processed=0, errors=0)
+        self.lock = threading.Lock()
+        self._batches = deque()
+        self._saved = True
+        self._saved_at = time.monotonic()
+
+    def batch(self, counter):
+        """Batch which has just been read from the lines"""
+        batch = Batch(self, counter, self.lines.position())
+        with self.lock:
+            self._batches.append(batch)
+        return batch
+
+    def commit(self):
+        with self.lock:
+            while self._batches and self._batches[0].parts == 0:
+                batch = self._batches.popleft()
+                self.state.update(batch.position)
+                self.state['processed'] += batch.processed
+                self.state['errors'] += batch.errors
+                self._saved = False
+            if not self._saved and time.monotonic() - self._saved_at >= self.interval:
+                self._save()
+
+    def _save(self):
+        save_state(self.path, self.state)
+        self._saved = True
+        self._saved_at = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if not self._saved:
+                self._save()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Coalescing of duplicate keys across batches, files and worker processes, last write in file order wins
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+from delta import fingerprint
+
+WAYS: int = 8  # entries of a bucket
+# key fingerprint (0 for an empty entry), version, value fingerprint (0 for unknown), version in flight (0 for none)
+ENTRY = struct.Struct('<QQQQ')
+BUCKET_SIZE: int = WAYS * ENTRY.size
+COALESCE_SIZE: int = 2 ** 20  # keys per device type
+SEND, SUPERSEDED, DUPLICATE, DEFER = range(4)
+
+
+def version(file_n, chunk_n=0, batch_n=0):
+    """Order of a batch: files are numbered chronologically, chunks and batches in the order of lines"""
+    return file_n << 40 | chunk_n << 20 | batch_n
+
+
+class KeyTable:
+    """
+    Recently sent keys of a device type in shared memory, with the latest version of each (the order of the batch
+    in files) and the version being stored, if any. It is set-associative: a key is in one of the WAYS entries
+    of its bucket, and when a bucket is full the entry with the lowest version which is not in flight is evicted,
+    so the table keeps the most recent keys in file order. Created by the main process before the workers,
+    which inherit it when forked, or attach to the same shared memory and lock when it is unpickled
+    """
+
+    def __init__(self, size=COALESCE_SIZE):
+        buckets = 1
+        while buckets * WAYS < size:
+            buckets *= 2
+        self.mask = buckets - 1
+        self.shm = shared_memory.SharedMemory(create=True, size=buckets * BUCKET_SIZE)
+        self.lock = multiprocessing.Lock()
+        self.evictions = 0
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'mask': self.mask, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.mask = state['mask']
+        self.shm = shared_memory.SharedMemory(state['name'])
+        self.lock = state['lock']
+        self.evictions = 0
+
+    def _lookup(self, key_fp):
+        """:return: offset of the entry of the key, or of the entry to replace, and whether the key was found"""
+        buf = self.shm.buf
+        base = (key_fp & self.mask) * BUCKET_SIZE
+        bucket = bytes(buf[base:base + BUCKET_SIZE])
+        needle = key_fp.to_bytes(8, 'little')
+        pos = bucket.find(needle)
+        while pos >= 0:
+            if not pos % ENTRY.size:
+                return base + pos, True
+            pos = bucket.find(needle, pos + 1)
+        victim, victim_version = None, None
+        for i, (fp, entry_version, _, inflight) in enumerate(ENTRY.iter_unpack(bucket)):
+            if not fp:
+                return base + i * ENTRY.size, False
+            if not inflight and (victim is None or entry_version < victim_version):
+                victim, victim_version = i, entry_version
+        if victim is None:  # all the keys of the bucket are being stored
+            return None, False
+        self.evictions += 1
+        return base + victim * ENTRY.size, False
+
+    def claim(self, data, batch_version, force=False):
+        """
+        Decide on each record of a batch:
+        * SUPERSEDED - a later batch has the key, so the record is dropped;
+        * DUPLICATE - the value is the same as of the latest batch with the key, so the record is dropped;
+        * DEFER - the key of an earlier batch is being stored, the record is to be claimed again after it is;
+        * SEND - the record is to be sent, its version is in flight until confirm().
+        :param data: dict of key -> packed value
+        :param force: send records which would be deferred
+        :return: dict of decision -> {key: packed}
+        """
+        decisions = {SEND: {}, SUPERSEDED: {}, DUPLICATE: {}, DEFER: {}}
+        buf = self.shm.buf
+        with self.lock:
+            for key, packed in data.items():
+                key_fp, value_fp = fingerprint(key), fingerprint(packed)
+                offset, found = self._lookup(key_fp)
+                if offset is None:
+                    decisions[SEND][key] = packed  # the table is out of room, the key is not coalesced
+                    continue
+                if found:
+                    _, entry_version, entry_value, inflight = ENTRY.unpack_from(buf, offset)
+                    if entry_version > batch_version:
+                        decisions[SUPERSEDED][key] = packed
+                        continue
+                    if entry_value == value_fp:
+                        ENTRY.pack_into(buf, offset, key_fp, batch_version, value_fp, inflight)
+                        decisions[DUPLICATE][key] = packed
+                        continue
+                    if inflight and not force:
+                        decisions[DEFER][key] = packed
+                        continue
+                ENTRY.pack_into(buf, offset, key_fp, batch_version, value_fp, batch_version)
+                decisions[SEND][key] = packed
+        return decisions
+
+    def confirm(self, keys, failed=()):
+        """
+        Clear the versions in flight of the stored keys. Values of failed keys become unknown,
+        so they are sent next time whatever the value
+        """
+        buf = self.shm.buf
+        with self.lock:
+            for key in keys:
+                key_fp = fingerprint(key)
+                offset, found = self._lookup(key_fp)
+                if not found:
+                    continue
+                _, entry_version, entry_value, _ = ENTRY.unpack_from(buf, offset)
+                ENTRY.pack_into(buf, offset, key_fp, entry_version, 0 if key in failed else entry_value, 0)
+
+    def close(self, unlink=True):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class Coalescer:
+    """
+    KeyTables of all the device types
+    :param dev_types: iterable of device types
+    """
+
+    def __init__(self, dev_types, size=COALESCE_SIZE):
+        self.tables = {dev_type: KeyTable(size) for dev_type in dev_types}
+
+    def table(self, dev_type):
+        return self.tables.get(dev_type.decode() if isinstance(dev_type, bytes) else dev_type)
+
+    def claim(self, batch_by_dev, batch_version, force=False):
+        """
+        KeyTable.claim of each device type. Records of unknown device types are sent, to be counted as errors
+        :param batch_by_dev: dict of dev_type -> {key: packed}
+        :return: dict of decision -> {dev_type: {key: packed}}
+        """
+        decisions = {SEND: {}, SUPERSEDED: {}, DUPLICATE: {}, DEFER: {}}
+        for dev_type, data in batch_by_dev.items():
+            table = self.table(dev_type)
+            if table is None:
+                decisions[SEND][dev_type] = data
+                continue
+            for decision, records in table.claim(data, batch_version, force).items():
+                if records:
+                    decisions[decision][dev_type] = records
+        return decisions
+
+    def confirm(self, data, failed=()):
+        """
+        :param data: dict of key -> packed value which was sent
+        :param failed: keys which were not stored
+        """
+        by_dev = {}
+        for key in data:
+            dev_type = key.partition(b':' if isinstance(key, bytes) else ':')[0]
+            by_dev.setdefault(dev_type, []).append(key)
+        failed = set(failed)
+        for dev_type, keys in by_dev.items():
+            table = self.table(dev_type)
+            if table is not None:
+                table.confirm(keys, failed)
+
+    def close(self, unlink=True):
+        for table in self.tables.values():
+            table.close(unlink)
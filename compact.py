@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Compact encoding of UserApps values: sorted delta varints of app ids, quantized coords, zstd with a dictionary
+import gzip
+import json
+import math
+import struct
+import sys
+import threading
+from itertools import islice
+from optparse import OptionParser
+
+import fastpack
+from fastpack import encode_varint
+
+FORMAT_V1: int = 0xC1  # first byte of a compact value. UserApps in wire format starts with 0x08, 0x11 or 0x19
+QUANTIZED: int = 0x01  # coords are zigzag varints of degrees * 10 ** digits, digits in the high 4 bits of flags
+ZSTD: int = 0x02  # the body is a zstd frame, compressed with the dictionary
+MAX_DIGITS: int = 9
+DICT_SIZE: int = 16 * 1024
+DICT_SAMPLES: int = 100000  # records of the sample file to train a dictionary on
+ZSTD_LEVEL: int = 3
+
+_DOUBLES = struct.Struct('<dd')
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression requires the zstandard package: pip install zstandard")
+    return zstandard
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def read_varint(data, pos):
+    """:return: value of the varint at pos, position after it"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def load_dictionary(path):
+    """zstd dictionary written by train()"""
+    zstandard = _zstd()
+    with open(path, 'rb') as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+
+class Encoder:
+    """
+    Packs records into the compact format, version 1: FORMAT_V1 byte, flags byte, and the body:
+    * number of apps and app ids as varints, sorted, each but the first one as the difference with the previous one.
+      The order of apps is not kept, duplicates are;
+    * lat and lon as doubles, or as zigzag varints of round(degrees * 10 ** digits) with `digits`;
+    * with a dictionary, the body is compressed with zstd, unless it gets no shorter.
+    :param digits: decimal digits of coords to keep, None for doubles. 5 digits are about a meter
+    :param dictionary: zstandard.ZstdCompressionDict, see train() and load_dictionary()
+    """
+
+    def __init__(self, digits=None, dictionary=None, level=ZSTD_LEVEL):
+        if digits is not None and not 0 <= digits <= MAX_DIGITS:
+            raise ValueError(f"Digits of coords must be within 0..{MAX_DIGITS}: {digits}")
+        self.digits = digits
+        self.scale = 10 ** digits if digits is not None else None
+        self.flags = QUANTIZED | digits << 4 if digits is not None else 0
+        self.dictionary = dictionary
+        self.level = level
+        self._local = threading.local()  # compressors are not thread-safe
+
+    def _compressor(self):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = _zstd().ZstdCompressor(level=self.level, dict_data=self.dictionary, write_content_size=False,
+                                                write_checksum=False)
+            self._local.compressor = compressor
+        return compressor
+
+    def body(self, apps, lat, lon):
+        apps = sorted(apps)
+        if apps and not (0 <= apps[0] and apps[-1] <= fastpack.MAX_UINT32):
+            raise ValueError(f"App id out of uint32 range: {apps[0]}..{apps[-1]}")
+        out = bytearray(encode_varint(len(apps)))
+        prev = 0
+        for app in apps:
+            out += encode_varint(app - prev)
+            prev = app
+        if self.scale is None:
+            out += _DOUBLES.pack(lat, lon)
+        else:
+            if not (math.isfinite(lat) and math.isfinite(lon)):
+                raise ValueError(f"Coords are not finite: {lat}, {lon}")
+            out += encode_varint(zigzag(round(lat * self.scale)))
+            out += encode_varint(zigzag(round(lon * self.scale)))
+        return bytes(out)
+
+    def pack(self, apps, lat, lon):
+        """The same as fastpack.pack_user_apps, in the compact format"""
+        body = self.body(apps, lat, lon)
+        if self.dictionary is not None:
+            compressed = self._compressor().compress(body)
+            if len(compressed) < len(body):
+                return bytes((FORMAT_V1, self.flags | ZSTD)) + compressed
+        return bytes((FORMAT_V1, self.flags)) + body
+
+
+def is_compact(value):
+    return bool(value) and value[0] == FORMAT_V1
+
+
+def decode(value, dictionary=None):
+    """
+    :param value: bytes in the compact format
+    :param dictionary: zstandard.ZstdCompressionDict the value was compressed with, if it was
+    :return: sorted list of app ids, lat, lon
+    """
+    if not is_compact(value):
+        raise ValueError(f"Unknown format of the value: {bytes(value[:1])!r}")
+    flags = value[1]
+    body = value[2:]
+    if flags & ZSTD:
+        if dictionary is None:
+            raise ValueError("The value is compressed with a zstd dictionary, which is not given")
+        body = _zstd().ZstdDecompressor(dict_data=dictionary).decompressobj().decompress(body)
+    n, pos = read_varint(body, 0)
+    apps = []
+    app = 0
+    for _ in range(n):
+        step, pos = read_varint(body, pos)
+        app += step
+        apps.append(app)
+    if flags & QUANTIZED:
+        scale = 10 ** (flags >> 4)
+        lat, pos = read_varint(body, pos)
+        lon, pos = read_varint(body, pos)
+        lat, lon = unzigzag(lat) / scale, unzigzag(lon) / scale
+    else:
+        lat, lon = _DOUBLES.unpack_from(body, pos)
+    return apps, lat, lon
+
+
+def read_records(path, limit=None):
+    """Yield (apps, lat, lon) of the valid lines of a .tsv.gz file, up to limit lines"""
+    with gzip.open(path, 'rt') as f:
+        for line in islice(f, limit):
+            by_dev, errors = fastpack.split_by_dev([line], pack=lambda apps, lat, lon: (apps, lat, lon))
+            for data in by_dev.values():
+                yield from data.values()
+
+
+def train(path, dict_size=DICT_SIZE, samples=DICT_SAMPLES, digits=None):
+    """
+    Train a zstd dictionary on uncompressed compact bodies of the records of a sample file
+    :return: zstandard.ZstdCompressionDict, its as_bytes() is to be saved for load_dictionary()
+    """
+    encoder = Encoder(digits)
+    bodies = [encoder.body(*record) for record in read_records(path, samples)]
+    return _zstd().train_dictionary(dict_size, bodies)
+
+
+def report(path, encoder, limit=None):
+    """
+    Sizes of the values of the records of a file, in UserApps wire format and in the compact format
+    :return: dict of records, bytes of each format, bytes per record of each and bytes saved per record
+    """
+    records = protobuf_bytes = compact_bytes = 0
+    for apps, lat, lon in read_records(path, limit):
+        records += 1
+        protobuf_bytes += len(fastpack.pack_user_apps(apps, lat, lon))
+        compact_bytes += len(encoder.pack(apps, lat, lon))
+    per_record = (lambda total: round(total / records, 2)) if records else (lambda total: 0.0)
+    return {
+        'records': records,
+        'protobuf_bytes': protobuf_bytes,
+        'compact_bytes': compact_bytes,
+        'protobuf_per_record': per_record(protobuf_bytes),
+        'compact_per_record': per_record(compact_bytes),
+        'saved_per_record': per_record(protobuf_bytes - compact_bytes),
+        'ratio': round(compact_bytes / protobuf_bytes, 4) if protobuf_bytes else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="%prog [options] report|train sample.tsv.gz\n\n"
+                            "report: bytes per record of the compact format against UserApps wire format\n"
+                            "train: train a zstd dictionary on the sample file, written to --dict")
+    op.add_option("--coord-digits", action="store", type="int", default=None, help="decimal digits of coords to keep")
+    op.add_option("--dict", action="store", default=None, help="zstd dictionary file")
+    op.add_option("--dict-size", action="store", type="int", default=DICT_SIZE)
+    op.add_option("--limit", action="store", type="int", default=None, help="lines of the file to take")
+    opts, args = op.parse_args()
+    if len(args) != 2 or args[0] not in ('report', 'train'):
+        op.error("command and sample file are required")
+    command, path = args
+    if command == 'train':
+        if not opts.dict:
+            op.error("--dict is required to train a dictionary")
+        dictionary = train(path, opts.dict_size, opts.limit or DICT_SAMPLES, opts.coord_digits)
+        with open(opts.dict, 'wb') as f:
+            f.write(dictionary.as_bytes())
+        print(opts.dict)
+        sys.exit(0)
+    encoder = Encoder(opts.coord_digits, load_dictionary(opts.dict) if opts.dict else None)
+    print(json.dumps(report(path, encoder, opts.limit)))
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Index of the values stored by previous loads, to skip sets of unchanged values
+import glob
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+MAGIC: bytes = b'MEMCDLT1'
+HEADER = struct.Struct('<8sQQ')  # magic, number of slots (a power of 2), number of keys
+SLOT = struct.Struct('<QQ')  # hash of the key (0 for an empty slot), hash of the value (0 for unknown)
+MAX_LOAD: float = 0.7  # share of slots used, the table is enlarged above it
+MIN_SLOTS: int = 2 ** 16
+LOG_BUFFER: int = 4096  # entries buffered by an UpdateLog before a write
+
+
+def fingerprint(data):
+    """
+    64-bit fingerprint of a key or a packed value: adler32 and crc32, which are about twice as fast
+    as a cryptographic hash. Slots of the table are taken from the low bits, so they are of crc32: adler32 of
+    short keys is poorly distributed. Never 0, as 0 marks empty slots and unknown values
+    :param data: str, bytes or memoryview
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    return (zlib.adler32(data) << 32 | zlib.crc32(data)) or 1
+
+
+class DeltaIndex:
+    """
+    Open-addressing table of key hash -> value hash of the records stored by previous loads, memory-mapped
+    from a file, read-only. A missing file is an empty index
+    """
+
+    def __init__(self, path):
+        self.slots = self.count = 0
+        self._mmap = None
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        if self._mmap is not None:
+            magic, self.slots, self.count = HEADER.unpack_from(self._mmap)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a delta index")
+
+    def get(self, key_hash):
+        """:return: hash of the value of the key, 0 if the key is not in the index"""
+        if not self.slots:
+            return 0
+        mask = self.slots - 1
+        i = key_hash & mask
+        buf = self._mmap
+        while True:
+            stored_key, value_hash = SLOT.unpack_from(buf, HEADER.size + i * SLOT.size)
+            if stored_key == key_hash:
+                return value_hash
+            if not stored_key:
+                return 0
+            i = (i + 1) & mask
+
+    def drop_unchanged(self, data):
+        """
+        Remove records with the same value as stored before from the dict
+        :param data: dict of key -> packed value
+        :return: number of records removed
+        """
+        if not self.count:
+            return 0
+        unchanged = [key for key, packed in data.items() if self.get(fingerprint(key)) == fingerprint(packed)]
+        for key in unchanged:
+            del data[key]
+        return len(unchanged)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+
+
+class UpdateLog:
+    """
+    Hashes of the records stored by a process in this load, appended to `<index>.<pid>.log`.
+    Logs are merged into the index by merge()
+    """
+
+    def __init__(self, path):
+        self.path = f"{path}.{os.getpid()}.log"
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def record(self, data, failed=()):
+        """
+        :param data: dict of key -> packed value which was sent
+        :param failed: keys which were not stored
+        """
+        failed = set(failed)
+        entries = [SLOT.pack(fingerprint(key), fingerprint(packed)) for key, packed in data.items()
+                   if key not in failed]
+        with self._lock:
+            self._buffer.extend(entries)
+            if len(self._buffer) >= LOG_BUFFER:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._buffer:
+            with open(self.path, 'ab') as f:
+                f.write(b''.join(self._buffer))
+            self._buffer.clear()
+
+
+def _create(path, slots):
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, slots, 0))
+        f.truncate(HEADER.size + slots * SLOT.size)
+
+
+def _insert(buf, slots, key_hash, value_hash, touched=None):
+    """
+    Set the value hash of the key in the table. With a bitmap of slots already set by this merge, a key set
+    to different values is marked as unknown, as it is not known which of the values was stored the last
+    :return: True if the key is new
+    """
+    mask = slots - 1
+    i = key_hash & mask
+    while True:
+        offset = HEADER.size + i * SLOT.size
+        stored_key, stored_value = SLOT.unpack_from(buf, offset)
+        if stored_key == key_hash or not stored_key:
+            if touched is not None:
+                if touched[i >> 3] & 1 << (i & 7) and stored_value != value_hash:
+                    value_hash = 0
+                touched[i >> 3] |= 1 << (i & 7)
+            SLOT.pack_into(buf, offset, key_hash, value_hash)
+            return not stored_key
+        i = (i + 1) & mask
+
+
+def merge(path):
+    """
+    Apply the update logs of all processes to the index, and remove them. The new index is written
+    to a temporary file and replaces the old one, so an interrupted merge leaves the old index and the logs
+    :return: number of entries applied
+    """
+    logs = sorted(glob.glob(glob.escape(path) + '.*.log'))
+    if not logs:
+        return 0
+    entries = sum(os.path.getsize(log) for log in logs) // SLOT.size
+    old = DeltaIndex(path)
+    slots = max(MIN_SLOTS, old.slots)
+    while (old.count + entries) > slots * MAX_LOAD:
+        slots *= 2
+    tmp = path + '.tmp'
+    _create(tmp, slots)
+    with open(tmp, 'r+b') as f, mmap.mmap(f.fileno(), 0) as buf:
+        count = 0
+        if old.slots == slots:
+            buf[HEADER.size:] = old._mmap[HEADER.size:]
+            count = old.count
+        elif old.count:
+            for i in range(old.slots):
+                key_hash, value_hash = SLOT.unpack_from(old._mmap, HEADER.size + i * SLOT.size)
+                if key_hash:
+                    count += _insert(buf, slots, key_hash, value_hash)
+        old.close()
+        touched = bytearray(slots // 8)
+        for log in logs:
+            with open(log, 'rb') as log_file:
+                data = log_file.read()
+            for key_hash, value_hash in SLOT.iter_unpack(data[:len(data) - len(data) % SLOT.size]):
+                count += _insert(buf, slots, key_hash, value_hash, touched)
+        HEADER.pack_into(buf, 0, MAGIC, slots, count)
+        buf.flush()
+    os.replace(tmp, path)
+    for log in logs:
+        os.remove(log)
+    return entries
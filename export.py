@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Bulk export of records into per-server dump files of memcached set commands, and their fast replay
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+
+from memc_meta import RECV_SIZE, SOCKET_TIMEOUT, prepare_items
+
+MANIFEST = 'manifest.json'
+SUFFIX = '.memc'
+
+
+def encode_sets(items):
+    """
+    Quiet meta-sets of the records, `ms <key> <datalen> q` followed by the value: memcached replies only to failures
+    :param items: list of (key, value) pairs, both are bytes
+    """
+    return b''.join(b'ms %s %d q\r\n%s\r\n' % (key, len(value), value) for key, value in items)
+
+
+def dump_dir(addr):
+    """Directory of the dumps of a memcached instance, relative to the export directory"""
+    return addr.replace(':', '_')
+
+
+class DumpFiles:
+    """
+    Dump files of an input file, one per memcached instance, at <directory>/<host>_<port>/<name>.memc.
+    A dump is written to a temporary file, and renamed when it is closed with the final `mn`,
+    so an interrupted export leaves no dumps to be replayed partially
+    :param name: name of the dump files, e.g. of the input file, so that dumps sort chronologically
+    """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.files = {}  # address -> open temporary file
+        self.records = {}  # address -> number of records written
+
+    def path(self, addr):
+        return os.path.join(self.directory, dump_dir(addr), self.name + SUFFIX)
+
+    def write(self, addr, data):
+        """
+        :param data: dict of key -> packed value
+        :return: invalid keys, which are not written
+        """
+        _, items, invalid = prepare_items(data)
+        if addr not in self.files:
+            os.makedirs(os.path.dirname(self.path(addr)), exist_ok=True)
+            self.files[addr] = open(self.path(addr) + f'.{os.getpid()}.tmp', 'wb')
+            self.records[addr] = 0
+        self.files[addr].write(encode_sets(items))
+        self.records[addr] += len(items)
+        return invalid
+
+    def close(self):
+        """:return: dict of path of the dump relative to the directory -> [address, number of records]"""
+        dumps = {}
+        for addr, f in self.files.items():
+            with f:
+                f.write(b'mn\r\n')
+            os.replace(f.name, self.path(addr))
+            dumps[os.path.relpath(self.path(addr), self.directory)] = [addr, self.records[addr]]
+        self.files.clear()
+        return dumps
+
+
+def update_manifest(directory, dumps):
+    """
+    Add the dumps to the manifest of the export directory, which tells the address of each dump for replay
+    :param dumps: see DumpFiles.close
+    """
+    path = os.path.join(directory, MANIFEST)
+    manifest = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+    manifest.update(dumps)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def read_replies(sock, sent):
+    """
+    Read the replies to a dump until the final MN
+    :param sent: Event set when the whole dump is written, a timeout before that is not an error
+    as quiet sets are not replied
+    :return: number of failed sets
+    """
+    buffer = b''
+    failed = 0
+    while True:
+        try:
+            data = sock.recv(RECV_SIZE)
+        except socket.timeout:
+            if sent.is_set():
+                raise
+            continue
+        if not data:
+            raise ConnectionError("Connection closed before the end of the replies")
+        *lines, buffer = (buffer + data).split(b'\r\n')
+        for line in lines:
+            if line == b'MN':
+                return failed
+            if line and not line.startswith(b'HD'):
+                if not failed:
+                    logging.warning(f"First failed set: {line[:100]!r}")
+                failed += 1
+
+
+def replay(path, addr, timeout=SOCKET_TIMEOUT):
+    """
+    Stream a dump file to the memcached instance with sendfile, so the file is copied to the socket by the kernel
+    with no parsing or packing, while the replies are read in a thread
+    :return: number of failed sets
+    """
+    host, port = addr.rsplit(':', 1)
+    sent = threading.Event()
+    with socket.create_connection((host, int(port)), timeout=timeout) as sock, open(path, 'rb') as f:
+        with ThreadPoolExecutor(1) as executor:
+            replies = executor.submit(read_replies, sock, sent)
+            try:
+                sock.sendfile(f)
+            except OSError:
+                sock.shutdown(socket.SHUT_RDWR)  # to stop the reader
+                raise
+            finally:
+                sent.set()
+            return replies.result()
+
+
+def replay_all(directory, timeout=SOCKET_TIMEOUT, servers=None):
+    """
+    Replay the dumps of the manifest, the dumps of an instance one by one in chronological order,
+    the instances at once
+    :param servers: dict of address in the manifest -> address to replay to, to warm up other instances
+    :return: dict of address -> [records, failed]
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    by_addr = {}
+    for path, (addr, records) in sorted(manifest.items()):
+        by_addr.setdefault(addr, []).append((path, records))
+
+    def replay_server(addr):
+        target = (servers or {}).get(addr, addr)
+        records = failed = 0
+        for path, count in by_addr[addr]:
+            start = time.monotonic()
+            failed += replay(os.path.join(directory, path), target, timeout)
+            seconds = time.monotonic() - start
+            records += count
+            logging.info(f"Dump {path} replayed to {target}: {count} records in {seconds:.2f}s, "
+                         f"{count / max(seconds, 1e-9):.0f} records/sec")
+        return [records, failed]
+
+    with ThreadPoolExecutor(max(1, len(by_addr))) as executor:
+        return dict(zip(by_addr, executor.map(replay_server, by_addr)))
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="%prog replay DIRECTORY\n\nReplay the dumps written by memc_load.py --export DIRECTORY")
+    op.add_option("--timeout", action="store", type="float", default=SOCKET_TIMEOUT,
+                  help="seconds to wait for an instance to connect, accept or answer")
+    op.add_option("--server", action="append", default=[],
+                  help="OLD=NEW to replay the dumps of address OLD to address NEW, may be repeated")
+    opts, args = op.parse_args()
+    if len(args) != 2 or args[0] != 'replay':
+        op.error("replay DIRECTORY is expected")
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    result = replay_all(args[1], opts.timeout, dict(server.split('=', 1) for server in opts.server))
+    print(json.dumps(result))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# In-process memcached stand-in for benchmarks and tests: text and meta protocol, injected latency and failures
+import asyncio
+import random
+import threading
+
+STORE_COMMANDS = (b'set', b'add', b'replace')
+
+
+class MemcachedProtocol(asyncio.Protocol):
+    """
+    Connection of a FakeMemcached. Replies to the commands received in one segment are written together,
+    `latency` seconds later, as if the server was that far away
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = b''
+        self.transport = None
+        self.ready_at = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        out = []
+        pos = 0
+        while True:
+            end = self.buffer.find(b'\r\n', pos)
+            if end < 0:
+                break
+            parts = self.buffer[pos:end].split()
+            size = self._data_size(parts)
+            value = None
+            if size is not None:
+                if len(self.buffer) < end + 2 + size + 2:
+                    break  # wait for the rest of the value
+                value = self.buffer[end + 2:end + 2 + size]
+                end += size + 2
+            pos = end + 2
+            if parts and parts[0] == b'quit':
+                self.transport.close()
+                return
+            out.append(self.server.execute(parts, value))
+        self.buffer = self.buffer[pos:]
+        self._write(b''.join(out))
+
+    @staticmethod
+    def _data_size(parts):
+        try:
+            if parts[0] in STORE_COMMANDS:
+                return int(parts[4])
+            if parts[0] == b'ms':
+                return int(parts[2])
+        except (IndexError, ValueError):
+            pass
+
+    def _write(self, out):
+        if not out:
+            return
+        latency = self.server.latency
+        if not latency:
+            self.transport.write(out)
+            return
+        loop = asyncio.get_running_loop()
+        self.ready_at = max(loop.time() + latency, self.ready_at + 1e-6)  # keep replies in order
+        loop.call_at(self.ready_at, self._write_later, out)
+
+    def _write_later(self, out):
+        if not self.transport.is_closing():
+            self.transport.write(out)
+
+
+class FakeMemcached:
+    """
+    Memcached server running in a thread of the current process. It keeps values in a dict, supports
+    get/gets/set/add/replace/delete/flush_all/version and meta-commands ms/mg/md/mn with flags used by
+    the loader and the reader (q, O, k, v, f)
+    :param latency: seconds added to each round-trip
+    :param fail_rate: share of storage commands failed with NOT_STORED (NS for meta-commands)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, fail_rate=0.0, seed=None):
+        self.host, self.port = host, port
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.store = {}
+        self.n_commands = 0
+        self.loop = None
+        self._server = None
+        self._thread = None
+        self.commands = {
+            b'set': self._set, b'add': self._add, b'replace': self._replace, b'get': self._get, b'gets': self._gets,
+            b'delete': self._delete, b'flush_all': self._flush_all, b'version': self._version,
+            b'ms': self._ms, b'mg': self._mg, b'md': self._md, b'mn': self._mn,
+        }
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def _run(self, started):
+        self.loop = asyncio.new_event_loop()
+        self._server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: MemcachedProtocol(self), self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+        self._server.close()
+        self.loop.run_until_complete(self._server.wait_closed())
+        self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _failed(self):
+        return self.fail_rate and self.random.random() < self.fail_rate
+
+    def execute(self, parts, value):
+        self.n_commands += 1
+        command = self.commands.get(parts[0]) if parts else None
+        if command is None:
+            return b'ERROR\r\n'
+        try:
+            return command(parts[1:], value)
+        except (IndexError, ValueError):
+            return b'CLIENT_ERROR bad command line format\r\n'
+
+    def _store(self, key, flags, value, mode=b'set'):
+        if (mode == b'add' and key in self.store) or (mode == b'replace' and key not in self.store) or self._failed():
+            return False
+        self.store[key] = (flags, value)
+        return True
+
+    def _set(self, args, value, mode=b'set'):
+        stored = self._store(args[0], int(args[1]), value, mode)
+        if args[-1] == b'noreply':
+            return b''
+        return b'STORED\r\n' if stored else b'NOT_STORED\r\n'
+
+    def _add(self, args, value):
+        return self._set(args, value, b'add')
+
+    def _replace(self, args, value):
+        return self._set(args, value, b'replace')
+
+    def _get(self, args, value, cas=False):
+        out = []
+        for key in args:
+            if key in self.store:
+                flags, data = self.store[key]
+                out.append(b'VALUE %s %d %d%s\r\n%s\r\n' % (key, flags, len(data), b' 1' if cas else b'', data))
+        out.append(b'END\r\n')
+        return b''.join(out)
+
+    def _gets(self, args, value):
+        return self._get(args, value, cas=True)
+
+    def _delete(self, args, value):
+        found = self.store.pop(args[0], None) is not None
+        if args[-1] == b'noreply':
+            return b''
+        return b'DELETED\r\n' if found else b'NOT_FOUND\r\n'
+
+    def _flush_all(self, args, value):
+        self.store.clear()
+        return b'' if args and args[-1] == b'noreply' else b'OK\r\n'
+
+    def _version(self, args, value):
+        return b'VERSION 1.6.21-fake\r\n'
+
+    @staticmethod
+    def _meta_reply(code, key, flags, extra=()):
+        """Reply to a meta-command: opaque and key are returned when asked, as memcached does"""
+        tokens = [code, *extra]
+        for flag in flags:
+            if flag[:1] == b'O':
+                tokens.append(flag)
+            elif flag == b'k':
+                tokens.append(b'k' + key)
+        return b' '.join(tokens) + b'\r\n'
+
+    def _ms(self, args, value):
+        key, flags = args[0], args[2:]
+        client_flags = next((int(flag[1:]) for flag in flags if flag[:1] == b'F'), 0)
+        if self._store(key, client_flags, value):
+            return b'' if b'q' in flags else self._meta_reply(b'HD', key, flags)
+        return self._meta_reply(b'NS', key, flags)
+
+    def _mg(self, args, value):
+        key, flags = args[0], args[1:]
+        if key not in self.store:
+            return b'' if b'q' in flags else self._meta_reply(b'EN', key, flags)
+        client_flags, data = self.store[key]
+        extra = [b'f%d' % client_flags] if b'f' in flags else []
+        if b'v' in flags:
+            return self._meta_reply(b'VA', key, flags, [b'%d' % len(data)] + extra) + data + b'\r\n'
+        return self._meta_reply(b'HD', key, flags, extra)
+
+    def _md(self, args, value):
+        key, flags = args[0], args[1:]
+        if self.store.pop(key, None) is None:
+            return self._meta_reply(b'NF', key, flags)
+        return b'' if b'q' in flags else self._meta_reply(b'HD', key, flags)
+
+    def _mn(self, args, value):
+        return b'MN\r\n'
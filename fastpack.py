@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Batch parser which emits UserApps wire format directly, without protobuf message objects
+import logging
+import struct
+from collections import defaultdict
+
+APPS_TAG: int = 0x08  # field 1, varint
+MAX_CACHED_APPS: int = 1 << 20  # distinct app ids kept in the cache of encoded fields
+MAX_UINT32: int = (1 << 32) - 1
+
+_COORDS = struct.Struct('<BdBd')  # field 2 and field 3, both fixed64 doubles
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+class _AppFields(dict):
+    """Encoded `apps` field by app id. App ids repeat a lot across records, so each one is encoded only once"""
+
+    def __missing__(self, app):
+        if not 0 <= app <= MAX_UINT32:
+            raise ValueError(f"App id out of uint32 range: {app}")
+        field = bytes((APPS_TAG,)) + encode_varint(app)
+        if len(self) < MAX_CACHED_APPS:
+            self[app] = field
+        return field
+
+
+_app_fields = _AppFields()
+
+
+def pack_user_apps(apps, lat, lon):
+    """
+    UserApps message in wire format, byte-for-byte equal to SerializeToString() of protobuf. As `apps` is not
+    declared packed in appsinstalled.proto, each app id goes with its own tag, as protobuf does
+    """
+    return b''.join(map(_app_fields.__getitem__, apps)) + _COORDS.pack(0x11, lat, 0x19, lon)
+
+
+def split_by_dev(batch, pack=pack_user_apps):
+    """
+    The same as memc_load.split_by_dev: records of the batch packed and grouped by device type. Fields are split
+    and packed in one pass over the batch, with no intermediate objects per record. Unlike parse_appsinstalled,
+    a record with invalid geo coords or app ids which do not fit into uint32 is counted as an error, instead
+    of failing the serialization of the whole batch
+    :param batch: list of lines, or a block of lines split with splitlines(). Lines are either str, or bytes
+    as read from a binary file: then dev types and keys are bytes too, and nothing is decoded
+    :param pack: function of apps, lat, lon packing a value, e.g. compact.Encoder.pack
+    :return: dict of dev_type -> {key: packed}, number of lines which could not be parsed
+    """
+    splitted_batch = defaultdict(dict)
+    batch_errors = 0
+    if not batch:
+        return splitted_batch, batch_errors
+    tab, comma, colon = (b'\t', b',', b':') if isinstance(batch[0], bytes) else ('\t', ',', ':')
+    for line in batch:
+        parts = line.strip().split(tab)
+        if len(parts) != 5:
+            batch_errors += 1
+            continue
+        dev_type, dev_id, lat, lon, raw_apps = parts
+        if not dev_type or not dev_id:
+            batch_errors += 1
+            continue
+        raw_apps = raw_apps.split(comma)
+        try:
+            apps = list(map(int, raw_apps))
+        except ValueError:
+            apps = [int(a) for a in raw_apps if a.isdigit()]
+            logging.info(f"Not all user apps are digits: `{line}`")
+        try:
+            packed = pack(apps, float(lat), float(lon))
+        except ValueError:
+            batch_errors += 1
+            continue
+        splitted_batch[dev_type][dev_type + colon + dev_id] = packed
+    return splitted_batch, batch_errors
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Generator of synthetic .tsv.gz files of installed apps, in the format memc_load.py reads
+import gzip
+import itertools
+import os
+import random
+import uuid
+from optparse import OptionParser
+
+DEV_TYPES: str = "idfa=0.4,gaid=0.4,adid=0.1,dvid=0.1"
+APPS_MEAN: int = 20  # mean length of an app list
+APP_IDS: int = 10000  # app ids are drawn from 1..APP_IDS
+
+
+def parse_mix(mix):
+    """
+    :param mix: comma-separated dev_type=weight pairs, e.g. `idfa=0.5,gaid=0.5`
+    :return: list of device types, list of their weights
+    """
+    pairs = [item.split('=') for item in mix.split(',')]
+    return [dev_type for dev_type, _ in pairs], [float(weight) for _, weight in pairs]
+
+
+def generate_lines(rows, dev_types=DEV_TYPES, apps_mean=APPS_MEAN, dirty_rate=0.0, seed=None):
+    """
+    Yield lines of installed apps. App list lengths follow a geometric distribution with the given mean,
+    as most devices have a few apps and some have a lot of them. App ids follow a Zipf-like distribution
+    :param dirty_rate: share of lines with errors: too few fields, invalid coords or non-digit apps
+    """
+    rnd = random.Random(seed)
+    types, weights = parse_mix(dev_types)
+    cum_popularity = list(itertools.accumulate(1 / rank for rank in range(1, APP_IDS + 1)))
+    app_ids = list(range(1, APP_IDS + 1))
+    for _ in range(rows):
+        dev_type = rnd.choices(types, weights)[0]
+        dev_id = uuid.UUID(int=rnd.getrandbits(128)).hex
+        n_apps = 1
+        while rnd.random() > 1 / apps_mean:
+            n_apps += 1
+        apps = ','.join(map(str, rnd.choices(app_ids, cum_weights=cum_popularity, k=n_apps)))
+        lat, lon = f"{rnd.uniform(-90, 90):.6f}", f"{rnd.uniform(-180, 180):.6f}"
+        if dirty_rate and rnd.random() < dirty_rate:
+            kind = rnd.randrange(3)
+            if kind == 0:
+                yield f"{dev_type}\t{dev_id}\t{lat}\n"
+                continue
+            if kind == 1:
+                lat = 'unknown'
+            else:
+                apps += ',none'
+        yield f"{dev_type}\t{dev_id}\t{lat}\t{lon}\t{apps}\n"
+
+
+def generate_file(path, rows, **kwargs):
+    """Write a gzipped file of generated lines, see generate_lines for the arguments"""
+    with gzip.open(path, 'wt') as f:
+        f.writelines(generate_lines(rows, **kwargs))
+    return path
+
+
+def generate_files(directory, files, rows, prefix='appsinstalled', seed=None, **kwargs):
+    """
+    Write files named as the daily dumps, rows per file
+    :return: list of paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"{prefix}-2017090{i + 1}000000.tsv.gz")
+        paths.append(generate_file(path, rows, seed=None if seed is None else seed + i, **kwargs))
+    return paths
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="%prog [options] directory")
+    op.add_option("--files", action="store", type="int", default=1)
+    op.add_option("--rows", action="store", type="int", default=100000, help="rows per file")
+    op.add_option("--dev-types", action="store", default=DEV_TYPES)
+    op.add_option("--apps-mean", action="store", type="int", default=APPS_MEAN)
+    op.add_option("--dirty-rate", action="store", type="float", default=0.0)
+    op.add_option("--seed", action="store", type="int", default=None)
+    opts, args = op.parse_args()
+    if len(args) != 1:
+        op.error("directory is required")
+    for path in generate_files(args[0], opts.files, opts.rows, seed=opts.seed, dev_types=opts.dev_types,
+                               apps_mean=opts.apps_mean, dirty_rate=opts.dirty_rate):
+        print(path)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Consistent hashing of keys over a pool of memcached instances, compatible with libketama
+import bisect
+import hashlib
+
+HASHES_PER_SERVER: int = 40  # each md5 digest gives 4 points of the ring
+
+
+def _digest(value):
+    return hashlib.md5(value.encode() if isinstance(value, str) else value).digest()
+
+
+def key_hash(key):
+    d = _digest(key)
+    return d[3] << 24 | d[2] << 16 | d[1] << 8 | d[0]
+
+
+class HashRing:
+    """
+    Ring of 160 points per server, as libketama (and readers compatible with it) build it for servers of equal
+    weight: points of a server are 4-byte slices of md5("<host>:<port>-<n>"). A key belongs to the first point
+    clockwise of md5 of the key, so adding a server to a ring of N remaps only about 1/(N+1) of the keys
+    """
+
+    def __init__(self, servers):
+        points = []
+        for server in servers:
+            for n in range(HASHES_PER_SERVER):
+                d = _digest(f"{server}-{n}")
+                for h in range(4):
+                    points.append((d[3 + h * 4] << 24 | d[2 + h * 4] << 16 | d[1 + h * 4] << 8 | d[h * 4], server))
+        points.sort()
+        self.points = [point for point, _ in points]
+        self.servers = [server for _, server in points]
+
+    def get_node(self, key):
+        i = bisect.bisect_left(self.points, key_hash(key))
+        return self.servers[i if i < len(self.points) else 0]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Asynchronous memcached client for the asyncio engine of the loader
+import asyncio
+
+from memc_meta import SOCKET_TIMEOUT, build_meta_set, failed_keys, is_complete, prepare_items
+
+READ_LIMIT: int = 2 ** 20  # buffer limit of a connection reader, replies of a batch must fit into it
+
+
+class AsyncMetaClient:
+    """
+    Client of a single memcached instance for an event loop. Up to `limit` batches are stored concurrently,
+    each one on its own connection with quiet meta-commands (see memc_meta). Connections are opened on demand
+    and reused for the next batches. Use `slots` to wait for a free connection before preparing a batch
+    """
+
+    def __init__(self, addr, limit, socket_timeout=SOCKET_TIMEOUT):
+        host, port = addr.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.socket_timeout = socket_timeout
+        self.servers = [f"inet:{addr}"]
+        self.slots = asyncio.Semaphore(limit)
+        self._idle = []
+        self._taken = set()  # tasks taking slots out, see resize
+
+    async def _connect(self):
+        if self._idle:
+            return self._idle.pop()
+        return await asyncio.wait_for(asyncio.open_connection(*self.address, limit=READ_LIMIT), self.socket_timeout)
+
+    async def _read_until_mn(self, reader):
+        reply = b''
+        while not is_complete(reply):
+            reply += await reader.readuntil(b'MN\r\n')
+        return reply[:-4]
+
+    async def set_multi(self, mapping):
+        """
+        Store all the records of the mapping
+        :return: list of keys which were not stored
+        """
+        keys, items, failed = prepare_items(mapping)
+        if not items:
+            return failed
+        conn = None
+        try:
+            conn = reader, writer = await self._connect()
+            writer.writelines(build_meta_set(items))
+            await asyncio.wait_for(writer.drain(), self.socket_timeout)
+            reply = await asyncio.wait_for(self._read_until_mn(reader), self.socket_timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            if conn is not None:
+                conn[1].close()
+            return failed + keys
+        self._idle.append(conn)
+        return failed + failed_keys(reply, keys)
+
+    def resize(self, delta):
+        """Change the number of batches stored at once by delta"""
+        for _ in range(delta):
+            self.slots.release()
+        for _ in range(-delta):
+            task = asyncio.ensure_future(self.slots.acquire())  # a slot is taken out as soon as it is free
+            self._taken.add(task)
+            task.add_done_callback(self._taken.discard)
+
+    async def disconnect_all(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+            await writer.wait_closed()
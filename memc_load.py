@@ -2,25 +2,54 @@
 # -*- coding: utf-8 -*-
 import glob
 import gzip
+import io
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import signal
 import sys
+import threading
 import time
 from collections import defaultdict, namedtuple
-from concurrent.futures import ThreadPoolExecutor, as_completed, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 from itertools import islice
 from optparse import OptionParser
 
-import memcache
+import autotune
+import budget
+import checkpoint
+import coalesce
+import compact
+import delta
+import export
+import fastpack
+import ketama
+import memc_meta
+import metrics
+import retry
+import scheduler
+import shmbatch
+import validate
+import verify
 
-import appsinstalled_pb2
-
-N_RETRY_ON_ERROR: int = 2  # number of retries in case inserting is unsuccessful
+N_RETRY_ON_ERROR: int = 2  # number of retries of the failed keys of a batch
 BATCH_SIZE: int = 20000
 N_PROCESSES: int = 3
-N_THREADS: int = 4  # as we split each batch by 4 device-type block of records, and store each block as set_multi
+CHUNK_SIZE: int = 16 * 2 ** 20  # bytes of decompressed lines passed to a worker, when a file is split
+QUEUE_DEPTH: int = 2  # batches waiting for a sender thread, per memcached instance
+INFLIGHT: int = 4  # batches being stored concurrently by the asyncio engine, per memcached instance
 NORMAL_ERR_RATE: float = 0.01
+DEFER_TIMEOUT: float = 30.0  # seconds to wait for an earlier write of a key, before sending the key anyway
+# options which rely on the memory or the pid of a worker process, see resolve_executor
+INTERPRETERS_UNSUPPORTED = ('coalesce', 'max_memory', 'metrics_port', 'stats_interval', 'delta_index', 'dead_letter',
+                            'dry')
 AppsInstalled = namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
+Delta = namedtuple("Delta", ["pid", "index", "log"])
+SenderCall = namedtuple("SenderCall", ["func", "future"])  # queued to a sender thread, see InsertPipeline.call
 
 
 def dot_rename(path):
@@ -29,6 +58,7 @@ def dot_rename(path):
 
 
 def protobuf_serilalize(appsinstalled):
+    import appsinstalled_pb2
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
     ua.lon = appsinstalled.lon
@@ -38,28 +68,736 @@ def protobuf_serilalize(appsinstalled):
     return key, packed
 
 
-def insert_appsinstalled_multi(memc: memcache.Client, data, dry_run=False):
-    # @TODO timeouts!
+def insert_appsinstalled_multi(memc: 'memcache.Client', data, dry_run=False):
+    """
+    Store the records, retrying only the keys which failed, with jittered exponential backoff. No sends are made
+    while the circuit of the server is open. Records which are not stored go to the dead-letter file.
+    With --noreply, replies are not waited for, so only records which could not be sent are counted as failed
+    :return: number of records not stored, total number of records
+    """
     total_records = len(data)
-    try:
-        if dry_run:
-            ua = appsinstalled_pb2.UserApps()
-            for key, value in data.items():
-                ua.ParseFromString(value)
-                ua_cr_replaced = str(ua).replace('\n', ' ')
-                logging.debug(f"{memc.servers[0]} - {key} -> {ua_cr_replaced}")
-        else:
-            result, i = False, 0
-            while i < N_RETRY_ON_ERROR:
-                result = memc.set_multi(data)
-                if not result:  # if ok, result is an empty list, if not - failed keys
-                    return 0, total_records
-                time.sleep(0.02)
-                i += 1
-            return len(result), total_records  # n of errors, total
-    except Exception as exc:
-        logging.exception(f"Cannot write to memc {memc.servers[0]}: {exc}")
-        return total_records, total_records  # assume all data is not stored
+    if dry_run:
+        from check_memc_values import decode_value
+        encoder = get_encoder()
+        dictionary = None if encoder is None else encoder.dictionary
+        for key, value in data.items():
+            ua_cr_replaced = str(decode_value(value, dictionary)).replace('\n', ' ')
+            logging.debug(f"{memc.servers[0]} - {key} -> {ua_cr_replaced}")
+        if _coalescer is not None:
+            _coalescer.confirm(data)
+        return 0, total_records
+    addr = server_name(memc)
+    breaker = get_breaker(addr)
+    noreply = opts.noreply and is_memcache(memc)
+    pending = data
+    for attempt in range(N_RETRY_ON_ERROR + 1):
+        if attempt:
+            metrics.current.inc('retries')
+            time.sleep(retry.backoff(attempt))
+        if not breaker.allow():
+            break
+        try:
+            if noreply:  # only keys which could not be written to the socket are returned
+                failed = memc.set_multi(pending, noreply=True)
+            else:
+                failed = memc.set_multi(pending)  # if ok, an empty list, if not - failed keys
+        except Exception as exc:
+            logging.exception(f"Cannot write to memc {addr}: {exc}")
+            failed = list(pending)
+        pending = send_result(breaker, pending, failed)
+        if not pending:
+            break
+    return fail_records(data, pending), total_records
+
+
+def is_memcache(memc):
+    """Whether the client is of python-memcached, which is imported with the first such client"""
+    memcache = sys.modules.get('memcache')
+    return memcache is not None and isinstance(memc, memcache.Client)
+
+
+def server_name(memc):
+    """`inet:host:port` of the client, as python-memcached adds the state of the server to the name of its host"""
+    server = memc.servers[0]
+    return server if isinstance(server, str) else f"inet:{server.ip}:{server.port}"
+
+
+def send_result(breaker, sent, failed):
+    """
+    Report a send to the circuit breaker of the server: it failed if none of the keys is stored
+    :return: dict of key -> packed of the records to retry
+    """
+    if len(failed) < len(sent):
+        breaker.success()
+    elif breaker.failure():
+        metrics.current.inc('breaker_open')
+    return {key: sent[key] for key in failed}
+
+
+def fail_records(data, failed):
+    """
+    Count the records of the batch which were not stored, and put them into the dead-letter file
+    :param failed: dict of key -> packed
+    :return: number of failed records
+    """
+    if failed:
+        metrics.current.inc('failed_keys', len(failed))
+        spill(failed)
+    record_stored(data, failed)
+    return len(failed)
+
+
+class LoadCounter:
+    """
+    Thread-safe number of processed and failed records of a file, and latencies of storing its batches.
+    Records skipped as unchanged since the previous load, and duplicates dropped, are counted as processed too.
+    Lines rejected by the validating parser are counted in `rejects` by category too
+    """
+
+    def __init__(self):
+        self.processed = self.errors = self.skipped = self.duplicates = 0
+        self.latencies = []
+        self.rejects = validate.Rejects(opts.reject_sample)
+        self.queued = 0  # batches submitted to the sender pipeline, and not inserted yet
+        self._lock = threading.Lock()
+        self._inserted = threading.Condition(self._lock)
+
+    def add(self, errors, total, latency=None):
+        with self._lock:
+            self.errors += errors
+            self.processed += total - errors
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def skip(self, n):
+        with self._lock:
+            self.skipped += n
+            self.processed += n
+
+    def coalesce(self, n):
+        with self._lock:
+            self.duplicates += n
+            self.processed += n
+
+    def summary(self):
+        """Counts as a dict, to be returned from a worker process"""
+        return {'processed': self.processed, 'errors': self.errors, 'skipped': self.skipped,
+                'duplicates': self.duplicates, 'latencies': self.latencies, 'rejects': self.rejects.summary()}
+
+    def merge(self, summary):
+        with self._lock:
+            self.processed += summary['processed']
+            self.errors += summary['errors']
+            self.skipped += summary.get('skipped', 0)
+            self.duplicates += summary.get('duplicates', 0)
+            self.latencies.extend(summary['latencies'])
+            if 'rejects' in summary:
+                self.rejects.merge(summary['rejects'])
+
+    def submitted(self):
+        with self._lock:
+            self.queued += 1
+
+    def inserted(self):
+        with self._lock:
+            self.queued -= 1
+            if not self.queued:
+                self._inserted.notify_all()
+
+    def wait_inserted(self):
+        """Wait until the batches submitted are inserted"""
+        with self._lock:
+            self._inserted.wait_for(lambda: not self.queued)
+
+
+class InsertPipeline:
+    """
+    Long-lived sender stage of a worker process. The parser puts batches into a bounded queue per memcached
+    instance, and each queue is drained by its own thread, so the parsing and packing of batch N+1 overlaps
+    the network round-trips of batch N. Sender threads are started once and reused for all files of the worker.
+    With a tuner, the depth of the queues follows its number of batches in flight
+    """
+
+    def __init__(self, depth=QUEUE_DEPTH, tuner=None):
+        self.depth = depth
+        self.tuner = tuner
+        self.pid = os.getpid()
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        self.stats = {'batches': 0, 'occupancy_sum': 0, 'occupancy_max': 0, 'stall_time': 0.0, 'idle_time': 0.0}
+
+    def _queue(self, memc):
+        with self._lock:
+            q = self._queues.get(memc)
+            if q is None:
+                q = self._queues[memc] = queue.Queue()  # bounded by depth in submit, as depth may change
+                threading.Thread(target=self._send, args=(memc, q), daemon=True).start()
+            return q
+
+    def _send(self, memc, q):
+        while True:
+            start = time.monotonic()
+            item = q.get()
+            idle = time.monotonic() - start
+            with self._space:
+                self.stats['idle_time'] += idle
+                self._space.notify_all()
+            if item is None:
+                q.task_done()
+                return
+            if isinstance(item, SenderCall):
+                try:
+                    item.future.set_result(item.func(memc))
+                except Exception as exc:
+                    item.future.set_exception(exc)
+                finally:
+                    q.task_done()
+                continue
+            data, counter, dry_run, done = item
+            try:
+                start = time.monotonic()
+                errors, total = insert_appsinstalled_multi(memc, data, dry_run)
+                latency = time.monotonic() - start
+                metrics.current.observe('set_multi', latency)
+                if self.tuner is not None:
+                    self.tuner.record_send(memc.servers[0], total, latency, errors)
+                counter.add(errors, total, latency)
+            except Exception as exc:  # the thread goes on with the next batches, or the queue would fill up
+                logging.exception(f"Batch of {len(data)} records to {memc.servers[0]} has failed: {exc}")
+                counter.add(len(data), len(data))
+                record_stored(data, data)  # releases the keys in flight of the coalescer
+            finally:
+                del data, item
+                if done is not None:
+                    done()
+                counter.inserted()
+                q.task_done()
+
+    def submit(self, memc, data, counter, dry_run=False, done=None):
+        """
+        Queue a batch for insertion, blocking while the queue of the instance is full
+        :param memc: client of the memcached instance
+        :param data: dict of key -> packed value
+        :param counter: LoadCounter which is updated when the batch is inserted
+        :param done: function called with no arguments after the batch is inserted
+        """
+        q = self._queue(memc)
+        counter.submitted()
+        start = time.monotonic()
+        with self._space:
+            if self.tuner is not None:
+                self.depth = self.tuner.inflight
+            occupancy = q.qsize()
+            while q.qsize() >= self.depth:
+                self._space.wait()
+            q.put((data, counter, dry_run, done))
+            stall = time.monotonic() - start
+            metrics.current.observe('queue_wait', stall)
+            self.stats['batches'] += 1
+            self.stats['occupancy_sum'] += occupancy
+            self.stats['occupancy_max'] = max(self.stats['occupancy_max'], occupancy)
+            self.stats['stall_time'] += stall
+
+    def call(self, memc, func):
+        """
+        Call func(memc) in the sender thread of the instance, after the batches queued before are sent. So it uses
+        the connection of the sender, as python-memcached clients have a connection per thread
+        :return: Future of the result
+        """
+        future = concurrent.futures.Future()
+        self._queue(memc).put(SenderCall(func, future))
+        return future
+
+    def join(self, counter=None):
+        """
+        Wait until all the queued batches are inserted
+        :param counter: wait only for the batches of this LoadCounter, as the threads of --executor threads
+        share the pipeline, and a file should not wait for the files of the other threads
+        """
+        if counter is not None:
+            counter.wait_inserted()
+            return
+        for q in list(self._queues.values()):
+            q.join()
+
+    def close(self):
+        for q in list(self._queues.values()):
+            q.put(None)
+        self.join()
+        self._queues.clear()
+
+    def stats_line(self):
+        stats = dict(self.stats)
+        occupancy_avg = stats.pop('occupancy_sum') / stats['batches'] if stats['batches'] else 0
+        return (f"batches: {stats['batches']}, queue occupancy avg/max: {occupancy_avg:.2f}/{stats['occupancy_max']}"
+                f" of {self.depth}, parser stall: {stats['stall_time']:.3f}s, senders idle: {stats['idle_time']:.3f}s")
+
+
+_pipeline = None
+
+
+def get_pipeline():
+    """Pipeline of the current process. A pipeline inherited from the parent by fork has no threads, so is not reused"""
+    global _pipeline
+    if _pipeline is None or _pipeline.pid != os.getpid():
+        _pipeline = InsertPipeline(opts.queue_depth, get_tuner())
+    return _pipeline
+
+
+def memc_client(addr, backend='memcache', timeout=memc_meta.SOCKET_TIMEOUT):
+    """
+    Client of a memcached instance
+    :param backend: `memcache` for python-memcached, `meta` for the client which sends each batch with one write
+    of quiet meta-commands
+    :param timeout: seconds to wait for the socket of the instance
+    """
+    if backend == 'meta':
+        return memc_meta.MetaClient(addr, timeout)
+    import memcache
+    return memcache.Client((addr,), debug=0, socket_timeout=timeout)
+
+
+conns = {}  # address -> client of a memcached instance, of the process in _conns_pid
+_conns_pid = None
+
+
+def get_conn(addr):
+    """
+    Client of the memcached instance for the current process, created on first use and kept for all its files.
+    Clients inherited from the parent process are dropped, not used, as their sockets are shared with it
+    """
+    global _conns_pid
+    if _conns_pid != os.getpid():
+        conns.clear()
+        _conns_pid = os.getpid()
+    memc = conns.get(addr)
+    if memc is None:
+        memc = conns[addr] = memc_client(addr, opts.backend, opts.timeout)
+    return memc
+
+
+def close_conns():
+    if _conns_pid == os.getpid():
+        for memc in conns.values():
+            memc.disconnect_all()
+    conns.clear()
+
+
+def init_worker(options, addresses, metrics_queue=None, stats_interval=metrics.PUSH_INTERVAL, coalescer=None):
+    """
+    Initializer of the worker processes: take the options of the main process, as they are not parsed at import,
+    set up logging if the worker is not forked, and create the clients of all the memcached instances, which are
+    reused for all the files of the worker. python-memcached connects lazily, on the first command of each thread
+    :param options: opts of the main process
+    :param addresses: device_memc of the main process
+    :param metrics_queue: queue of metrics.Collector of the main process, or None
+    :param coalescer: coalesce.Coalescer of the main process, or None. A worker which is not forked attaches
+    to its shared memory and locks when it is unpickled
+    """
+    global _coalescer
+    vars(opts).update(vars(options))
+    device_memc.update(addresses)
+    if not logging.getLogger().handlers:
+        setup_logging()
+    if metrics_queue is not None:
+        metrics.init_worker(metrics_queue, stats_interval)
+    if opts.watch and opts.executor == 'processes':  # the main process stops the load on SIGINT
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if coalescer is not None:
+        _coalescer = coalescer
+    if not opts.shm:  # otherwise the workers only parse
+        open_conns()
+
+
+def open_conns():
+    for servers in device_memc.values():
+        for addr in servers.split(','):
+            get_conn(addr)
+            get_breaker(addr)
+
+
+def init_threads():
+    """
+    Create the state of the process before the worker threads share it: the sender pipeline, clients and breakers
+    of all the memcached instances, and the rest, which are created on first use otherwise
+    """
+    get_pipeline()
+    get_tuner()
+    get_delta()
+    get_budget()
+    get_encoder()
+    if not opts.shm:
+        open_conns()
+
+
+def free_threaded():
+    """Whether the GIL is disabled, which takes a free-threaded build of CPython 3.13+"""
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def resolve_executor():
+    """
+    Kind of the pool of workers of --executor: `processes`, `threads` which parse in the main process and share
+    its sender pipeline and clients, or `interpreters`, each with its own clients. `auto` is threads when the GIL
+    is disabled, and processes otherwise. Threads and interpreters fall back to processes where they do not work
+    """
+    kind = opts.executor
+    if kind == 'auto':
+        return 'threads' if free_threaded() and opts.engine == 'threads' else 'processes'
+    reason = None
+    if kind == 'threads' and opts.engine == 'asyncio':
+        reason = "the asyncio engine has an event loop per process"
+    elif kind == 'interpreters' and getattr(concurrent.futures, 'InterpreterPoolExecutor', None) is None:
+        reason = "concurrent.futures.InterpreterPoolExecutor of CPython 3.14+ is not available"
+    elif kind == 'interpreters':
+        unsupported = [name for name in INTERPRETERS_UNSUPPORTED if getattr(opts, name)]
+        if opts.parser == 'protobuf' and not opts.binary and opts.encoding != 'compact':
+            unsupported.append('parser protobuf')  # C extension modules may not load in a subinterpreter
+        if unsupported:
+            reason = f"{', '.join('--' + name.replace('_', '-') for name in unsupported)} are not supported"
+    if reason is not None:
+        logging.warning(f"--executor {kind} falls back to processes: {reason}")
+        return 'processes'
+    if kind == 'threads' and not free_threaded():
+        logging.warning("--executor threads with the GIL enabled: the workers do not parse in parallel")
+    return kind
+
+
+def worker_pool(collector=None):
+    """
+    Executor of the workers of opts.executor (see resolve_executor), which are initialized with init_worker,
+    or share the main process with threads
+    :param collector: metrics.Collector the worker processes push their metrics to
+    """
+    if opts.executor == 'threads':
+        init_threads()
+        return ThreadPoolExecutor(max_workers=opts.workers, thread_name_prefix='worker')
+    initargs = (opts, device_memc)
+    if opts.executor == 'interpreters':
+        return concurrent.futures.InterpreterPoolExecutor(max_workers=opts.workers, initializer=init_worker,
+                                                          initargs=initargs)
+    if collector is not None:
+        initargs += (collector.queue, opts.stats_interval or metrics.PUSH_INTERVAL)
+    else:
+        initargs += (None, metrics.PUSH_INTERVAL)
+    initargs += (_coalescer,)  # inherited by forked workers, but not by spawned ones
+    return ProcessPoolExecutor(max_workers=opts.workers, initializer=init_worker, initargs=initargs)
+
+
+async def insert_appsinstalled_multi_async(memc: 'memc_async.AsyncMetaClient', data):
+    """The same as insert_appsinstalled_multi, for the asyncio engine"""
+    import asyncio
+    addr = server_name(memc)
+    breaker = get_breaker(addr)
+    pending = data
+    for attempt in range(N_RETRY_ON_ERROR + 1):
+        if attempt:
+            metrics.current.inc('retries')
+            await asyncio.sleep(retry.backoff(attempt))
+        if not breaker.allow():
+            break
+        try:
+            failed = await memc.set_multi(pending)
+        except Exception as exc:
+            logging.exception(f"Cannot write to memc {addr}: {exc}")
+            failed = list(pending)
+        pending = send_result(breaker, pending, failed)
+        if not pending:
+            break
+    return fail_records(data, pending), len(data)
+
+
+class AsyncEngine:
+    """
+    Event loop of a worker process with asynchronous connections to memcached instances, used instead of
+    the sender threads. Up to `inflight` batches per instance are being stored at once, while the next batch
+    is read and parsed in the default executor of the loop. The loop and its connections are reused for all
+    files of the worker
+    """
+
+    def __init__(self, inflight=INFLIGHT, tuner=None):
+        self.inflight = inflight
+        self.tuner = tuner
+        import asyncio
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.clients = {}
+
+    def client(self, addr):
+        if addr not in self.clients:
+            import memc_async
+            self.clients[addr] = memc_async.AsyncMetaClient(addr, self.inflight, opts.timeout)
+        return self.clients[addr]
+
+    def load(self, batches, device_memc, counter, tracker=None, base_version=0, sampler=None):
+        """
+        Store all the batches
+        :param batches: iterator of lists of lines
+        :param counter: LoadCounter of the file
+        :param tracker: checkpoint.Tracker of the file, or None
+        :param base_version: coalesce.version() of the file or chunk, batches are numbered from it
+        :param sampler: verify.Sampler to add the records sent to, or None
+        """
+        self.loop.run_until_complete(self._load(batches, device_memc, counter, tracker, base_version, sampler))
+
+    async def _insert(self, memc, data, counter, done=None):
+        try:
+            start = time.monotonic()
+            errors, total = await insert_appsinstalled_multi_async(memc, data)
+            latency = time.monotonic() - start
+            metrics.current.observe('set_multi', latency)
+            if self.tuner is not None:
+                self.tuner.record_send(memc.servers[0], total, latency, errors)
+            counter.add(errors, total, latency)
+        finally:
+            memc.slots.release()
+            if done is not None:
+                done()
+
+    async def _load(self, batches, device_memc, counter, tracker=None, base_version=0, sampler=None):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        batch_version = base_version
+        try:
+            while True:
+                parsed = await loop.run_in_executor(None, split_next_batch, batches, self.tuner, counter.rejects)
+                if parsed is None:
+                    break
+                if self.tuner is not None and self.tuner.inflight != self.inflight:
+                    for memc in self.clients.values():
+                        memc.resize(self.tuner.inflight - self.inflight)
+                    self.inflight = self.tuner.inflight
+                batch_by_dev, batch_errors, duplicates = parsed
+                batch = counter if tracker is None else tracker.batch(counter)
+                batch.coalesce(duplicates)
+                skipped = drop_unchanged(batch_by_dev)
+                batch_version += 1
+                # waits for the senders of this loop, so off the loop
+                batch_by_dev = await loop.run_in_executor(None, coalesce_batch, batch_by_dev, batch_version, batch)
+                batch_by_addr, unknown = route_batch(batch_by_dev, device_memc)
+                batch.add(batch_errors + unknown, batch_errors + unknown)
+                batch.skip(skipped)
+                if sampler is not None:
+                    sampler.add(batch_by_addr)
+                if tracker is not None:
+                    batch.expect(len(batch_by_addr))
+                for addr, data in batch_by_addr.items():
+                    memc = self.client(addr)
+                    start = time.monotonic()
+                    await memc.slots.acquire()  # wait for a connection not to parse too far ahead of the network
+                    metrics.current.observe('queue_wait', time.monotonic() - start)
+                    done = None if tracker is None else batch.part_done
+                    if get_budget() is not None:  # waits for the senders of this loop, so off the loop
+                        done = await loop.run_in_executor(None, hold_memory, data, done)
+                    task = loop.create_task(self._insert(memc, data, batch, done))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks)
+
+    def close(self):
+        for memc in self.clients.values():
+            self.loop.run_until_complete(memc.disconnect_all())
+        self.loop.close()
+
+
+_async_engine = None
+
+
+def get_async_engine():
+    """Asyncio engine of the current process, see get_pipeline"""
+    global _async_engine
+    if _async_engine is None or _async_engine.pid != os.getpid():
+        _async_engine = AsyncEngine(opts.inflight, get_tuner())
+    return _async_engine
+
+
+_tuner = None
+
+
+def get_tuner():
+    """AutoTuner of the current process, None unless --autotune is given: constants are used then"""
+    global _tuner
+    if not opts.autotune:
+        return
+    if _tuner is None or _tuner.pid != os.getpid():
+        inflight = opts.inflight if opts.engine == 'asyncio' else opts.queue_depth
+        _tuner = autotune.AutoTuner(BATCH_SIZE, inflight, opts.min_batch_size, opts.max_batch_size,
+                                    opts.max_inflight, opts.target_latency)
+    return _tuner
+
+
+_delta = None
+
+
+def get_delta():
+    """Delta index of the previous loads and update log of the current process, None unless --delta-index is given"""
+    global _delta
+    if not opts.delta_index:
+        return
+    if _delta is None or _delta.pid != os.getpid():
+        _delta = Delta(os.getpid(), delta.DeltaIndex(opts.delta_index), delta.UpdateLog(opts.delta_index))
+    return _delta
+
+
+def drop_unchanged(batch_by_dev):
+    """
+    Remove records whose packed value is the same as stored by the previous loads
+    :param batch_by_dev: dict of dev_type -> {key: packed}
+    :return: number of records removed
+    """
+    current = get_delta()
+    if current is None:
+        return 0
+    skipped = sum(current.index.drop_unchanged(data) for data in batch_by_dev.values())
+    metrics.current.inc('skipped', skipped)
+    return skipped
+
+
+def record_stored(data, failed=()):
+    """
+    Log the records of the batch which were stored, for the delta index of the next load, and confirm them
+    to the coalescer
+    """
+    current = get_delta()
+    if current is not None:
+        current.log.record(data, failed)
+    if _coalescer is not None:
+        _coalescer.confirm(data, failed)
+
+
+_coalescer = None  # created by main before the worker pools, with --coalesce, and passed to the workers by init_worker
+
+
+def coalesce_batch(batch_by_dev, batch_version, counter):
+    """
+    Drop records of the batch which are superseded by later batches, or have the same value as the latest batch
+    with the key. Keys of earlier batches which are being stored are waited for, so the values are stored
+    in the order of files and lines, whatever the order in which the workers get to them
+    :param batch_version: coalesce.version() of the batch
+    :return: dict of dev_type -> {key: packed} to send
+    """
+    if _coalescer is None:
+        return batch_by_dev
+    send, deferred, superseded, duplicates = {}, batch_by_dev, 0, 0
+    deadline = time.monotonic() + DEFER_TIMEOUT
+    force = False
+    while deferred:
+        decisions = _coalescer.claim(deferred, batch_version, force)
+        for dev_type, data in decisions[coalesce.SEND].items():
+            send.setdefault(dev_type, {}).update(data)
+        deferred = decisions[coalesce.DEFER]
+        superseded += sum(map(len, decisions[coalesce.SUPERSEDED].values()))
+        duplicates += sum(map(len, decisions[coalesce.DUPLICATE].values()))
+        if deferred:
+            force = time.monotonic() > deadline
+            if force:
+                logging.warning(f"Keys of earlier batches are not stored in {DEFER_TIMEOUT}s, sending "
+                                f"{sum(map(len, deferred.values()))} records anyway")
+            else:
+                time.sleep(0.002)
+    duplicates += superseded
+    metrics.current.inc('superseded', superseded)
+    metrics.current.inc('duplicates', duplicates)
+    counter.coalesce(duplicates)
+    return send
+
+
+_budget = None
+
+
+def get_budget():
+    """
+    MemoryBudget of the current process, None unless --max-memory is given. The budget is shared equally
+    by the main process and the worker processes, worker threads share the budget of the main process
+    """
+    global _budget
+    if not opts.max_memory:
+        return
+    if _budget is None or _budget.pid != os.getpid():
+        processes = 1 if opts.executor == 'threads' else opts.workers + 1
+        _budget = budget.MemoryBudget(budget.parse_size(opts.max_memory) // processes)
+    return _budget
+
+
+def hold_memory(data, done=None):
+    """
+    Wait until the budget of the process has room for the records to send, see MemoryBudget.hold
+    :return: function to call after the records are sent
+    """
+    current = get_budget()
+    if current is None:
+        return done
+    start = time.monotonic()
+    done = current.hold(budget.records_size(data), done)
+    metrics.current.observe('memory_wait', time.monotonic() - start)
+    return done
+
+
+def batch_bytes():
+    """Bytes of lines of a batch with --max-memory, otherwise None: batches are sized by lines only"""
+    current = get_budget()
+    return None if current is None else current.batch_bytes
+
+
+def chunk_size():
+    """
+    --chunk-size, reduced with --max-memory so that the chunks pending for the workers fit into the budget
+    of the main process
+    """
+    current = get_budget()
+    if current is None:
+        return opts.chunk_size
+    return max(2 ** 16, min(opts.chunk_size, current.limit // (2 * opts.workers)))
+
+
+_breakers = None
+
+
+def get_breaker(addr):
+    """CircuitBreaker of the server in the current process"""
+    global _breakers
+    if _breakers is None or _breakers.pid != os.getpid():
+        _breakers = retry.Breakers(opts.breaker_threshold, opts.breaker_timeout)
+    return _breakers[addr]
+
+
+_dead_letters = None
+
+
+def spill(data):
+    """Put the records which could not be stored into the dead-letter file of the process, with --dead-letter"""
+    global _dead_letters
+    if not opts.dead_letter or not data:
+        return
+    if _dead_letters is None or _dead_letters.pid != os.getpid():
+        _dead_letters = retry.DeadLetters(opts.dead_letter)
+    _dead_letters.write(data)
+    metrics.current.inc('dead_letters', len(data))
+
+
+_encoder = None
+
+
+def get_encoder():
+    """compact.Encoder with --encoding compact, None for UserApps wire format"""
+    global _encoder
+    if opts.encoding != 'compact':
+        return
+    if _encoder is None:
+        dictionary = compact.load_dictionary(opts.zstd_dict) if opts.zstd_dict else None
+        _encoder = compact.Encoder(opts.coord_digits, dictionary)
+    return _encoder
+
+
+def flush_delta():
+    current = get_delta()
+    if current is not None:
+        current.log.flush()
 
 
 def parse_appsinstalled(line):
@@ -78,57 +816,480 @@ def parse_appsinstalled(line):
         lat, lon = float(lat), float(lon)
     except ValueError:
         logging.info(f"Invalid geo coords: `{line}`")
+        return
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
 def main():
-    files = sorted(list(glob.iglob(opts.pattern)))  # to prefix processed files chronologically
-    with ProcessPoolExecutor(max_workers=N_PROCESSES) as pexecutor:
-        iterator = {pexecutor.submit(process_file, fn, device_memc): fn for fn in files}
-        files.reverse()  # to pop from the end
-        while files:
-            dones = wait(iterator, return_when=FIRST_COMPLETED).done
-            for done in dones:
-                if files[-1] == iterator[done]:
-                    dot_rename(files[-1])
-                    iterator.pop(done)
-                    logging.info(f"File {files.pop()} has been renamed")
+    """
+    Load all the files matching the pattern
+    :return: summary of the load (see LoadCounter.summary) with the number of files
+    """
+    global _coalescer
+    opts.executor = resolve_executor()
+    logging.info(f"Workers: {opts.workers} {opts.executor}")
+    if opts.noreply and (opts.backend != 'memcache' or opts.engine != 'threads'):
+        logging.warning("--noreply applies to the memcache backend of the threads engine only, replies are waited for")
+    elif opts.noreply and opts.delta_index:  # records the server did not store would be skipped by the next loads
+        raise ValueError("--delta-index requires replies, it cannot be used with --noreply")
+    if opts.max_memory:
+        budget.parse_size(opts.max_memory)  # fail before the workers do
+    collector = start_metrics()
+    if opts.delta_index:
+        delta.merge(opts.delta_index)  # of an interrupted load
+    if opts.coalesce:
+        _coalescer = coalesce.Coalescer(device_memc, opts.coalesce_size)
+    try:
+        if opts.replay:
+            summary = replay_dead_letters(device_memc)
+        elif opts.export:
+            summary = export_files(glob.glob(opts.pattern))
+        else:
+            watch = scheduler.Watch(opts.pattern) if opts.watch else None
+            summary = load_files(glob.glob(opts.pattern), collector, watch)
+    finally:
+        if collector is not None:
+            collector.close()
+        if _coalescer is not None:
+            _coalescer.close()
+            _coalescer = None
+        if opts.delta_index:
+            flush_delta()  # records stored by the main process with --shm
+            logging.info(f"Delta index {opts.delta_index}: {delta.merge(opts.delta_index)} records merged")
+    if collector is not None:
+        summary['metrics'] = collector.total()
+        logging.info(f"Stats: {json.dumps(summary['metrics'])}")
+    return summary
+
+
+def start_metrics():
+    """
+    Collector of metrics of this process and the workers if --metrics-port or --stats-interval is given,
+    otherwise None and metrics calls do nothing
+    """
+    if not opts.metrics_port and not opts.stats_interval:
+        return
+    metrics.enable()
+    collector = metrics.Collector(multiprocessing.Queue())
+    if opts.metrics_port:
+        port = collector.serve(opts.metrics_port)
+        logging.info(f"Metrics are served at http://localhost:{port}/metrics")
+    if opts.stats_interval:
+        collector.log_every(opts.stats_interval)
+    return collector
+
+
+def load_files(files, collector=None, watch=None):
+    """
+    Load the files with the workers, see scheduler.FileScheduler and worker_pool. Each file is loaded by a worker,
+    largest first, or with --split-files by all of them, one by one in chronological order
+    :param files: paths
+    :param collector: metrics.Collector the workers push their metrics to
+    :param watch: function returning new files to load, e.g. scheduler.Watch, to run until SIGTERM or SIGINT
+    """
+    total = LoadCounter()
+
+    def finish(fn, summary):
+        total.merge(summary)
+        dot_rename(fn)
+        if opts.checkpoint:
+            checkpoint.remove_state(fn)
+        logging.info(f"File {fn} has been renamed")
+
+    with worker_pool(collector) as pexecutor:
+        if opts.split_files:
+            process = process_file_shm if opts.shm else process_file_chunks
+            files_scheduler = scheduler.FileScheduler(
+                lambda fn, file_n: scheduler.submit_now(process, fn, device_memc, pexecutor, file_n), finish, 1,
+                largest_first=False)
+        else:
+            files_scheduler = scheduler.FileScheduler(
+                lambda fn, file_n: pexecutor.submit(process_file, fn, device_memc, file_n), finish,
+                opts.files_inflight or opts.workers + 1)
+        files_scheduler.add(files)
+        handlers = {}
+        if watch is not None:
+            logging.info(f"Watching {opts.pattern} for new files every {opts.watch}s, stop with SIGTERM or SIGINT")
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                handlers[signum] = signal.signal(signum, lambda *_: files_scheduler.stop.set())
+        try:
+            files_scheduler.run(watch, opts.watch)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        if watch is not None:
+            logging.info(f"Stopped watching {opts.pattern}")
+    return dict(total.summary(), files=files_scheduler.count)
+
+
+def export_files(files):
+    """
+    Write the records of the files into dump files of memcached set commands in --export, with the worker processes,
+    instead of storing them. The files are not renamed. See export.py
+    :return: summary of the export, as of load_files
+    """
+    total = LoadCounter()
+    dumps = {}
+
+    def finish(fn, summary):
+        total.merge(summary)
+        dumps.update(summary['dumps'])
+
+    with worker_pool() as pexecutor:
+        files_scheduler = scheduler.FileScheduler(
+            lambda fn, file_n: pexecutor.submit(export_file, fn, device_memc), finish,
+            opts.files_inflight or opts.workers + 1)
+        files_scheduler.add(files)
+        files_scheduler.run()
+    manifest = export.update_manifest(opts.export, dumps)
+    logging.info(f"Exported {len(dumps)} dumps to {opts.export}, {len(manifest)} in its manifest")
+    return dict(total.summary(), files=files_scheduler.count)
+
+
+def export_file(fn, device_memc):
+    """
+    Write the records of the file into its dump files, one per memcached instance
+    :return: LoadCounter.summary() of the file, with `dumps` of export.DumpFiles.close
+    """
+    counter = LoadCounter()
+    logging.info(f'Exporting file {fn}')
+    # the whole name but the suffix, files may share the part before the first dot
+    dumps = export.DumpFiles(opts.export, os.path.basename(fn).removesuffix('.gz').removesuffix('.tsv'))
+    with gzip.open(fn, 'rb' if opts.binary else 'rt') as f:
+        batches = log_progress(read_batches(f, max_bytes=batch_bytes()), fn, f, os.path.getsize(fn))
+        while True:
+            parsed = split_next_batch(batches, rejects=counter.rejects)
+            if parsed is None:
+                break
+            batch_by_dev, batch_errors, duplicates = parsed
+            counter.coalesce(duplicates)
+            batch_by_addr, unknown = route_batch(batch_by_dev, device_memc)
+            counter.add(batch_errors + unknown, batch_errors + unknown)
+            for addr, data in batch_by_addr.items():
+                counter.add(len(dumps.write(addr, data)), len(data))
+    report_load(fn, counter.processed, counter.errors, duplicates=counter.duplicates, rejects=counter.rejects)
+    metrics.push()
+    return dict(counter.summary(), dumps=dumps.close())
+
+
+def replay_dead_letters(device_memc):
+    """
+    Load the records of the dead-letter files of --dead-letter, one by one, with the sender pipeline of the main
+    process. A file is removed when it is loaded, records which fail again go to a new dead-letter file
+    :return: summary of the load, as of load_files
+    """
+    if not opts.dead_letter:
+        raise ValueError("--replay requires --dead-letter")
+    total = LoadCounter()
+    files = retry.dead_letter_files(opts.dead_letter)
+    pipeline = get_pipeline()
+    for fn in files:
+        counter = LoadCounter()
+        records = retry.read_dead_letters(fn)
+        while True:
+            batch_by_dev = defaultdict(dict)
+            for key, packed in islice(records, BATCH_SIZE):
+                batch_by_dev[key.partition(':' if isinstance(key, str) else b':')[0]][key] = packed
+            if not batch_by_dev:
+                break
+            batch_by_addr, unknown = route_batch(batch_by_dev, device_memc)
+            counter.add(unknown, unknown)
+            for addr, data in batch_by_addr.items():
+                pipeline.submit(get_conn(addr), data, counter, opts.dry)
+        pipeline.join()
+        report_load(fn, counter.processed, counter.errors)
+        if not opts.dry:
+            os.remove(fn)
+        total.merge(counter.summary())
+    return dict(total.summary(), files=len(files))
 
 
-def process_file(fn, device_memc):
+def process_file(fn, device_memc, file_n=0):
     """
     :param fn:
     :param device_memc: despite it is global, we pass it to this function in order
     to be able to modify device_memc in tests, and be sure modified version is available in a forked process
-    :return:
+    :param file_n: number of the file in chronological order, to coalesce keys
+    :return: LoadCounter.summary() of the file
     """
 
-    processed = errors = 0
+    counter = LoadCounter()
     logging.info(f'Processing file {fn}')
-    with gzip.open(fn, 'rt') as f:
-        nlines = sum(1 for _ in f)
-        f.seek(0)
-        logging.info(f"File {fn}. Total lines to process: {nlines}")
-        batch_n = 1
+    size = os.path.getsize(fn)
+    tracker = None
+    if opts.checkpoint and not opts.dry:
+        state = checkpoint.load_state(fn)
+        if state:
+            logging.info(f"File {fn}: resuming after line {state['line']}")
+            counter.merge({'processed': state['processed'], 'errors': state['errors'], 'latencies': []})
+        f = checkpoint.GzipLines(fn, state, text=not opts.binary)
+        tracker = checkpoint.Tracker(fn, f, state)
+    else:
+        f = gzip.open(fn, 'rb' if opts.binary else 'rt')
+    sampler = verify.Sampler(opts.verify_sample) if opts.verify_sample and not opts.dry else None
+    try:
+        with f:
+            load(log_progress(read_batches(f, tuner=get_tuner(), max_bytes=batch_bytes()), fn, f, size), device_memc,
+                 counter, fn, tracker, coalesce.version(file_n), sampler)
+    finally:
+        if tracker is not None:
+            tracker.close()
+    verification = None if sampler is None else verify_sample(sampler)
+    report_load(fn, counter.processed, counter.errors, counter.skipped, counter.duplicates, verification,
+                counter.rejects)
+    flush_delta()
+    metrics.push()
+    return counter.summary()
+
+
+def process_file_chunks(fn, device_memc, executor, file_n=0):
+    """
+    Load a single file with all the worker processes. The file is decompressed here, and its line-aligned
+    chunks are parsed and stored by the workers, so inflating of the next chunk overlaps the processing
+    of the previous ones. No more than 2 chunks per worker are pending at a time, to bound memory
+    :param executor: ProcessPoolExecutor of the workers
+    """
+    counter = LoadCounter()
+    logging.info(f'Processing file {fn} in chunks')
+    size = os.path.getsize(fn)
+    pending = set()
+    with gzip.open(fn, 'rb') as f:
+        for chunk_n, chunk in enumerate(read_chunks(f, chunk_size()), 1):
+            if len(pending) >= 2 * opts.workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    counter.merge(future.result())
+            logging.info(f"File {fn}: chunk {chunk_n}, {read_progress(f, size):.1%} read")
+            pending.add(executor.submit(process_chunk, chunk, device_memc, fn, coalesce.version(file_n, chunk_n)))
+    for future in pending:
+        counter.merge(future.result())
+    report_load(fn, counter.processed, counter.errors, counter.skipped, counter.duplicates, rejects=counter.rejects)
+    return counter.summary()
+
+
+def process_file_shm(fn, device_memc, executor, file_n=0):
+    """
+    The same as process_file_chunks, but the workers only parse: they pack records of a chunk into an arena of
+    shared memory, and the main process stores them with its sender pipeline, passing slices of the arena to
+    the sockets. So parsed batches are not pickled, and arenas are reused for the next chunks
+    """
+    counter = LoadCounter()
+    logging.info(f'Processing file {fn} in chunks through shared memory')
+    size = os.path.getsize(fn)
+    pipeline = get_pipeline()
+    ring = shmbatch.ArenaRing(opts.shm_arenas or 2 * opts.workers + 2, 2 * chunk_size())
+    pending = {}
+
+    def send(future):
+        name = pending.pop(future)
+        ranges, overflow, errors, skipped, duplicates, rejects = future.result()
+        counter.add(errors, errors)
+        counter.rejects.merge(rejects)
+        counter.skip(skipped)
+        counter.coalesce(duplicates)
+        reader = ring.reader(name)
+        parts = [len(ranges)]
+        lock = threading.Lock()  # parts are sent by the sender threads of several instances
+
+        def sent():
+            with lock:
+                parts[0] -= 1
+                last = not parts[0]
+            if last:
+                reader.release()
+                ring.release(name)
+
+        for addr, start, stop in ranges:
+            data = reader.batch(start, stop, copy=opts.backend != 'meta')
+            pipeline.submit(get_conn(addr), data, counter, opts.dry, sent)
+        if not ranges:
+            reader.release()
+            ring.release(name)
+        for addr, data in overflow.items():
+            pipeline.submit(get_conn(addr), data, counter, opts.dry)
+
+    def acquire():
+        while True:
+            name = ring.acquire(timeout=None if not pending else 0.01)
+            if name is not None:
+                return name
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                send(future)
+
+    try:
+        with gzip.open(fn, 'rb') as f:
+            for chunk_n, chunk in enumerate(read_chunks(f, chunk_size()), 1):
+                name = acquire()
+                logging.info(f"File {fn}: chunk {chunk_n}, {read_progress(f, size):.1%} read")
+                future = executor.submit(parse_chunk_shm, chunk, name, device_memc, coalesce.version(file_n, chunk_n))
+                pending[future] = name
+        while pending:
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                send(future)
+    finally:
+        pipeline.join()
+        ring.close()
+    logging.info(f"File {fn}. Main pipeline {pipeline.stats_line()}")
+    report_load(fn, counter.processed, counter.errors, counter.skipped, counter.duplicates, rejects=counter.rejects)
+    return counter.summary()
+
+
+def chunk_lines(chunk):
+    """
+    Lines of a chunk, read as the lines of the whole file are by gzip.open: in binary mode they end with a line feed
+    only, in text mode with universal newlines. splitlines() would split on vertical tabs, file separators,
+    Unicode line separators and other line boundaries too
+    :param chunk: bytes of complete lines, see read_chunks
+    """
+    f = io.BytesIO(chunk)
+    return f if opts.binary else io.TextIOWrapper(f)
+
+
+def parse_chunk_shm(chunk, arena, device_memc, base_version=0):
+    """
+    Parse the lines of a chunk into an arena of shared memory. Records of a batch are written grouped by memcached
+    instance, so each group is a contiguous range of the arena
+    :param chunk: bytes of complete lines
+    :param arena: name of the shared memory
+    :param base_version: coalesce.version() of the chunk
+    :return: list of (address, start, stop) ranges of records, dict of address -> {key: packed} of records which
+    did not fit into the arena, number of errors, number of records skipped as unchanged, number of duplicates,
+    Rejects.summary() of the lines rejected by the validating parser
+    """
+    writer = shmbatch.BatchWriter(arena)
+    counter = LoadCounter()  # of duplicates and rejects
+    ranges, overflow, errors, skipped = [], defaultdict(dict), 0, 0
+    batch_version = base_version
+    lines = chunk_lines(chunk)
+    try:
+        batches = read_batches(iter(lines))
         while True:
-            batch = list(islice(f, BATCH_SIZE))
-            if not batch:
+            parsed = split_next_batch(batches, rejects=counter.rejects)
+            if parsed is None:
                 break
-            logging.info(f"File {fn}: batch {batch_n} / {int(nlines / BATCH_SIZE) + 1}")
-            batch_by_dev, batch_errors = split_by_dev(batch)
-            with ThreadPoolExecutor(max_workers=N_THREADS) as executor:
-                future_to_line = [
-                    executor.submit(insert_appsinstalled_multi, conns[device_memc[dev_type]], data, opts.dry) for
-                    dev_type, data in batch_by_dev.items()]
-                logging.info(f"File {fn}. Created thread pool")
-                for future in as_completed(future_to_line):
-                    data = future.result()
-                    errors += data[0]
-                    processed += data[1] - data[0]
-                # add number of lines which were not parsed and as such were not included into batches_by_dev for insert
-                errors += batch_errors
-            batch_n += 1
+            batch_by_dev, batch_errors, duplicates = parsed
+            counter.coalesce(duplicates)
+            skipped += drop_unchanged(batch_by_dev)
+            batch_version += 1
+            batch_by_dev = coalesce_batch(batch_by_dev, batch_version, counter)
+            batch_by_addr, unknown = route_batch(batch_by_dev, device_memc)
+            errors += batch_errors + unknown
+            for addr, data in batch_by_addr.items():
+                start = writer.count
+                for key, packed in data.items():
+                    if not writer.add(key, packed):
+                        overflow[addr][key] = packed
+                if writer.count > start:
+                    ranges.append((addr, start, writer.count))
+    finally:
+        writer.close()
+        metrics.push()
+    return ranges, dict(overflow), errors, skipped, counter.duplicates, counter.rejects.summary()
+
+
+def process_chunk(chunk, device_memc, fn='', base_version=0):
+    """
+    Load the lines of a chunk of a file
+    :param chunk: bytes of complete lines
+    :param base_version: coalesce.version() of the chunk
+    :return: LoadCounter.summary() of the chunk
+    """
+    counter = LoadCounter()
+    lines = chunk_lines(chunk)
+    load(read_batches(iter(lines), tuner=get_tuner(), max_bytes=batch_bytes()), device_memc, counter, fn,
+         base_version=base_version)
+    flush_delta()
+    metrics.push()
+    return counter.summary()
+
+
+def load(batches, device_memc, counter, fn='', tracker=None, base_version=0, sampler=None):
+    """
+    Parse the batches and store them with the engine of the current process
+    :param batches: iterator of lists of lines
+    :param counter: LoadCounter to be updated
+    :param fn: name of the file, for logging
+    :param tracker: checkpoint.Tracker of the file, or None
+    :param base_version: coalesce.version() of the file or chunk, batches are numbered from it
+    :param sampler: verify.Sampler of the records sent, or None
+    """
+    if opts.engine == 'asyncio' and not opts.dry:
+        get_async_engine().load(batches, device_memc, counter, tracker, base_version, sampler)
+    else:
+        pipeline = get_pipeline()
+        load_batches(pipeline, batches, device_memc, counter, tracker, base_version, sampler)
+        logging.info(f"File {fn}. Worker pipeline {pipeline.stats_line()}")
+
+
+def verify_sample(sampler):
+    """
+    Read the sampled records back from memcached. With --noreply the reads are made by the sender thread of each
+    instance on its own connection, after the batches queued before, as the server may not have processed the writes
+    yet when the reads come on another connection. Otherwise the writes are done, as their replies are read
+    :param sampler: verify.Sampler of the records sent
+    :return: verify.Verification
+    """
+    sampled = matched = 0
+    noreply = opts.noreply and opts.backend == 'memcache' and opts.engine == 'threads'
+    for addr, sample in sampler.samples().items():
+        sampled += len(sample)
+        if noreply:
+            matched += get_pipeline().call(get_conn(addr), lambda memc: verify.check(memc, sample)).result()
+            continue
+        shared = opts.executor == 'threads'  # the clients are used by the senders of other files at the same time
+        if is_memcache(get_conn(addr)) and not shared:
+            matched += verify.check(get_conn(addr), sample)
+            continue
+        memc = memc_client(addr, timeout=opts.timeout)
+        try:
+            matched += verify.check(memc, sample)
+        finally:
+            memc.disconnect_all()
+    return verify.Verification(sampled, matched, sampler.sent)
+
+
+def estimate_errors(errors, verification):
+    """
+    Errors of a file with the records which the read-back verification estimates to be lost. These are added
+    to the errors counted with --noreply, as failed sets are not known then, otherwise the larger number is taken,
+    as records which failed are lost too
+    :return: estimated number of errors, and its range within the confidence interval of the success rate
+    """
+    def with_lost(lost):
+        return round(errors + lost if opts.noreply else max(errors, lost))
+    return (with_lost(verification.lost()), with_lost(verification.lost(verification.high)),
+            with_lost(verification.lost(verification.low)))
+
+
+def report_load(fn, processed, errors, skipped=0, duplicates=0, verification=None, rejects=None):
+    """
+    Log the counts of a file and decide if the load is successful
+    :param verification: verify.Verification of the records sent, or None, see estimate_errors
+    :param rejects: validate.Rejects of the file, its sample is written into the --rejects directory.
+    Rejected lines are among the errors
+    """
     logging.info(f"File {fn}. {processed} {errors}")
+    if rejects:
+        logging.info(f"File {fn}. Rejected lines: {rejects}")
+        if opts.rejects and rejects.sample:
+            path = validate.write_sample(opts.rejects, fn, rejects)
+            logging.info(f"File {fn}. {len(rejects.sample)} of {rejects.seen} rejected lines written to {path}")
+    if verification is not None:
+        logging.info(f"File {fn}. Read back: {verification}")
+        total = processed + errors
+        errors, errors_low, errors_high = estimate_errors(errors, verification)
+        processed = total - errors
+        if total and (errors_low / total < NORMAL_ERR_RATE) != (errors_high / total < NORMAL_ERR_RATE):
+            logging.warning(f"File {fn}. Error rate is {errors_low / total:.2%}..{errors_high / total:.2%} within "
+                            f"the confidence interval, a larger --verify-sample would tell if it is under "
+                            f"{NORMAL_ERR_RATE}")
+    if opts.delta_index and processed + errors:
+        logging.info(f"File {fn}. Skipped unchanged: {skipped}, {skipped / (processed + errors):.1%}")
+    if duplicates:
+        logging.info(f"File {fn}. Duplicate keys dropped: {duplicates}")
+    if not processed + errors:
+        logging.info(f"File {fn}. No records. Successfull load")
+        return
     err_rate = float(errors) / (errors + processed)
     if err_rate < NORMAL_ERR_RATE:
         logging.info(f"File {fn}. Processed: {processed}. Acceptable error rate {err_rate}. Successfull load")
@@ -137,9 +1298,186 @@ def process_file(fn, device_memc):
         High error rate ({err_rate} > {NORMAL_ERR_RATE}). Failed load")
 
 
+def load_batches(pipeline, batches, device_memc, counter, tracker=None, base_version=0, sampler=None):
+    """
+    Parse the batches and queue them into the sender pipeline
+    :param batches: iterator of lists of lines
+    :param counter: LoadCounter of the file
+    :param tracker: checkpoint.Tracker to commit the batches to when they are stored, or None
+    :param base_version: coalesce.version() of the file or chunk, batches are numbered from it
+    :param sampler: verify.Sampler to add the records sent to, or None
+    """
+    batch_version = base_version
+    try:
+        while True:
+            parsed = split_next_batch(batches, pipeline.tuner, counter.rejects)
+            if parsed is None:
+                break
+            batch_by_dev, batch_errors, duplicates = parsed
+            batch = counter if tracker is None else tracker.batch(counter)
+            batch.coalesce(duplicates)
+            skipped = drop_unchanged(batch_by_dev)
+            batch_version += 1
+            batch_by_dev = coalesce_batch(batch_by_dev, batch_version, batch)
+            batch_by_addr, unknown = route_batch(batch_by_dev, device_memc)
+            # lines which were not parsed and as such were not included into batches_by_dev for insert,
+            # and records of device types with no memcached
+            batch.add(batch_errors + unknown, batch_errors + unknown)
+            batch.skip(skipped)
+            if sampler is not None:
+                sampler.add(batch_by_addr)
+            if tracker is not None:
+                batch.expect(len(batch_by_addr))
+            for addr, data in batch_by_addr.items():
+                done = hold_memory(data, None if tracker is None else batch.part_done)
+                pipeline.submit(get_conn(addr), data, batch, opts.dry, done)
+    finally:
+        pipeline.join(counter)  # batches already queued are inserted even if the file fails
+
+
+@lru_cache(maxsize=None)
+def hash_ring(servers):
+    """
+    :param servers: comma-separated addresses of memcached instances of a device type
+    :return: HashRing of the instances, None for a single instance
+    """
+    servers = servers.split(',')
+    if len(servers) == 1:
+        return
+    return ketama.HashRing(servers)
+
+
+def route_batch(batch_by_dev, device_memc):
+    """
+    Group records of the batch by memcached instance. When a device type is served by several instances,
+    keys are distributed over them by the consistent hash ring
+    :param batch_by_dev: dict of dev_type -> {key: packed}
+    :return: dict of address -> {key: packed}, number of records of unknown device types
+    """
+    start = time.monotonic()
+    batch_by_addr = defaultdict(dict)
+    unknown = 0
+    for dev_type, data in batch_by_dev.items():
+        # an invalid device type of a binary file is decoded with replacement characters, and is unknown
+        servers = device_memc.get(dev_type.decode('utf-8', 'replace') if isinstance(dev_type, bytes) else dev_type)
+        if not servers:
+            logging.error(f"Unknown device type: {dev_type}")
+            unknown += len(data)
+            spill(data)
+            continue
+        ring = hash_ring(servers)
+        if ring is None:
+            batch_by_addr[servers].update(data)
+            continue
+        for key, packed in data.items():
+            batch_by_addr[ring.get_node(key)][key] = packed
+    metrics.current.observe('route', time.monotonic() - start)
+    return batch_by_addr, unknown
+
+
+def split_next_batch(batches, tuner=None, rejects=None):
+    """
+    split_by_dev of the next batch, None if there are no batches left
+    :param tuner: AutoTuner to report parser throughput to
+    :param rejects: validate.Rejects of the file, to count the lines rejected by the validating parser into
+    :return: dict of dev_type -> {key: packed}, number of errors, number of records of keys repeated in the batch,
+    where the last one is kept
+    """
+    start = time.monotonic()
+    batch = next(batches, None)
+    if batch is None:
+        return
+    read = time.monotonic()
+    encoder = get_encoder()
+    if opts.parser == 'validate':
+        parsed = validate.split_by_dev(batch, validate.Rejects(0) if rejects is None else rejects,
+                                       fastpack.pack_user_apps if encoder is None else encoder.pack)
+    elif encoder is not None:
+        parsed = fastpack.split_by_dev(batch, encoder.pack)
+    elif opts.parser == 'fast' or opts.binary:
+        parsed = fastpack.split_by_dev(batch)
+    else:
+        parsed = split_by_dev(batch)
+    end = time.monotonic()
+    if tuner is not None:
+        tuner.record_parse(len(batch), end - start)
+    m = metrics.current
+    m.observe('read', read - start)  # decompression and splitting into lines
+    m.observe('parse', end - read)  # packing included, see split_by_dev for the share of protobuf packing
+    batch_by_dev, batch_errors = parsed
+    duplicates = len(batch) - batch_errors - sum(map(len, batch_by_dev.values()))
+    m.inc('records', len(batch))
+    m.inc('parse_errors', batch_errors)
+    m.inc('duplicates', duplicates)
+    return batch_by_dev, batch_errors, duplicates
+
+
+def read_batches(f, batch_size=BATCH_SIZE, tuner=None, max_bytes=None):
+    """
+    Yield lists of at most batch_size lines from an opened file. The file is read only once, and no more than
+    one batch is held in memory at a time, whatever the size of the file
+    :param tuner: AutoTuner, its batch size is taken instead of batch_size
+    :param max_bytes: a batch ends when its lines take that many bytes of memory, if it is given
+    """
+    while True:
+        lines = islice(f, batch_size if tuner is None else tuner.batch_size)
+        if max_bytes is None:
+            batch = list(lines)
+        else:
+            batch, size = [], 0
+            for line in lines:
+                batch.append(line)
+                size += len(line) + budget.LINE_OVERHEAD
+                if size >= max_bytes:
+                    break
+        if not batch:
+            return
+        yield batch
+
+
+def read_chunks(f, chunk_size=CHUNK_SIZE):
+    """
+    Yield chunks of about chunk_size bytes of complete lines from a file opened in binary mode
+    """
+    tail = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            if tail:
+                yield tail
+            return
+        data = tail + data
+        end = data.rfind(b'\n') + 1
+        if not end:  # a line longer than the chunk
+            tail = data
+            continue
+        yield data[:end]
+        tail = data[end:]
+
+
+def read_progress(f, size):
+    """
+    Share of the compressed file consumed so far. We take the offset of the underlying raw file object,
+    so there is no need to decompress the file in advance just to count its lines
+    :param f: stream returned by gzip.open(fn, 'rt') or gzip.open(fn, 'rb')
+    :param size: size of the compressed file, in bytes
+    """
+    if not size:
+        return 1.0
+    return getattr(f, 'buffer', f).fileobj.tell() / size
+
+
+def log_progress(batches, fn, f, size):
+    for batch_n, batch in enumerate(batches, 1):
+        logging.info(f"File {fn}: batch {batch_n}, {read_progress(f, size):.1%} read")
+        yield batch
+
+
 def split_by_dev(batch):
     splitted_batch = defaultdict(dict)
     batch_errors = 0
+    timed = metrics.current.enabled
+    pack_time = 0.0
     for line in batch:
         line = line.strip()
         if not line:
@@ -149,12 +1487,20 @@ def split_by_dev(batch):
         if not appsinstalled:
             batch_errors += 1
             continue
-        key, packed = protobuf_serilalize(appsinstalled)
+        if timed:
+            start = time.monotonic()
+            key, packed = protobuf_serilalize(appsinstalled)
+            pack_time += time.monotonic() - start
+        else:
+            key, packed = protobuf_serilalize(appsinstalled)
         splitted_batch[appsinstalled.dev_type][key] = packed
+    if timed:
+        metrics.current.observe('pack', pack_time)
     return splitted_batch, batch_errors
 
 
 def prototest():
+    import appsinstalled_pb2
     sample = "idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567,3,7,23\ngaid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424"
     for line in sample.splitlines():
         dev_type, dev_id, lat, lon, raw_apps = line.strip().split("\t")
@@ -174,31 +1520,130 @@ op = OptionParser()
 op.add_option("-t", "--test", action="store_true", default=False)
 op.add_option("-l", "--log", action="store", default=False)
 op.add_option("--dry", action="store_true", default=False)
+op.add_option("--parser", action="store", type="choice", choices=["fast", "protobuf", "validate"], default="fast",
+              help="fast packs records directly into wire format, protobuf packs them with UserApps messages, "
+                   "validate is fast with rejected lines checked without exceptions and counted by category")
+op.add_option("--rejects", action="store", default=None,
+              help="with --parser validate, directory to write a sample of the rejected lines of each file into")
+op.add_option("--reject-sample", action="store", type="int", default=validate.SAMPLE_SIZE,
+              help="rejected lines of a file written into --rejects")
+op.add_option("--binary", action="store_true", default=False,
+              help="read lines as bytes with no decoding, keys are built as bytes too. Implies --parser fast "
+                   "unless it is validate")
+op.add_option("--encoding", action="store", type="choice", choices=["protobuf", "compact"], default="protobuf",
+              help="values as UserApps wire format, or in the compact format of compact.py. Compact implies "
+                   "--parser fast unless it is validate")
+op.add_option("--coord-digits", action="store", type="int", default=None,
+              help="with --encoding compact, decimal digits of coords to keep instead of doubles, 5 is about a meter")
+op.add_option("--zstd-dict", action="store", default=None,
+              help="with --encoding compact, compress values with zstd and this dictionary (python compact.py train)")
+op.add_option("--backend", action="store", type="choice", choices=["memcache", "meta"], default="memcache")
+op.add_option("--timeout", action="store", type="float", default=memc_meta.SOCKET_TIMEOUT,
+              help="seconds to wait for a memcached instance to connect, accept or answer a batch")
+op.add_option("--breaker-threshold", action="store", type="int", default=retry.BREAKER_THRESHOLD,
+              help="consecutive failed sends to an instance after which no sends are made to it for a while")
+op.add_option("--breaker-timeout", action="store", type="float", default=retry.BREAKER_TIMEOUT,
+              help="seconds after which a send is tried again to an instance whose circuit is open")
+op.add_option("--dead-letter", action="store", default=None,
+              help="prefix of files records which could not be stored are put into, <prefix>.<pid>.dead")
+op.add_option("--replay", action="store_true", default=False,
+              help="load the records of the dead-letter files of --dead-letter instead of the files of --pattern")
+op.add_option("--export", action="store", default=None,
+              help="write the records of the files of --pattern into dump files of set commands per memcached "
+                   "instance in this directory instead of storing them, to replay with python export.py replay")
+op.add_option("--noreply", action="store_true", default=False,
+              help="do not wait for replies of memcached, only sets which cannot be sent are counted as failed. "
+                   "The memcache backend of the threads engine only, see --verify-sample")
+op.add_option("--verify-sample", action="store", type="int", default=0,
+              help="records sampled per memcached instance of each file, read back after the file is loaded "
+                   "to estimate the share of records stored. Whole-file loads only")
+op.add_option("--max-memory", action="store", default=None,
+              help="memory of the loader, e.g. 512M, shared equally by the main process and the workers: batches "
+                   "are sized by bytes, and parsing waits while batches being sent would exceed the share")
+op.add_option("--files-inflight", action="store", type="int", default=None,
+              help="files submitted to the workers at a time, largest first, one more than the workers by default. "
+                   "Files are renamed in chronological order")
+op.add_option("--watch", action="store", type="float", default=0,
+              help="keep loading new files of --pattern, scanning for them every that many seconds, until SIGTERM "
+                   "or SIGINT. A file is loaded when its size stays the same for a scan")
+op.add_option("--workers", action="store", type="int", default=N_PROCESSES,
+              help="worker processes or threads which parse and store files or chunks")
+op.add_option("--executor", action="store", type="choice", choices=["auto", "processes", "threads", "interpreters"],
+              default="auto", help="workers as processes, threads of the main process sharing its clients and senders "
+                                   "(free-threaded CPython 3.13+), or subinterpreters (CPython 3.14+). Auto is threads "
+                                   "when the GIL is disabled, processes otherwise")
+op.add_option("--split-files", action="store_true", default=False,
+              help="load files one by one, each with all the worker processes")
+op.add_option("--chunk-size", action="store", type="int", default=CHUNK_SIZE)
+op.add_option("--shm", action="store_true", default=False,
+              help="with --split-files, workers only parse chunks into shared memory, the main process stores them")
+op.add_option("--shm-arenas", action="store", type="int", default=None, help="2 per worker and 2 more by default")
+op.add_option("--queue-depth", action="store", type="int", default=QUEUE_DEPTH)
+op.add_option("--engine", action="store", type="choice", choices=["threads", "asyncio"], default="threads",
+              help="asyncio engine always uses meta-commands, dry run always uses threads")
+op.add_option("--inflight", action="store", type="int", default=INFLIGHT)
+op.add_option("--autotune", action="store_true", default=False,
+              help="adjust batch size and batches in flight (queue depth for threads) to the observed latency")
+op.add_option("--min-batch-size", action="store", type="int", default=autotune.MIN_BATCH_SIZE)
+op.add_option("--max-batch-size", action="store", type="int", default=autotune.MAX_BATCH_SIZE)
+op.add_option("--max-inflight", action="store", type="int", default=autotune.MAX_INFLIGHT)
+op.add_option("--target-latency", action="store", type="float", default=autotune.TARGET_LATENCY)
+op.add_option("--checkpoint", action="store_true", default=False,
+              help="save the position of stored lines of each file, and resume an interrupted load from it. "
+                   "Ignored with --split-files and --dry")
+op.add_option("--delta-index", action="store", default=None,
+              help="file of hashes of the stored values: records unchanged since the previous load are not sent. "
+                   "Remove it when memcached is restarted or flushed")
+op.add_option("--coalesce", action="store_true", default=False,
+              help="drop duplicate keys across batches, files and workers, so the last value in file order is stored")
+op.add_option("--coalesce-size", action="store", type="int", default=coalesce.COALESCE_SIZE,
+              help="recent keys per device type kept for --coalesce, the ones of the earliest batches are evicted")
+op.add_option("--metrics-port", action="store", type="int", default=0,
+              help="serve metrics of all the processes at /metrics (Prometheus) and /stats (JSON) during the load")
+op.add_option("--stats-interval", action="store", type="float", default=0,
+              help="log metrics of all the processes as a JSON line every that many seconds")
 op.add_option("--pattern", action="store", default="/data/appsinstalled/*.tsv.gz")
+# each device type is served by an address, or by comma-separated addresses of memcached instances
 op.add_option("--idfa", action="store", default="127.0.0.1:33013")
 op.add_option("--gaid", action="store", default="127.0.0.1:33014")
 op.add_option("--adid", action="store", default="127.0.0.1:33015")
 op.add_option("--dvid", action="store", default="127.0.0.1:33016")
-opts, args = op.parse_args()
-logging.basicConfig(filename=opts.log, level=logging.DEBUG if not opts.dry else logging.DEBUG,
-                    format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+opts = op.get_default_values()  # of the command line after configure()
 device_memc = {
     "idfa": opts.idfa,
     "gaid": opts.gaid,
     "adid": opts.adid,
     "dvid": opts.dvid,
 }
-conns = {addr: memcache.Client((addr,), debug=0) for devtype, addr in device_memc.items()}
+
+
+def configure(argv=None):
+    """
+    Parse the command line into opts and device_memc, which are updated in place as other modules import them
+    :param argv: arguments, sys.argv[1:] by default
+    :return: positional arguments
+    """
+    vars(opts).update(vars(op.get_default_values()))
+    _, args = op.parse_args(argv, values=opts)
+    device_memc.update(idfa=opts.idfa, gaid=opts.gaid, adid=opts.adid, dvid=opts.dvid)
+    return args
+
+
+def setup_logging():
+    logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+
 
 if __name__ == '__main__':
+    configure()
+    setup_logging()
     if opts.test:
         prototest()
         sys.exit(0)
     logging.info("Memc loader started with options: %s" % opts)
     try:
         main()
-        for server in conns.values():
-            server.disconnect_all()
+        close_conns()
     except Exception as e:
         logging.exception("Unexpected error: %s" % e)
         sys.exit(1)
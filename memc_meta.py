@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Memcached client which stores a batch of records with one preassembled write of meta-commands
+import select
+import socket
+
+SOCKET_TIMEOUT: int = 3  # seconds, as in python-memcached
+MAX_KEY_LENGTH: int = 250
+IOV_MAX: int = 1024  # max number of buffers passed to a single sendmsg call
+RECV_SIZE: int = 65536
+
+
+def build_meta_set(items, quiet=True):
+    """
+    Meta-commands to store the records. Each record is `ms <key> <datalen> O<n> [q]` followed by the value:
+    the opaque token O<n> is the index of the record, so that a failure reply can be matched with its key.
+    With the quiet flag successful sets are not replied at all, and the trailing `mn` returns MN when all
+    the commands before it are processed.
+    :param items: list of (key, value) pairs, both are bytes
+    :return: list of buffers to be written as is, the values are not copied
+    """
+    flag = b' q\r\n' if quiet else b'\r\n'
+    buffers = []
+    for i, (key, value) in enumerate(items):
+        buffers.append(b'ms %s %d O%d%s' % (key, len(value), i, flag))
+        buffers.append(value)
+        buffers.append(b'\r\n')
+    buffers.append(b'mn\r\n')
+    return buffers
+
+
+def failed_keys(reply, keys):
+    """
+    Keys not stored according to the replies to a quiet batch of meta-commands
+    :param reply: everything read before MN
+    :param keys: keys of the batch, in the order they were sent
+    """
+    failed = []
+    for line in reply.split(b'\r\n'):
+        if not line or line.startswith(b'HD'):
+            continue
+        opaque = [token for token in line.split()[1:] if token.startswith(b'O')]
+        if not opaque:  # error which is not related to a particular key, e.g. SERVER_ERROR: nothing is guaranteed
+            return list(keys)
+        failed.append(keys[int(opaque[0][1:])])
+    return failed
+
+
+def valid_key(key):
+    return 0 < len(key) <= MAX_KEY_LENGTH and len(key.split()) == 1
+
+
+def prepare_items(mapping):
+    """
+    :param mapping: dict of key -> value, keys are str or bytes
+    :return: keys to be sent, (bytes key, value) pairs to be sent, invalid keys
+    """
+    keys, items, invalid = [], [], []
+    for key, value in mapping.items():
+        bkey = key.encode() if isinstance(key, str) else key
+        if not valid_key(bkey):
+            invalid.append(key)
+            continue
+        keys.append(key)
+        items.append((bkey, value))
+    return keys, items, invalid
+
+
+def is_complete(reply):
+    """If the reply to a batch contains the final MN"""
+    return reply.startswith(b'MN\r\n') or reply.endswith(b'\r\nMN\r\n')
+
+
+class MetaClient:
+    """
+    Client of a single memcached instance with the part of python-memcached interface used by the loader.
+    set_multi sends the whole batch with sendmsg and reads only failures back, instead of waiting for
+    a reply to each key as python-memcached does. A client is not thread-safe: the loader uses it from
+    the only sender thread of its instance
+    """
+
+    def __init__(self, addr, socket_timeout=SOCKET_TIMEOUT):
+        host, port = addr.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.socket_timeout = socket_timeout
+        self.servers = [f"inet:{addr}"]  # to log the same way as for python-memcached
+        self.sock = None
+
+    def _connect(self):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=self.socket_timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.sock
+
+    def disconnect_all(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _send(self, buffers, received):
+        """
+        Write all the buffers. Replies to failed commands are read in between, not to let the server
+        block on a full socket buffer while we are still writing
+        """
+        sock = self.sock
+        views = [memoryview(buffer) for buffer in buffers]
+        i = 0
+        while i < len(views):
+            sent = sock.sendmsg(views[i:i + IOV_MAX])
+            while sent:
+                if sent >= len(views[i]):
+                    sent -= len(views[i])
+                    i += 1
+                else:
+                    views[i] = views[i][sent:]
+                    sent = 0
+            if not select.select((sock,), (), (), 0)[0]:
+                continue
+            chunk = sock.recv(RECV_SIZE)
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            received.append(chunk)
+
+    def _read_until_mn(self, received):
+        reply = b''.join(received)
+        while not is_complete(reply):
+            chunk = self.sock.recv(RECV_SIZE)
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            reply += chunk
+        return reply[:-4]
+
+    def set_multi(self, mapping):
+        """
+        Store all the records of the mapping
+        :param mapping: dict of key -> value, keys are str or bytes, values are bytes-like objects
+        :return: list of keys which were not stored, as python-memcached does
+        """
+        keys, items, failed = prepare_items(mapping)
+        if not items:
+            return failed
+        try:
+            self._connect()
+            received = []
+            self._send(build_meta_set(items), received)
+            return failed + failed_keys(self._read_until_mn(received), keys)
+        except OSError:
+            self.disconnect_all()
+            return failed + keys
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Per-stage timers and counters of the loader, aggregated across worker processes
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+PUSH_INTERVAL: float = 5.0  # seconds between snapshots sent by a worker process
+
+
+class NullMetrics:
+    """Metrics when instrumentation is disabled: all the calls do nothing"""
+    enabled = False
+
+    def observe(self, stage, seconds, calls=1):
+        pass
+
+    def inc(self, event, n=1):
+        pass
+
+    def snapshot(self):
+        return {'stages': {}, 'events': {}}
+
+
+class Metrics:
+    """
+    Timers of stages (seconds spent and number of calls) and counters of events of a process. Hot paths
+    report once per batch, not per record, so the cost is a few calls per batch
+    """
+    enabled = True
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: [0.0, 0])
+        self.events = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, calls=1):
+        with self._lock:
+            timer = self.stages[stage]
+            timer[0] += seconds
+            timer[1] += calls
+
+    def inc(self, event, n=1):
+        with self._lock:
+            self.events[event] += n
+
+    def snapshot(self):
+        with self._lock:
+            return {'stages': {stage: list(timer) for stage, timer in self.stages.items()}, 'events': dict(self.events)}
+
+
+current = NullMetrics()
+_queue = None
+
+
+def enable():
+    """Start collecting metrics in the current process, from zero"""
+    global current
+    current = Metrics()
+    return current
+
+
+def init_worker(queue, interval=PUSH_INTERVAL):
+    """
+    Initializer of a worker process: collect metrics and send their snapshots to the queue of the main process
+    every interval seconds, and on push()
+    """
+    global _queue
+    enable()
+    _queue = queue
+
+    def push_periodically():
+        while True:
+            time.sleep(interval)
+            push()
+
+    threading.Thread(target=push_periodically, daemon=True).start()
+
+
+def push():
+    """Send the snapshot of the current process to the main one, if this is a worker with metrics"""
+    if _queue is not None:
+        _queue.put((os.getpid(), current.snapshot()))
+
+
+def merge(snapshots):
+    total = {'stages': defaultdict(lambda: [0.0, 0]), 'events': defaultdict(int)}
+    for snapshot in snapshots:
+        for stage, (seconds, calls) in snapshot['stages'].items():
+            total['stages'][stage][0] += seconds
+            total['stages'][stage][1] += calls
+        for event, n in snapshot['events'].items():
+            total['events'][event] += n
+    return {'stages': dict(total['stages']), 'events': dict(total['events'])}
+
+
+def prometheus(snapshot):
+    """Snapshot in Prometheus text exposition format"""
+    lines = ['# HELP memc_load_stage_seconds_total Time spent in a stage of the loader',
+             '# TYPE memc_load_stage_seconds_total counter']
+    lines += [f'memc_load_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}'
+              for stage, (seconds, _) in sorted(snapshot['stages'].items())]
+    lines += ['# HELP memc_load_stage_calls_total Number of times a stage was run',
+              '# TYPE memc_load_stage_calls_total counter']
+    lines += [f'memc_load_stage_calls_total{{stage="{stage}"}} {calls}'
+              for stage, (_, calls) in sorted(snapshot['stages'].items())]
+    lines += ['# HELP memc_load_events_total Number of events of the loader',
+              '# TYPE memc_load_events_total counter']
+    lines += [f'memc_load_events_total{{event="{event}"}} {n}' for event, n in sorted(snapshot['events'].items())]
+    return '\n'.join(lines) + '\n'
+
+
+class Collector:
+    """
+    Latest snapshots of the worker processes, read from the queue they push to, plus the metrics of the main
+    process. Exposes their sum over HTTP (/metrics in Prometheus format, /stats in JSON) and as periodic log lines
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.snapshots = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def _receive(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            pid, snapshot = item
+            with self._lock:
+                self.snapshots[pid] = snapshot
+
+    def total(self):
+        with self._lock:
+            snapshots = list(self.snapshots.values())
+        return merge(snapshots + [current.snapshot()])
+
+    def serve(self, port, host=''):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # only the main process serves
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = prometheus(collector.total()), 'text/plain; version=0.0.4'
+                elif self.path == '/stats':
+                    body, content_type = json.dumps(collector.total()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+    def log_every(self, interval):
+        def log():
+            while not self._stopped.wait(interval):
+                logging.info(f"Stats: {json.dumps(self.total())}")
+
+        threading.Thread(target=log, daemon=True).start()
+
+    def close(self):
+        """Stop serving and logging. Snapshots pushed by the workers which have exited are all received then"""
+        self._stopped.set()
+        self.queue.put(None)
+        self._receiver.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Read path of the loaded data: lookups routed by device type, micro-batched into get_multi, cached, decoded lazily
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from optparse import OptionParser
+
+import memcache
+
+import fastpack
+from check_memc_values import decode_value
+from memc_load import device_memc as DEVICE_MEMC, hash_ring
+
+WINDOW: float = 0.001  # seconds a lookup waits for others to be batched with it
+MAX_BATCH: int = 256  # keys of a get_multi
+CACHE_SIZE: int = 10000  # devices kept in the cache of the process
+CACHE_TTL: float = 30.0  # seconds a cached value is used, as the loader updates the values
+LOOKUP_TIMEOUT: float = 3.0  # seconds, as the socket timeout of python-memcached
+
+
+class LazyUserApps:
+    """Value of a device, parsed into UserApps on the first access to lat, lon or apps"""
+    __slots__ = ('raw', '_dictionary', '_decoded')
+
+    def __init__(self, raw, dictionary=None):
+        self.raw = raw
+        self._dictionary = dictionary
+        self._decoded = None
+
+    def decode(self):
+        """:return: UserApps, parsed once"""
+        if self._decoded is None:
+            self._decoded = decode_value(self.raw, self._dictionary)
+        return self._decoded
+
+    @property
+    def lat(self):
+        return self.decode().lat
+
+    @property
+    def lon(self):
+        return self.decode().lon
+
+    @property
+    def apps(self):
+        return self.decode().apps
+
+
+class TTLCache:
+    """LRU cache of at most `size` values, each used for `ttl` seconds after it is put. Thread-safe"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._items = OrderedDict()  # key -> (expiry, value), the least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """:return: the value, None if there is no value or it is expired"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        if not self.size:
+            return
+        with self._lock:
+            self._items[key] = time.monotonic() + self.ttl, value
+            self._items.move_to_end(key)
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+class Batcher:
+    """
+    Lookups of a memcached instance: a lookup waits up to `window` seconds for others, and all of them are read with
+    one get_multi by the thread of the batcher. Keys looked up at once by several callers are read once
+    """
+
+    def __init__(self, addr, window=WINDOW, max_batch=MAX_BATCH, timeout=LOOKUP_TIMEOUT):
+        self.addr = addr
+        self.window = window
+        self.max_batch = max_batch
+        self.memc = memcache.Client((addr,), socket_timeout=timeout)
+        self.requests = queue.SimpleQueue()  # (key, Future), None to stop
+        self.batches = self.keys = 0
+        self._thread = threading.Thread(target=self._run, name=f'batcher-{addr}', daemon=True)
+        self._thread.start()
+
+    def submit(self, key):
+        """:return: Future of the value of the key, None if it is not stored"""
+        future = Future()
+        self.requests.put((key, future))
+        return future
+
+    def _collect(self):
+        """:return: dict of key -> futures of the next batch, None to stop"""
+        request = self.requests.get()
+        if request is None:
+            return
+        batch = {request[0]: [request[1]]}
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)  # stop after this batch
+                break
+            batch.setdefault(request[0], []).append(request[1])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                self.memc.disconnect_all()
+                return
+            try:
+                values = self.memc.get_multi(list(batch))
+            except Exception as exc:
+                logging.exception(f"Cannot read from memc {self.addr}: {exc}")
+                for futures in batch.values():
+                    for future in futures:
+                        future.set_exception(exc)
+                continue
+            self.batches += 1
+            self.keys += len(batch)
+            for key, futures in batch.items():
+                for future in futures:
+                    future.set_result(values.get(key))
+
+    def close(self):
+        self.requests.put(None)
+        self._thread.join()
+
+
+class Reader:
+    """
+    Client of the UserApps of devices stored by memc_load. Keys are routed to memcached instances by device type,
+    as the loader does, with the consistent hash ring when a device type has several instances. Thread-safe:
+    concurrent lookups of an instance are batched into get_multi, see Batcher. Values of hot devices are cached
+    in the process, and values are parsed only when their fields are accessed
+    :param device_memc: dict of device type -> comma-separated addresses, memc_load.device_memc by default
+    :param dictionary: zstd dictionary of values loaded with --zstd-dict
+    """
+
+    def __init__(self, device_memc=None, window=WINDOW, max_batch=MAX_BATCH, cache_size=CACHE_SIZE,
+                 ttl=CACHE_TTL, timeout=LOOKUP_TIMEOUT, dictionary=None):
+        self.device_memc = dict(DEVICE_MEMC if device_memc is None else device_memc)
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.dictionary = dictionary
+        self.cache = TTLCache(cache_size, ttl)
+        self.batchers = {}
+        self._lock = threading.Lock()
+
+    def address(self, dev_type, key):
+        """Address of the instance of the key, None for an unknown device type"""
+        servers = self.device_memc.get(dev_type)
+        if not servers:
+            return
+        ring = hash_ring(servers)
+        return servers if ring is None else ring.get_node(key)
+
+    def _batcher(self, addr):
+        with self._lock:
+            if addr not in self.batchers:
+                self.batchers[addr] = Batcher(addr, self.window, self.max_batch, self.timeout)
+            return self.batchers[addr]
+
+    def get_many(self, devices):
+        """
+        :param devices: iterable of (dev_type, dev_id)
+        :return: dict of (dev_type, dev_id) -> LazyUserApps of the devices found
+        """
+        found, futures = {}, {}
+        for dev_type, dev_id in devices:
+            key = f"{dev_type}:{dev_id}"
+            value = self.cache.get(key)
+            if value is not None:
+                found[dev_type, dev_id] = value
+                continue
+            addr = self.address(dev_type, key)
+            if addr is None:
+                continue
+            futures[dev_type, dev_id] = key, self._batcher(addr).submit(key)
+        for device, (key, future) in futures.items():
+            raw = future.result(self.timeout)
+            if raw is not None:
+                found[device] = LazyUserApps(raw, self.dictionary)
+                self.cache.put(key, found[device])
+        return found
+
+    def get(self, dev_type, dev_id):
+        """:return: LazyUserApps of the device, None if it is not found"""
+        return self.get_many([(dev_type, dev_id)]).get((dev_type, dev_id))
+
+    def stats(self):
+        batches = sum(batcher.batches for batcher in self.batchers.values())
+        keys = sum(batcher.keys for batcher in self.batchers.values())
+        lookups = self.cache.hits + self.cache.misses
+        return {'get_multi': batches, 'keys_per_get_multi': round(keys / batches, 1) if batches else None,
+                'cache_hit_rate': round(self.cache.hits / lookups, 3) if lookups else None}
+
+    def close(self):
+        with self._lock:
+            for batcher in self.batchers.values():
+                batcher.close()
+            self.batchers.clear()
+
+
+def load_generator(reader, devices, threads, seconds, skew=1.2, seed=None):
+    """
+    Look up devices with `threads` concurrent callers for `seconds`, each a device at a time, chosen with
+    a Zipf-like skew so that some devices are hot
+    :param devices: list of (dev_type, dev_id)
+    :return: report of lookups/sec and latency percentiles in milliseconds
+    """
+    weights = [1 / (rank + 1) ** skew for rank in range(len(devices))]
+    latencies = []
+    found = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def caller(n):
+        rng = random.Random(None if seed is None else seed + n)
+        local, hits = [], 0
+        while time.monotonic() < deadline:
+            for device in rng.choices(devices, weights, k=100):
+                start = time.monotonic()
+                value = reader.get(*device)
+                if value is not None:
+                    value.apps  # decoded as a caller would
+                    hits += 1
+                local.append(time.monotonic() - start)
+        with lock:
+            latencies.extend(local)
+            found[0] += hits
+
+    workers = [threading.Thread(target=caller, args=(n,)) for n in range(threads)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3) if latencies else None
+    return dict({'threads': threads, 'lookups': len(latencies), 'found': found[0],
+                 'lookups_per_sec': round(len(latencies) / elapsed), 'p50_ms': percentile(0.5),
+                 'p99_ms': percentile(0.99), 'p999_ms': percentile(0.999)}, **reader.stats())
+
+
+def bench(options):
+    """Load generator against fake memcached servers, one per device type, holding `options.devices` records"""
+    import fake_memc
+    dev_types = ('idfa', 'gaid', 'adid', 'dvid')
+    rng = random.Random(options.seed)
+    servers = [fake_memc.FakeMemcached(latency=options.latency).start() for _ in dev_types]
+    try:
+        devices = []
+        for n in range(options.devices):
+            dev_type, server = dev_types[n % len(dev_types)], servers[n % len(dev_types)]
+            devices.append((dev_type, f"{n:032x}"))
+            apps = rng.sample(range(1, 10000), rng.randint(1, 20))
+            server.store[f"{dev_type}:{n:032x}".encode()] = 0, fastpack.pack_user_apps(apps, 55.5, 42.4)
+        rng.shuffle(devices)  # hot devices of all the types
+        reader = Reader({dev_type: server.address for dev_type, server in zip(dev_types, servers)},
+                        options.window, options.max_batch, options.cache_size, options.ttl)
+        try:
+            return dict(load_generator(reader, devices, options.threads, options.seconds, options.skew,
+                                       options.seed), window=options.window, cache_size=options.cache_size,
+                        latency=options.latency)
+        finally:
+            reader.close()
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage="%prog bench [options]\n\nLookups/sec and latency of Reader against fake memcached servers")
+    op.add_option("--threads", action="store", type="int", default=32, help="concurrent callers")
+    op.add_option("--seconds", action="store", type="float", default=5.0)
+    op.add_option("--devices", action="store", type="int", default=100000, help="records stored")
+    op.add_option("--skew", action="store", type="float", default=1.2, help="Zipf exponent of the devices looked up")
+    op.add_option("--window", action="store", type="float", default=WINDOW)
+    op.add_option("--max-batch", action="store", type="int", default=MAX_BATCH)
+    op.add_option("--cache-size", action="store", type="int", default=CACHE_SIZE, help="0 for no cache")
+    op.add_option("--ttl", action="store", type="float", default=CACHE_TTL)
+    op.add_option("--latency", action="store", type="float", default=0.0, help="seconds added to each round-trip")
+    op.add_option("--seed", action="store", type="int", default=1)
+    opts, args = op.parse_args()
+    if args != ['bench']:
+        op.error("bench is expected")
+    print(json.dumps(bench(opts)))
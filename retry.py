@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Failure handling of sends: jittered exponential backoff, circuit breakers per server, dead-letter files
+import glob
+import logging
+import os
+import random
+import struct
+import threading
+import time
+
+BACKOFF_BASE: float = 0.02  # seconds before the first retry, at most
+BACKOFF_CAP: float = 1.0  # seconds between retries, at most
+BREAKER_THRESHOLD: int = 5  # consecutive failed sends which open the circuit of a server
+BREAKER_TIMEOUT: float = 10.0  # seconds the circuit stays open before a trial send
+RECORD = struct.Struct('<II')  # lengths of the key and of the value of a dead letter
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Delay before a retry, with "full jitter": uniform up to the exponential delay, so that the retries
+    of the workers failed at once do not come at once too
+    :param attempt: number of the retry, from 1
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    Stops sending to a server which keeps failing. After `threshold` consecutive failed sends the circuit is open:
+    sends are refused for `timeout` seconds. Then a single trial send is allowed (half-open): the circuit closes
+    if it succeeds, and opens again if it fails. A send fails if none of its keys is stored
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, addr, threshold=BREAKER_THRESHOLD, timeout=BREAKER_TIMEOUT):
+        self.addr = addr
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """:return: whether a send may be made now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.timeout:
+                self.state = self.HALF_OPEN
+                logging.info(f"Circuit of {self.addr} is half-open, trying a send")
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info(f"Circuit of {self.addr} is closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        """:return: True if the circuit has been opened by this failure"""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.state == self.CLOSED and self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                logging.error(f"Circuit of {self.addr} is open after {self.failures} failed sends, "
+                              f"no sends for {self.timeout}s")
+                return True
+            return False
+
+
+class Breakers(dict):
+    """CircuitBreaker by address of a process, created on first use"""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, timeout=BREAKER_TIMEOUT):
+        super().__init__()
+        self.pid = os.getpid()
+        self.threshold = threshold
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def __missing__(self, addr):
+        with self._lock:
+            return self.setdefault(addr, CircuitBreaker(addr, self.threshold, self.timeout))
+
+
+class DeadLetters:
+    """
+    Records which could not be stored, appended to `<path>.<pid>.dead` of the process, to be loaded again later.
+    Each record is the lengths of the key and of the value, the key in UTF-8, and the value
+    """
+
+    def __init__(self, path):
+        self.path = f"{path}.{os.getpid()}.dead"
+        self.pid = os.getpid()
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        """:param data: dict of key -> packed value"""
+        if not data:
+            return
+        chunks = []
+        for key, packed in data.items():
+            key = key.encode() if isinstance(key, str) else key
+            chunks += [RECORD.pack(len(key), len(packed)), key, packed]
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(b''.join(chunks))
+            self.count += len(data)
+
+
+def read_dead_letters(path):
+    """
+    Yield (key, packed) of a dead-letter file. Keys are str, or bytes if they are not valid UTF-8, as the keys of
+    --binary files with invalid device types, which are routed as unknown device types again
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + RECORD.size <= len(data):
+        key_len, value_len = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if pos + key_len + value_len > len(data):  # a record cut by an interrupted write
+            logging.warning(f"Dead-letter file {path} ends with an incomplete record")
+            return
+        key = data[pos:pos + key_len]
+        try:
+            key = key.decode()
+        except UnicodeDecodeError:
+            pass
+        yield key, data[pos + key_len:pos + key_len + value_len]
+        pos += key_len + value_len
+
+
+def dead_letter_files(path):
+    """
+    Dead-letter files of all the processes, renamed to `.replay` so that records which fail again go to new files.
+    Files of an interrupted replay are included
+    """
+    for dead in glob.glob(glob.escape(path) + '.*.dead'):
+        os.replace(dead, f"{dead[:-len('.dead')]}.{time.time_ns()}.replay")
+    return sorted(glob.glob(glob.escape(path) + '.*.replay'))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Scheduling of the files of a load: largest first, a bounded number in flight, finished in chronological order
+import bisect
+import glob
+import heapq
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+WATCH_INTERVAL: float = 5.0  # seconds between scans of the directory for new files
+
+
+def submit_now(func, *args):
+    """Call the function in this thread, :return: its done Future, for a FileScheduler loading a file at a time"""
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+class Watch:
+    """
+    Poll of the files of a pattern which are ready to be loaded: those of the same size and modification time
+    at two scans in a row, as a file appearing in the directory may still be being written
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.stats = {}  # path -> (size, mtime) at the previous scan
+
+    def __call__(self):
+        stats, ready = {}, []
+        for path in glob.iglob(self.pattern):
+            try:
+                st = os.stat(path)
+            except OSError:  # renamed after the scan
+                continue
+            stats[path] = st.st_size, st.st_mtime_ns
+            if self.stats.get(path) == stats[path]:
+                ready.append(path)
+        self.stats = stats
+        return ready
+
+
+class FileScheduler:
+    """
+    Files are submitted largest first (longest processing time first, by compressed size), so that the largest file
+    does not start last and keep a single worker busy at the end, with at most `inflight` files submitted at a time.
+    A file is finished (renamed) in chronological order, that is of the sorted paths: only after all the earlier
+    files are. A failed file is not finished, nor are the later ones, so that they are all loaded again in order;
+    no new files are submitted after a failure, and it is raised when the files in flight are done
+    :param submit: function of the path and the number of the file in chronological order -> Future of the summary
+    :param finish: function of the path and the summary, called in chronological order
+    :param inflight: files submitted at a time
+    :param largest_first: False to submit files in chronological order
+    """
+
+    def __init__(self, submit, finish, inflight, largest_first=True):
+        self.submit = submit
+        self.finish = finish
+        self.inflight = inflight
+        self.largest_first = largest_first
+        self.queue = []  # heap of (-size, file_n, path) to submit
+        self.unfinished = []  # sorted paths added and not finished
+        self.futures = {}  # future -> path
+        self.results = {}  # path -> summary of the files done, waiting for an earlier one
+        self.added = set()
+        self.count = 0  # files added, to number them
+        self.error = None
+        self.stop = threading.Event()  # set to stop watching, the files added are loaded
+
+    def add(self, paths):
+        """
+        Add the files which are not added yet, numbered in chronological order after the files added before
+        :return: number of files added
+        """
+        new = sorted(set(paths) - self.added)
+        for path in new:
+            self.count += 1
+            size = os.path.getsize(path) if self.largest_first else 0
+            heapq.heappush(self.queue, (-size, self.count, path))
+            bisect.insort(self.unfinished, path)
+        self.added.update(new)
+        return len(new)
+
+    def _submit(self):
+        while self.queue and len(self.futures) < self.inflight and self.error is None:
+            _, file_n, path = heapq.heappop(self.queue)
+            self.futures[self.submit(path, file_n)] = path
+
+    def _finish(self):
+        while self.unfinished and self.unfinished[0] in self.results:
+            path = self.unfinished.pop(0)
+            self.added.discard(path)  # a new file of the same name is loaded again
+            self.finish(path, self.results.pop(path))
+
+    def run(self, poll=None, interval=WATCH_INTERVAL):
+        """
+        Load the files added. With poll, add the files it returns every interval seconds too, until stop is set
+        :param poll: function with no arguments -> paths of the files ready to be loaded, e.g. Watch
+        """
+        next_poll = time.monotonic() + interval
+        while True:
+            self._submit()
+            watching = poll is not None and not self.stop.is_set() and self.error is None
+            if not self.futures and not watching:
+                break
+            if self.futures:
+                timeout = max(0.0, next_poll - time.monotonic()) if watching else None
+                done = wait(self.futures, timeout, return_when=FIRST_COMPLETED).done
+                for future in done:
+                    path = self.futures.pop(future)
+                    try:
+                        self.results[path] = future.result()
+                    except Exception as exc:
+                        logging.exception(f"File {path} has failed, it and the later files are not renamed: {exc}")
+                        self.error = self.error or exc
+                self._finish()
+            else:
+                self.stop.wait(max(0.0, next_poll - time.monotonic()))
+            if watching and not self.stop.is_set() and time.monotonic() >= next_poll:
+                added = self.add(poll())
+                if added:
+                    logging.info(f"{added} new files to load")
+                next_poll = time.monotonic() + interval
+        if self.error is not None:
+            raise self.error
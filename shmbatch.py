@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Batches of packed records in shared memory, to pass them between processes with no pickling
+import queue
+import struct
+from multiprocessing.shared_memory import SharedMemory
+
+ARENA_SIZE: int = 32 * 2 ** 20
+RECORD_SIZE: int = 32  # minimal expected size of key and value of a record, to size the index of an arena
+
+# Layout of an arena: header, index of records, records. A record is its key followed by its value,
+# the index holds offset, key length and value length of each record
+HEADER = struct.Struct('<II')  # number of records, capacity of the index
+INDEX_ENTRY_SIZE: int = 3 * 4
+
+
+def _capacity(size):
+    return (size - HEADER.size) // (RECORD_SIZE + INDEX_ENTRY_SIZE)
+
+
+class BatchWriter:
+    """Fills an arena created by another process with records, from the start"""
+
+    def __init__(self, name):
+        self.shm = SharedMemory(name)
+        self.capacity = _capacity(self.shm.size)
+        self.index = self.shm.buf[HEADER.size:HEADER.size + self.capacity * INDEX_ENTRY_SIZE].cast('I')
+        self.data = self.shm.buf[HEADER.size + self.capacity * INDEX_ENTRY_SIZE:]
+        self.count = self.pos = 0
+
+    def add(self, key, value):
+        """
+        :param key: str or bytes
+        :return: False if the record does not fit into the arena
+        """
+        if isinstance(key, str):
+            key = key.encode()
+        end = self.pos + len(key) + len(value)
+        if self.count == self.capacity or end > len(self.data):
+            return False
+        self.data[self.pos:self.pos + len(key)] = key
+        self.data[self.pos + len(key):end] = value
+        i = self.count * 3
+        self.index[i], self.index[i + 1], self.index[i + 2] = self.pos, len(key), len(value)
+        self.pos = end
+        self.count += 1
+        return True
+
+    def close(self):
+        HEADER.pack_into(self.shm.buf, 0, self.count, self.capacity)
+        self.index.release()
+        self.data.release()
+        self.shm.close()
+
+
+class BatchReader:
+    """Records of an arena, values are memoryviews of the shared memory"""
+
+    def __init__(self, shm):
+        self.count, capacity = HEADER.unpack_from(shm.buf, 0)
+        self.index = shm.buf[HEADER.size:HEADER.size + capacity * INDEX_ENTRY_SIZE].cast('I')
+        self.data = shm.buf[HEADER.size + capacity * INDEX_ENTRY_SIZE:]
+
+    def batch(self, start, stop, copy=False):
+        """
+        dict of key -> value of the records from start to stop
+        :param copy: values are bytes, for clients which do not accept memoryviews
+        """
+        data = {}
+        index, records = self.index, self.data
+        for i in range(start * 3, stop * 3, 3):
+            pos, key_len, value_len = index[i], index[i + 1], index[i + 2]
+            value = records[pos + key_len:pos + key_len + value_len]
+            data[bytes(records[pos:pos + key_len])] = bytes(value) if copy else value
+        return data
+
+    def release(self):
+        self.index.release()
+        self.data.release()
+
+
+class ArenaRing:
+    """
+    Arenas of shared memory created once and reused for all the batches, so steady-state ingestion does not
+    allocate. An arena is acquired before it is passed to a writer, and released when its records are sent
+    """
+
+    def __init__(self, n, size=ARENA_SIZE):
+        self.arenas = {}
+        self._free = queue.Queue()
+        for _ in range(n):
+            shm = SharedMemory(create=True, size=size)
+            self.arenas[shm.name] = shm
+            self._free.put(shm.name)
+
+    def acquire(self, timeout=None):
+        """
+        :return: name of a free arena, None if there is no one within the timeout
+        """
+        try:
+            return self._free.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+    def release(self, name):
+        self._free.put(name)
+
+    def reader(self, name):
+        return BatchReader(self.arenas[name])
+
+    def close(self):
+        for shm in self.arenas.values():
+            shm.close()
+            shm.unlink()
@@ -1,17 +1,58 @@
 import collections
 import gzip
+import importlib.util
+import json
 import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import memcache
 
+import appsinstalled_pb2
+import autotune
+import budget
+import checkpoint
+import check_memc_values
+import coalesce
+import compact
+import delta
+import export
+import fake_memc
+import fastpack
+import gen_data
+import ketama
 import memc_load
+import memc_meta
+import metrics
+import reader
+import retry
+import scheduler
+import shmbatch
+import validate
+import verify
 
 client_addr = '127.0.0.1:33013'  # test server address
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
 
 
+def keep_device_memc(test):
+    """Restore memc_load.device_memc when the test is done, for tests which add device types to it"""
+    saved = dict(memc_load.device_memc)
+
+    def restore():
+        memc_load.device_memc.clear()
+        memc_load.device_memc.update(saved)
+    test.addCleanup(restore)
+
+
 class InsertAppsinstalledTest(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -54,6 +95,271 @@ class InsertAppsinstalledTest(unittest.TestCase):
             'DEBUG:root:inet:127.0.0.1:33013 - somedev:someid -> apps: 1 apps: 2 apps: 3 lat: 55.1 lon: 55.1 ',
             cm.output)
 
+    def test_insert_dry_run_compact(self):
+        packed = compact.Encoder().pack([3, 1, 2], 55.1, 55.1)
+        memc_load.opts.encoding = 'compact'
+        try:
+            with self.assertLogs(level='DEBUG') as cm:
+                result = memc_load.insert_appsinstalled_multi(self.memc, {'somedev:someid': packed}, True)
+        finally:
+            memc_load.opts.encoding = 'protobuf'
+            memc_load._encoder = None
+        self.assertEqual((0, 1), result)
+        self.assertIn(
+            'DEBUG:root:inet:127.0.0.1:33013 - somedev:someid -> apps: 1 apps: 2 apps: 3 lat: 55.1 lon: 55.1 ',
+            cm.output)
+
+
+class FlakyClient:
+    """set_multi fails the given keys the given number of times"""
+
+    def __init__(self, failing, times=1):
+        self.servers = ['inet:flaky']
+        self.failing = failing
+        self.times = times
+        self.sent = []
+
+    def set_multi(self, data):
+        self.sent.append(sorted(data))
+        if len(self.sent) > self.times:
+            return []
+        return [key for key in data if key in self.failing]
+
+
+class RetryTest(unittest.TestCase):
+    def tearDown(self) -> None:
+        memc_load._breakers = None
+        memc_load.opts.dead_letter = None
+
+    def test_backoff(self):
+        for attempt in range(1, 10):
+            self.assertLessEqual(retry.backoff(attempt, 0.01, 0.1), min(0.1, 0.01 * 2 ** (attempt - 1)))
+
+    def test_breaker(self):
+        breaker = retry.CircuitBreaker('inet:flaky', threshold=2, timeout=0.05)
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())  # a trial send
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.failure())  # opened again by a single failure
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual((retry.CircuitBreaker.CLOSED, True), (breaker.state, breaker.allow()))
+
+    def test_retry_failed_keys(self):
+        memc = FlakyClient({'idfa:2'})
+        result = memc_load.insert_appsinstalled_multi(memc, {'idfa:1': b'1', 'idfa:2': b'2'})
+        self.assertEqual((0, 2), result)
+        self.assertEqual([['idfa:1', 'idfa:2'], ['idfa:2']], memc.sent)
+
+    def test_open_circuit(self):
+        memc_load.opts.dead_letter = 'data/test'
+        memc = FlakyClient({'idfa:1'}, times=100)
+        breaker = memc_load.get_breaker('inet:flaky')
+        try:
+            for _ in range(breaker.threshold):
+                self.assertEqual((1, 1), memc_load.insert_appsinstalled_multi(memc, {'idfa:1': b'1'}))
+            sent = len(memc.sent)
+            self.assertEqual((1, 1), memc_load.insert_appsinstalled_multi(memc, {'idfa:1': b'1'}))
+            self.assertEqual(sent, len(memc.sent))  # no sends while the circuit is open
+            files = retry.dead_letter_files('data/test')
+            records = [record for fn in files for record in retry.read_dead_letters(fn)]
+        finally:
+            for fn in retry.dead_letter_files('data/test'):
+                os.remove(fn)
+        self.assertEqual([('idfa:1', b'1')] * (breaker.threshold + 1), records)
+
+    def test_replay(self):
+        from memc_load import opts, device_memc
+        opts.dead_letter = 'data/test'
+        dead = retry.DeadLetters(opts.dead_letter)
+        dead.write({'somedev:someid': b'1', 'otherdev:someid': b'2'})
+        keep_device_memc(self)
+        device_memc['somedev'] = client_addr
+        opts.replay = True
+        memc = memcache.Client((client_addr,))
+        try:
+            result = memc_load.main()
+            self.assertEqual(b'1', memc.get('somedev:someid'))
+            # the record of the unknown device type goes to a new file
+            files = retry.dead_letter_files('data/test')
+            self.assertEqual([('otherdev:someid', b'2')], list(retry.read_dead_letters(files[0])))
+        finally:
+            opts.replay = False
+            memc.delete('somedev:someid')
+            memc.disconnect_all()
+            for fn in retry.dead_letter_files('data/test'):
+                os.remove(fn)
+        self.assertEqual((1, 1, 1), (result['processed'], result['errors'], result['files']))
+
+    def test_replay_invalid_utf8(self):
+        from memc_load import opts
+        opts.dead_letter = 'data/test'
+        retry.DeadLetters(opts.dead_letter).write({b'\xffdev:0': b'1'})  # of a --binary file
+        opts.replay = True
+        try:
+            with self.assertLogs(level='ERROR'):
+                result = memc_load.main()
+            files = retry.dead_letter_files('data/test')
+            self.assertEqual([(b'\xffdev:0', b'1')], list(retry.read_dead_letters(files[0])))
+        finally:
+            opts.replay = False
+            for fn in retry.dead_letter_files('data/test'):
+                os.remove(fn)
+        self.assertEqual((0, 1, 1), (result['processed'], result['errors'], result['files']))
+
+
+class InsertPipelineTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.memc = memcache.Client((client_addr,))
+        self.pipeline = memc_load.InsertPipeline(depth=1)
+
+    def tearDown(self) -> None:
+        self.pipeline.close()
+        self.memc.delete('somedev:someid')
+        self.memc.delete('somedev:someid1')
+        self.memc.disconnect_all()
+
+    def test_submit(self):
+        counter = memc_load.LoadCounter()
+        self.pipeline.submit(self.memc, {'somedev:someid': b'1'}, counter)
+        self.pipeline.submit(self.memc, {'somedev:someid1': b'2'}, counter)
+        self.pipeline.join()
+        self.assertEqual((2, 0), (counter.processed, counter.errors))
+        self.assertEqual(2, self.pipeline.stats['batches'])
+        self.assertEqual(b'2', self.memc.get('somedev:someid1'))
+
+    def test_submit_fail_nonexistent_instance(self):
+        counter = memc_load.LoadCounter()
+        self.pipeline.submit(memcache.Client(['127.0.0.1:35004', ]), {'somedev:someid': b'1'}, counter)
+        self.pipeline.join()
+        self.assertEqual((0, 1), (counter.processed, counter.errors))
+
+    def test_failed_batch(self):
+        counter = memc_load.LoadCounter()
+        packed = fastpack.pack_user_apps([1], 1.0, 2.0)
+        with self.assertLogs(level='ERROR'):
+            self.pipeline.submit(self.memc, {'somedev:someid': b'\xff', 'somedev:someid1': packed}, counter, True)
+            self.pipeline.submit(self.memc, {'somedev:someid': packed}, counter, True)  # the same sender
+            self.pipeline.submit(self.memc, {'somedev:someid1': packed}, counter, True)
+            self.pipeline.join()
+        self.assertEqual((2, 2), (counter.processed, counter.errors))
+
+    def test_failed_batch_coalesced(self):
+        coalescer = coalesce.Coalescer(['somedev'], 64)
+        memc_load._coalescer = coalescer
+        try:
+            coalescer.claim({'somedev': {'somedev:someid': b'\xff'}}, 1)
+            with self.assertLogs(level='ERROR'):
+                self.pipeline.submit(self.memc, {'somedev:someid': b'\xff'}, memc_load.LoadCounter(), True)
+                self.pipeline.join()
+            # the key of the failed batch is not in flight any more, and its value is sent again
+            self.assertEqual({'somedev': {'somedev:someid': b'\xff'}},
+                             coalescer.claim({'somedev': {'somedev:someid': b'\xff'}}, 2)[coalesce.SEND])
+        finally:
+            memc_load._coalescer = None
+            coalescer.close()
+
+    def test_call(self):
+        counter = memc_load.LoadCounter()
+        self.pipeline.submit(self.memc, {'somedev:someid': b'1'}, counter)
+        future = self.pipeline.call(self.memc, lambda memc: (threading.current_thread(), memc.get('somedev:someid')))
+        thread, value = future.result(5)
+        self.assertEqual(b'1', value)  # after the batch queued before
+        self.assertIsNot(threading.current_thread(), thread)
+        failed = self.pipeline.call(self.memc, lambda memc: 1 / 0)
+        self.assertRaises(ZeroDivisionError, failed.result, 5)
+
+    def test_join_counter(self):
+        class BlockedClient(FlakyClient):
+            def set_multi(self, data):
+                release.wait(5)
+                return super().set_multi(data)
+
+        release = threading.Event()
+        blocked, counter = memc_load.LoadCounter(), memc_load.LoadCounter()
+        self.pipeline.submit(BlockedClient(()), {'a': b'1'}, blocked)
+        self.pipeline.submit(self.memc, {'somedev:someid': b'1'}, counter)
+        self.pipeline.join(counter)  # not waiting for the batch of the other file
+        self.assertEqual(((1, 0), 1), ((counter.processed, counter.errors), blocked.queued))
+        release.set()
+        self.pipeline.join(blocked)
+        self.assertEqual((1, 0), (blocked.processed, blocked.queued))
+
+
+class MetaClientTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.memc = memcache.Client((client_addr,))
+        self.meta = memc_meta.MetaClient(client_addr)
+
+    def tearDown(self) -> None:
+        self.memc.delete('somedev:someid')
+        self.memc.delete('somedev:someid1')
+        self.memc.disconnect_all()
+        self.meta.disconnect_all()
+
+    def test_set_multi(self):
+        result = self.meta.set_multi({'somedev:someid': b'1', b'somedev:someid1': b'2'})
+        self.assertEqual([], result)
+        self.assertEqual(b'1', self.memc.get('somedev:someid'))
+        self.assertEqual(b'2', self.memc.get('somedev:someid1'))
+
+    def test_insert(self):
+        appsinstalled = AppsInstalled('somedev', 'someid', 55.1, 55.1, [1, 2, 3])
+        key, packed = memc_load.protobuf_serilalize(appsinstalled)
+        result = memc_load.insert_appsinstalled_multi(self.meta, {key: packed}, False)
+        self.assertEqual((0, 1), result)
+        self.assertEqual(packed, self.memc.get('somedev:someid'))
+
+    def test_invalid_key(self):
+        result = self.meta.set_multi({'some dev:someid': b'1', 'somedev:someid': b'2'})
+        self.assertEqual(['some dev:someid'], result)
+
+    def test_fail_nonexistent_instance(self):
+        result = memc_meta.MetaClient('127.0.0.1:35004').set_multi({'somedev:someid': b'1'})
+        self.assertEqual(['somedev:someid'], result)
+
+    def test_failed_keys(self):
+        keys = ['somedev:someid', 'somedev:someid1', 'somedev:someid2']
+        self.assertEqual([], memc_meta.failed_keys(b'', keys))
+        self.assertEqual(['somedev:someid1'], memc_meta.failed_keys(b'NS O1\r\n', keys))
+        self.assertEqual(keys, memc_meta.failed_keys(b'SERVER_ERROR out of memory\r\n', keys))
+
+    def test_build_meta_set(self):
+        buffers = memc_meta.build_meta_set([(b'somedev:someid', b'12')])
+        self.assertEqual(b'ms somedev:someid 2 O0 q\r\n12\r\nmn\r\n', b''.join(buffers))
+
+
+class AsyncEngineTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.memc = memcache.Client((client_addr,))
+        self.engine = memc_load.AsyncEngine(inflight=2)
+        self.batches = [
+            ['somedev\tsomeid\t55.55\t42.42\t1423,43,567,3,7,23', 'errdev\t...'],
+            ['somedev1\tsomeid1\t55.55\t42.42\t7423,424'],
+        ]
+
+    def tearDown(self) -> None:
+        self.engine.close()
+        self.memc.delete('somedev:someid')
+        self.memc.delete('somedev1:someid1')
+        self.memc.disconnect_all()
+
+    def test_load(self):
+        counter = memc_load.LoadCounter()
+        self.engine.load(iter(self.batches), {'somedev': client_addr, 'somedev1': client_addr}, counter)
+        self.assertEqual((2, 1), (counter.processed, counter.errors))
+        self.assertTrue(self.memc.get('somedev:someid'))
+        self.assertTrue(self.memc.get('somedev1:someid1'))
+
+    def test_load_fail_nonexistent_instance(self):
+        counter = memc_load.LoadCounter()
+        self.engine.load(iter(self.batches), {'somedev': '127.0.0.1:35004', 'somedev1': client_addr}, counter)
+        self.assertEqual((1, 2), (counter.processed, counter.errors))
+
 
 class ParseAppinstalledTest(unittest.TestCase):
     def test_line_completeness(self):
@@ -75,8 +381,9 @@ class ParseAppinstalledTest(unittest.TestCase):
     def test_invalid_geo(self):
         sample = "idfa\tdevid\t55.55\tabc\t1423,3,7,23\n"
         with self.assertLogs(level='DEBUG') as cm:
-            memc_load.parse_appsinstalled(sample)
+            result = memc_load.parse_appsinstalled(sample)
         self.assertIn(f"INFO:root:Invalid geo coords: `{sample}`", cm.output)
+        self.assertIsNone(result)  # not passed into UserApps, which would fail the batch
 
     def test_ok(self):
         sample = "idfa\tdevid\t55.55\t42.42\t1423,3,7,23\n"
@@ -87,6 +394,7 @@ class ParseAppinstalledTest(unittest.TestCase):
 
 class FilesTest(unittest.TestCase):
     def setUp(self) -> None:
+        keep_device_memc(self)
         self.memc = memcache.Client((client_addr,))
         # write a gunzipped file with some contents
         content = "somedev\tsomeid\t55.55\t42.42\t1423,43,567,3,7,23\nsomedev1\tsomeid1\t55.55\t42.42\t7423,424"
@@ -116,6 +424,117 @@ class FilesTest(unittest.TestCase):
         os.rename(str(self.compressed_file_path.parent) + '/.' + str(self.compressed_file_path.name),
                   self.compressed_file_path)
 
+    def test_read_batches(self):
+        size = os.path.getsize(self.compressed_file_path)
+        with gzip.open(self.compressed_file_path, 'rt') as f:
+            batches = list(memc_load.read_batches(f, 1))
+            self.assertEqual(1.0, memc_load.read_progress(f, size))
+        self.assertEqual(2, len(batches))
+        self.assertTrue(batches[1][0].startswith('somedev1\tsomeid1'))
+
+    def test_read_batches_binary(self):
+        size = os.path.getsize(self.compressed_file_path)
+        with gzip.open(self.compressed_file_path, 'rb') as f:
+            batches = list(memc_load.read_batches(f, 1))
+            self.assertEqual(1.0, memc_load.read_progress(f, size))
+        self.assertTrue(batches[0][0].startswith(b'somedev\tsomeid'))
+
+    def test_read_chunks(self):
+        with gzip.open(self.compressed_file_path, 'rb') as f:
+            chunks = list(memc_load.read_chunks(f, 10))
+        self.assertEqual(2, len(chunks))
+        self.assertTrue(chunks[0].endswith(b'\n'))
+        self.assertTrue(chunks[1].startswith(b'somedev1\tsomeid1'))
+
+    def test_process_chunk(self):
+        chunk = b'somedev\tsomeid\t55.55\t42.42\t1423,43,567,3,7,23\nerrdev\t...\n'
+        result = memc_load.process_chunk(chunk, {'somedev': client_addr})
+        self.assertEqual((1, 1), (result['processed'], result['errors']))
+        self.assertTrue(self.memc.get('somedev:someid'))
+
+    def test_main_threads(self):
+        from memc_load import opts, device_memc
+        opts.pattern = 'test/*.tsv.gz'
+        opts.executor = 'threads'
+        device_memc['somedev'] = device_memc['somedev1'] = client_addr
+        try:
+            result = memc_load.main()
+        finally:
+            opts.executor = 'auto'
+        os.rename(str(self.compressed_file_path.parent) + '/.' + str(self.compressed_file_path.name),
+                  self.compressed_file_path)
+        self.assertEqual((2, 0), (result['processed'], result['errors']))
+        self.assertTrue(self.memc.get('somedev1:someid1'))
+
+    def test_main_split_files(self):
+        from memc_load import opts, device_memc
+        opts.pattern = 'test/*.tsv.gz'
+        opts.split_files = True
+        device_memc['somedev'] = client_addr
+        try:
+            memc_load.main()
+        finally:
+            opts.split_files = False
+        os.rename(str(self.compressed_file_path.parent) + '/.' + str(self.compressed_file_path.name),
+                  self.compressed_file_path)
+        self.assertTrue(self.memc.get('somedev:someid'))
+
+    def test_process_file_checkpoint(self):
+        from memc_load import opts
+        checkpoint.save_state(self.compressed_file_path, {'member_offset': 0, 'member_line': 1, 'line': 1,
+                                                          'processed': 1, 'errors': 0})
+        opts.checkpoint = True
+        try:
+            result = memc_load.process_file(str(self.compressed_file_path),
+                                            {'somedev': client_addr, 'somedev1': client_addr})
+        finally:
+            opts.checkpoint = False
+        self.assertEqual((2, 0), (result['processed'], result['errors']))
+        self.assertIsNone(self.memc.get('somedev:someid'))  # stored before the checkpoint
+        self.assertTrue(self.memc.get('somedev1:someid1'))
+        self.assertEqual(2, checkpoint.load_state(self.compressed_file_path)['line'])
+        checkpoint.remove_state(self.compressed_file_path)
+
+    def test_main_delta(self):
+        from memc_load import opts, device_memc
+        opts.pattern = 'test/*.tsv.gz'
+        opts.delta_index = 'test/delta.idx'
+        device_memc['somedev'] = client_addr
+        device_memc['somedev1'] = client_addr
+        results = []
+        try:
+            for _ in range(2):
+                results.append(memc_load.main())
+                os.rename(str(self.compressed_file_path.parent) + '/.' + str(self.compressed_file_path.name),
+                          self.compressed_file_path)
+        finally:
+            opts.delta_index = None
+            os.remove('test/delta.idx')
+        self.assertEqual([(2, 0), (2, 2)], [(result['processed'], result['skipped']) for result in results])
+
+    def test_main_delta_noreply(self):
+        from memc_load import opts
+        opts.delta_index, opts.noreply = 'test/delta.idx', True
+        try:
+            with self.assertRaises(ValueError):
+                memc_load.main()
+        finally:
+            opts.delta_index, opts.noreply = None, False
+        self.assertFalse(os.path.exists('test/delta.idx'))
+
+    def test_process_file_verify(self):
+        from memc_load import opts, device_memc
+        device_memc['somedev'] = device_memc['somedev1'] = client_addr
+        opts.noreply, opts.verify_sample = True, 10
+        try:
+            with self.assertLogs(level='INFO') as cm:
+                result = memc_load.process_file(str(self.compressed_file_path), device_memc)
+        finally:
+            opts.noreply, opts.verify_sample = False, 0
+        self.assertEqual((2, 0), (result['processed'], result['errors']))
+        self.assertTrue(any('Read back: verified 2 of 2 sampled records, success rate 100.00%' in line
+                            for line in cm.output))
+
     def test_main(self):
         from memc_load import opts, device_memc
         opts.pattern = 'test/*.tsv.gz'
@@ -126,6 +545,314 @@ class FilesTest(unittest.TestCase):
         self.assertTrue(self.memc.get('somedev:someid'))
 
 
+def worker_state():
+    return sorted(memc_load.conns), memc_load.opts.timeout, memc_load.device_memc['idfa']
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_import(self):
+        # options which would fail parsing, the module is imported with no side effects
+        code = ("import logging, sys, memc_load; print(len(logging.getLogger().handlers), len(memc_load.conns), "
+                "[m for m in ('memcache', 'appsinstalled_pb2', 'asyncio') if m in sys.modules])")
+        output = subprocess.run([sys.executable, '-c', code, '--bogus'], capture_output=True, text=True, check=True)
+        self.assertEqual("0 0 []", output.stdout.strip())
+
+    def test_configure(self):
+        try:
+            self.assertEqual(['extra'], memc_load.configure(['--dry', '--idfa', '127.0.0.1:1', 'extra']))
+            from memc_load import opts, device_memc
+            self.assertTrue(opts.dry)
+            self.assertEqual('127.0.0.1:1', device_memc['idfa'])
+        finally:
+            memc_load.configure([])
+        self.assertFalse(opts.dry)
+        self.assertEqual('127.0.0.1:33013', device_memc['idfa'])
+
+    def test_get_conn(self):
+        memc = memc_load.get_conn(client_addr)
+        self.assertIs(memc, memc_load.get_conn(client_addr))
+        pid = memc_load._conns_pid
+        try:
+            memc_load._conns_pid = -1  # as in a forked process
+            self.assertIsNot(memc, memc_load.get_conn(client_addr))
+            self.assertEqual([client_addr], list(memc_load.conns))
+        finally:
+            memc_load.close_conns()
+            memc_load._conns_pid = pid
+
+    def test_init_worker(self):
+        options = memc_load.op.get_default_values()
+        options.timeout = 1.5
+        addresses = dict(memc_load.device_memc, idfa='127.0.0.1:1')
+        with ProcessPoolExecutor(1, initializer=memc_load.init_worker, initargs=(options, addresses)) as executor:
+            conns, timeout, idfa = executor.submit(worker_state).result()
+        self.assertEqual(sorted(addresses.values()), conns)
+        self.assertEqual((1.5, '127.0.0.1:1'), (timeout, idfa))
+        self.assertEqual(memc_load.op.get_default_values().timeout, memc_load.opts.timeout)
+
+
+class ExecutorTest(unittest.TestCase):
+
+    def tearDown(self) -> None:
+        memc_load.opts.executor = 'auto'
+        memc_load.opts.engine = 'threads'
+        memc_load.opts.coalesce = False
+
+    def test_auto(self):
+        expected = 'threads' if memc_load.free_threaded() else 'processes'
+        self.assertEqual(expected, memc_load.resolve_executor())
+
+    def test_fallback(self):
+        memc_load.opts.executor = 'threads'
+        self.assertEqual('threads', memc_load.resolve_executor())
+        memc_load.opts.engine = 'asyncio'
+        self.assertEqual('processes', memc_load.resolve_executor())
+        memc_load.opts.executor = 'interpreters'
+        memc_load.opts.engine = 'threads'
+        memc_load.opts.coalesce = True  # relies on the memory inherited by fork
+        self.assertEqual('processes', memc_load.resolve_executor())
+
+    def test_thread_pool(self):
+        memc_load.opts.executor = 'threads'
+        with memc_load.worker_pool() as executor:
+            self.assertIsInstance(executor, ThreadPoolExecutor)
+            # the workers share the clients of the main process
+            self.assertIs(memc_load.get_conn(client_addr), executor.submit(memc_load.get_conn, client_addr).result())
+
+    def test_verify_sample_threads(self):
+        memc_load.opts.executor = 'threads'
+        clients = []
+        memc_client = memc_load.memc_client
+
+        def client(addr, backend='memcache', timeout=None):
+            clients.append(memc_client(addr, backend, timeout))
+            return clients[-1]
+
+        sampler = verify.Sampler(10)
+        sampler.add({client_addr: {'somedev:missing': b'1'}})
+        memc_load.memc_client = client
+        try:
+            verification = memc_load.verify_sample(sampler)
+        finally:
+            memc_load.memc_client = memc_client
+        self.assertEqual((1, 0), (verification.sampled, verification.matched))
+        self.assertEqual(1, len(clients))  # a client of the file, closed after the reads
+        self.assertIsNone(clients[0].servers[0].socket)
+
+
+class FileSchedulerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir = Path('test_scheduler')
+        self.dir.mkdir(exist_ok=True)
+        self.started, self.finished = [], []
+        self.running = self.max_running = 0
+        self.lock = threading.Lock()
+        self.release = {}  # path -> Event or Barrier the load of the file waits for
+
+    def tearDown(self) -> None:
+        for path in self.dir.iterdir():
+            path.unlink()
+        self.dir.rmdir()
+
+    def make(self, name, size):
+        path = self.dir / name
+        path.write_bytes(b'x' * size)
+        return str(path)
+
+    def process(self, path, file_n):
+        with self.lock:
+            self.started.append((path, file_n))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        if path in self.release:
+            self.release[path].wait(5)
+        with self.lock:
+            self.running -= 1
+        if path.endswith('bad'):
+            raise ValueError(path)
+        return path
+
+    def finish(self, path, result):
+        self.assertEqual(path, result)
+        self.finished.append(path)
+
+    def test_order(self):
+        files = [self.make(name, size) for name, size in (('1', 10), ('2', 30), ('3', 20), ('4', 40))]
+        self.release = {files[0]: threading.Event()}  # the earliest file is the last to be done
+        self.release[files[3]] = self.release[files[1]] = threading.Barrier(2)  # 2 files are loaded at once
+        with ThreadPoolExecutor(4) as executor:
+            sched = scheduler.FileScheduler(lambda *args: executor.submit(self.process, *args), self.finish, 2)
+            self.assertEqual(4, sched.add(reversed(files)))
+            self.assertEqual(0, sched.add(files))
+            threading.Timer(0.2, self.release[files[0]].set).start()
+            sched.run()
+        # largest first, numbered chronologically, renamed chronologically
+        self.assertEqual([(files[3], 4), (files[1], 2), (files[2], 3), (files[0], 1)], self.started)
+        self.assertEqual(files, self.finished)
+        self.assertEqual(2, self.max_running)
+
+    def test_failure(self):
+        files = [self.make(name, size) for name, size in (('1', 10), ('2bad', 30), ('3', 20), ('4', 5))]
+        sched = scheduler.FileScheduler(lambda *args: scheduler.submit_now(self.process, *args), self.finish, 1)
+        sched.add(files)
+        with self.assertRaises(ValueError):
+            sched.run()
+        # the failed file is not renamed, nor the later ones, and no files are started after it
+        self.assertEqual([files[1]], [path for path, _ in self.started])
+        self.assertEqual([], self.finished)
+
+    def test_watch(self):
+        first = self.make('1', 10)
+        watch = scheduler.Watch(str(self.dir / '*'))
+        sched = scheduler.FileScheduler(lambda *args: scheduler.submit_now(self.process, *args), self.finish, 1,
+                                        largest_first=False)
+        sched.add([first])
+
+        def finish(path, result):
+            self.finish(path, result)
+            os.rename(path, path + '.done')
+            if path == first:
+                self.make('2', 10)  # appears during the run, picked up at the second scan
+            else:
+                sched.stop.set()
+        sched.finish = finish
+        thread = threading.Thread(target=sched.run, args=(lambda: [path for path in watch() if '.' not in path],
+                                                          0.01))
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([first, str(self.dir / '2')], self.finished)
+        self.assertEqual(2, sched.count)
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir = Path('test_export')
+        (self.dir / 'in').mkdir(parents=True, exist_ok=True)
+        with gzip.open(self.dir / 'in' / '1.tsv.gz', 'wt') as f:
+            f.write("idfa\tid1\t55.55\t42.42\t1,2\ngaid\tid2\t1\t2\t3\nerrdev\tid3\t1\t2\t3\nidfa\tid1\t1\t2\t3\n")
+        with gzip.open(self.dir / 'in' / '2.tsv.gz', 'wt') as f:
+            f.write("idfa\tid1\t5\t6\t7\n")
+
+    def tearDown(self) -> None:
+        for path in sorted(self.dir.rglob('*'), reverse=True):
+            path.rmdir() if path.is_dir() else path.unlink()
+        self.dir.rmdir()
+
+    def test_encode_sets(self):
+        self.assertEqual(b'ms a 2 q\r\nxy\r\nms bc 0 q\r\n\r\n', export.encode_sets([(b'a', b'xy'), (b'bc', b'')]))
+
+    def export(self):
+        from memc_load import opts, device_memc
+        opts.pattern = str(self.dir / 'in' / '*.tsv.gz')
+        opts.export = str(self.dir / 'out')
+        try:
+            return memc_load.main()
+        finally:
+            opts.export = None
+
+    def test_export_replay(self):
+        summary = self.export()
+        self.assertEqual((4, 1, 1, 2), (summary['processed'], summary['errors'], summary['duplicates'],
+                                        summary['files']))
+        self.assertEqual(['1.tsv.gz', '2.tsv.gz'], sorted(os.listdir(self.dir / 'in')))  # not renamed
+        idfa, gaid = memc_load.device_memc['idfa'], memc_load.device_memc['gaid']
+        with fake_memc.FakeMemcached() as server:
+            result = export.replay_all(str(self.dir / 'out'), servers={idfa: server.address, gaid: server.address})
+            store = dict(server.store)
+        self.assertEqual({idfa: [2, 0], gaid: [1, 0]}, result)
+        self.assertEqual({b'idfa:id1', b'gaid:id2'}, set(store))
+        # the dumps of an instance are replayed in chronological order, the last value of a key is stored
+        self.assertEqual(fastpack.pack_user_apps([7], 5.0, 6.0), store[b'idfa:id1'][1])
+        self.assertEqual(fastpack.pack_user_apps([3], 1.0, 2.0), store[b'gaid:id2'][1])
+
+    def test_export_dump_names(self):
+        for name in ('1.a.tsv.gz', '1.b.tsv.gz'):
+            with gzip.open(self.dir / 'in' / name, 'wt') as f:
+                f.write("idfa\tid1\t1\t2\t3\n")
+        self.export()
+        self.assertEqual(['1.a.memc', '1.b.memc', '1.memc', '2.memc'],
+                         sorted(os.listdir(self.dir / 'out' / export.dump_dir(memc_load.device_memc['idfa']))))
+
+    def test_replay_failures(self):
+        self.export()
+        with open(self.dir / 'out' / export.MANIFEST) as f:
+            manifest = json.load(f)
+        path = os.path.join(export.dump_dir(memc_load.device_memc['idfa']), '1' + export.SUFFIX)
+        self.assertEqual([memc_load.device_memc['idfa'], 1], manifest[path])
+        with fake_memc.FakeMemcached(fail_rate=1.0) as server:
+            self.assertEqual(1, export.replay(str(self.dir / 'out' / path), server.address))
+
+
+class ReaderTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.servers = [fake_memc.FakeMemcached().start() for _ in range(3)]
+        self.device_memc = {'idfa': self.servers[0].address,
+                            'gaid': f"{self.servers[1].address},{self.servers[2].address}"}
+        self.reader = reader.Reader(self.device_memc, window=0.05)
+        self.packed = fastpack.pack_user_apps([1, 2], 55.5, 42.5)
+        self.servers[0].store[b'idfa:1'] = 0, self.packed
+
+    def tearDown(self) -> None:
+        self.reader.close()
+        for server in self.servers:
+            server.stop()
+
+    def test_get(self):
+        value = self.reader.get('idfa', '1')
+        self.assertIsNone(value._decoded)  # parsed on access
+        self.assertEqual([1, 2], list(value.apps))
+        self.assertEqual((55.5, 42.5), (value.lat, value.lon))
+        self.assertIsNone(self.reader.get('idfa', '2'))
+        self.assertIsNone(self.reader.get('unknown', '1'))
+
+    def test_batching(self):
+        self.servers[0].store[b'idfa:2'] = 0, self.packed
+        found = self.reader.get_many([('idfa', '1'), ('idfa', '2'), ('idfa', '3'), ('idfa', '1')])
+        self.assertEqual({('idfa', '1'), ('idfa', '2')}, set(found))
+        batcher = self.reader.batchers[self.servers[0].address]
+        self.assertEqual((1, 3), (batcher.batches, batcher.keys))  # one get_multi, keys read once
+
+    def test_concurrent_batching(self):
+        with ThreadPoolExecutor(8) as executor:
+            values = list(executor.map(lambda _: self.reader.get('idfa', '1'), range(8)))
+        self.assertTrue(all(value is not None for value in values))
+        self.assertLess(self.reader.batchers[self.servers[0].address].batches, 8)
+
+    def test_cache(self):
+        self.assertIsNotNone(self.reader.get('idfa', '1'))
+        self.servers[0].store.clear()
+        self.assertIsNotNone(self.reader.get('idfa', '1'))  # hot device from the cache
+        self.assertEqual({'get_multi': 1, 'keys_per_get_multi': 1.0, 'cache_hit_rate': 0.5}, self.reader.stats())
+        self.reader.cache.ttl = 0
+        self.reader.cache.put('idfa:1', 'expired')
+        self.assertIsNone(self.reader.get('idfa', '1'))
+
+    def test_lru(self):
+        cache = reader.TTLCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)  # b is the least recently used
+        self.assertEqual((1, None, 3), (cache.get('a'), cache.get('b'), cache.get('c')))
+
+    def test_routing(self):
+        # keys of a sharded device type are read from the instance the loader stores them to
+        batch_by_addr, _ = memc_load.route_batch({'gaid': {f'gaid:{n}': self.packed for n in range(50)}},
+                                                 self.device_memc)
+        self.assertEqual(2, len(batch_by_addr))
+        for addr, data in batch_by_addr.items():
+            for key in data:
+                self.assertEqual(addr, self.reader.address('gaid', key))
+                self.servers[[server.address for server in self.servers].index(addr)].store[key.encode()] = 0, b''
+        found = self.reader.get_many([('gaid', n) for n in range(50)])
+        self.assertEqual(50, len(found))
+
+
 class SplitByDevTest(unittest.TestCase):
     def setUp(self) -> None:
         self.content = [
@@ -142,5 +869,690 @@ class SplitByDevTest(unittest.TestCase):
         self.assertEqual(2, errors)
 
 
+class FastPackTest(unittest.TestCase):
+    def test_pack_fixture(self):
+        packed = fastpack.pack_user_apps([1, 2, 3], 55.1, 55.1)
+        self.assertEqual(b'\x08\x01\x08\x02\x08\x03\x11\xcd\xcc\xcc\xcc\xcc\x8cK@\x19\xcd\xcc\xcc\xcc\xcc\x8cK@', packed)
+
+    def test_pack_equals_protobuf(self):
+        for apps, lat, lon in [([], 0.0, 0.0), ([0, 127, 128, 300, 16384, 4294967295], -55.55, 180.0),
+                               ([1423, 43, 567, 3, 7, 23], 55.55, 42.42)]:
+            ua = appsinstalled_pb2.UserApps()
+            ua.lat, ua.lon = lat, lon
+            ua.apps.extend(apps)
+            self.assertEqual(ua.SerializeToString(), fastpack.pack_user_apps(apps, lat, lon))
+
+    def test_pack_out_of_range(self):
+        with self.assertRaises(ValueError):
+            fastpack.pack_user_apps([4294967296], 55.55, 42.42)
+
+    def test_split_equals_protobuf(self):
+        batch = [
+            'somedev\tsomeid\t55.55\t42.42\t1423,43,567,3,7,23\n',
+            'somedev1\tsomeid1\t55.55\t42.42\t7423,a,424',
+            'errdev\t...',
+            '  ',
+        ]
+        self.assertEqual(memc_load.split_by_dev(batch), fastpack.split_by_dev(batch))
+
+    def test_split_bytes(self):
+        batch = [b'somedev\tsomeid\t55.55\t42.42\t1423,43,567,3,7,23\n', b'errdev\t...']
+        batch_by_dev, errors = fastpack.split_by_dev(batch)
+        expected, _ = fastpack.split_by_dev([line.decode() for line in batch])
+        self.assertEqual(1, errors)
+        self.assertEqual(expected['somedev']['somedev:someid'], batch_by_dev[b'somedev'][b'somedev:someid'])
+
+    def test_split_invalid_geo(self):
+        batch_by_dev, errors = fastpack.split_by_dev(['somedev\tsomeid\t55.55\tabc\t1423,3'])
+        self.assertEqual(({}, 1), (dict(batch_by_dev), errors))
+
+
+class ValidateTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.lines = [
+            'idfa\tid1\t55.55\t42.42\t1423,43,567\n',
+            'idfa\tid2\t55.55\n',
+            'gaid\t\t55.55\t42.42\t1\n',
+            'gaid\tid3\tunknown\t42.42\t1\n',
+            'gaid\tid4\t95.0\t42.42\t1\n',
+            'adid\tid5\t10.\t-2\t1,none,\u00b2,3\n',
+            'dvid\tid6\t1\t2\t4294967296\n',
+        ]
+
+    def test_categories(self):
+        rejects = validate.Rejects()
+        batch_by_dev, errors = validate.split_by_dev(self.lines, rejects)
+        self.assertEqual(5, errors)
+        self.assertEqual({'fields': 1, 'ids': 1, 'coords': 2, 'apps': 1, 'partial_apps': 1}, dict(rejects.counts))
+        self.assertEqual({'idfa:id1': fastpack.pack_user_apps([1423, 43, 567], 55.55, 42.42)},
+                         batch_by_dev['idfa'])
+        self.assertEqual({'adid:id5': fastpack.pack_user_apps([1, 3], 10.0, -2.0)}, batch_by_dev['adid'])
+        self.assertEqual(5, len(rejects.sample))
+        self.assertEqual(('fields', self.lines[1]), rejects.sample[0])
+
+    def test_binary(self):
+        rejects = validate.Rejects()
+        batch_by_dev, errors = validate.split_by_dev([line.encode() for line in self.lines], rejects)
+        self.assertEqual(5, errors)
+        self.assertEqual({b'adid:id5': fastpack.pack_user_apps([1, 3], 10.0, -2.0)}, batch_by_dev[b'adid'])
+
+    def test_sample_bounded(self):
+        rejects = validate.Rejects(10, seed=1)
+        for n in range(1000):
+            rejects.add(validate.FIELDS, str(n))
+        self.assertEqual((1000, 10), (rejects.seen, len(rejects.sample)))
+        self.assertTrue(any(int(line) >= 10 for _, line in rejects.sample))  # not the first ones only
+        other = validate.Rejects(10)
+        other.add(validate.COORDS, 'x')
+        rejects.merge(other.summary())
+        self.assertEqual((1001, 10), (rejects.seen, len(rejects.sample)))
+        self.assertEqual({'fields': 1000, 'coords': 1}, dict(rejects.counts))
+
+    def test_merge_small(self):
+        rejects = validate.Rejects(10)
+        rejects.add(validate.IDS, 'a')
+        other = validate.Rejects(10)
+        other.add(validate.COORDS, 'b')
+        rejects.merge(other.summary())
+        self.assertEqual({('ids', 'a'), ('coords', 'b')}, set(rejects.sample))
+
+    def test_load_counts(self):
+        counter = memc_load.LoadCounter()
+        memc_load.opts.parser = 'validate'
+        try:
+            batch_by_dev, errors, duplicates = memc_load.split_next_batch(iter([self.lines]), rejects=counter.rejects)
+        finally:
+            memc_load.opts.parser = 'fast'
+        self.assertEqual((5, 0), (errors, duplicates))
+        counter.add(errors, len(self.lines))
+        total = memc_load.LoadCounter()
+        total.merge(counter.summary())
+        self.assertEqual(5, total.rejects.errors)
+        with tempfile.TemporaryDirectory() as directory:
+            memc_load.opts.rejects = directory
+            try:
+                with self.assertLogs(level='INFO') as cm:
+                    memc_load.report_load('dir/1.tsv.gz', total.processed, total.errors, rejects=total.rejects)
+            finally:
+                memc_load.opts.rejects = None
+            with open(os.path.join(directory, '1.tsv.gz.rejects')) as f:
+                lines = f.read().splitlines()
+        self.assertIn('INFO:root:File dir/1.tsv.gz. Rejected lines: apps 1, coords 2, fields 1, ids 1, partial_apps 1',
+                      cm.output)
+        self.assertTrue(any('High error rate' in line for line in cm.output))
+        self.assertEqual(5, len(lines))
+        self.assertIn('coords\tgaid\tid3\tunknown\t42.42\t1', lines)
+
+
+class CompactTest(unittest.TestCase):
+    def test_pack(self):
+        packed = compact.Encoder().pack([1423, 43, 567, 3, 7, 23], 55.55, 42.42)
+        self.assertEqual(b'\xc1\x00\x06\x03\x04\x10\x14\x8c\x04\xd8\x06', packed[:11])
+        self.assertEqual(([3, 7, 23, 43, 567, 1423], 55.55, 42.42), compact.decode(packed))
+
+    def test_digits(self):
+        encoder = compact.Encoder(digits=5)
+        packed = encoder.pack([300, 1, 1], -55.123456, 180.0)
+        apps, lat, lon = compact.decode(packed)
+        self.assertEqual([1, 1, 300], apps)
+        self.assertAlmostEqual(-55.12346, lat, places=9)
+        self.assertEqual(180.0, lon)
+        self.assertLess(len(packed), len(compact.Encoder().pack([300, 1, 1], -55.123456, 180.0)))
+        with self.assertRaises(ValueError):
+            encoder.pack([1], float('inf'), 0.0)
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            compact.Encoder().pack([4294967296], 55.55, 42.42)
+
+    def test_decode_value(self):
+        apps, lat, lon = [1423, 43, 567], 55.55, 42.42
+        for packed in fastpack.pack_user_apps(apps, lat, lon), compact.Encoder().pack(apps, lat, lon):
+            ua = check_memc_values.decode_value(packed)
+            self.assertEqual((sorted(apps), lat, lon), (sorted(ua.apps), ua.lat, ua.lon))
+
+    def test_split_by_dev(self):
+        encoder = compact.Encoder(digits=6)
+        batch_by_dev, errors = fastpack.split_by_dev(['idfa\tsomeid\t55.55\t42.42\t1423,43\n', 'idfa\t...'],
+                                                     encoder.pack)
+        self.assertEqual(1, errors)
+        self.assertEqual(([43, 1423], 55.55, 42.42), compact.decode(batch_by_dev['idfa']['idfa:someid']))
+
+    def test_report(self):
+        with gzip.open('data/compact.tsv.gz', 'wt') as f:
+            f.writelines(gen_data.generate_lines(200, seed=1))
+        try:
+            report = compact.report('data/compact.tsv.gz', compact.Encoder(digits=5))
+        finally:
+            os.remove('data/compact.tsv.gz')
+        self.assertEqual(200, report['records'])
+        self.assertLess(report['compact_bytes'], report['protobuf_bytes'])
+        self.assertGreater(report['saved_per_record'], 0)
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'), "zstandard is not installed")
+    def test_zstd(self):
+        with gzip.open('data/compact.tsv.gz', 'wt') as f:
+            f.writelines(gen_data.generate_lines(2000, seed=1))
+        try:
+            dictionary = compact.train('data/compact.tsv.gz', dict_size=4096)
+        finally:
+            os.remove('data/compact.tsv.gz')
+        packed = compact.Encoder(dictionary=dictionary).pack(list(range(100, 200, 3)), 55.55, 42.42)
+        self.assertTrue(packed[1] & compact.ZSTD)
+        self.assertEqual((list(range(100, 200, 3)), 55.55, 42.42), compact.decode(packed, dictionary))
+        with self.assertRaises(ValueError):
+            compact.decode(packed)
+
+
+class VerifyTest(unittest.TestCase):
+    def test_wilson(self):
+        low, high = verify.wilson(10, 10)
+        self.assertAlmostEqual(0.7225, low, places=4)
+        self.assertEqual(1.0, high)
+        low, high = verify.wilson(50, 100)
+        self.assertAlmostEqual(1.0, low + high, places=9)
+        self.assertEqual((0.0, 1.0), verify.wilson(0, 0))
+
+    def test_reservoir(self):
+        sampler = verify.Sampler(100, seed=1)
+        for start in range(0, 10000, 700):
+            sampler.add({'a': {str(i): b'' for i in range(start, min(start + 700, 10000))}})
+        sample = sampler.samples()['a']
+        self.assertEqual((100, 10000), (len(sample), sampler.sent))
+        self.assertLess(abs(sum(map(int, sample)) / 100 - 5000), 1000)  # uniform over the batches
+
+    def test_reservoir_latest_value(self):
+        sampler = verify.Sampler(2)
+        sampler.add({'a': {'1': b'1', '2': b'2'}})
+        sampler.add({'a': {'1': b'3'}})
+        self.assertEqual({'1': b'3', '2': b'2'}, sampler.samples()['a'])
+
+    def test_check(self):
+        memc = memcache.Client((client_addr,))
+        try:
+            memc.set_multi({'somedev:1': b'1', 'somedev:2': b'2'})
+            sample = {'somedev:1': b'1', 'somedev:2': b'3', 'somedev:3': b'3'}
+            self.assertEqual(1, verify.check(memc, sample, batch_size=2))
+        finally:
+            memc.delete_multi(['somedev:1', 'somedev:2'])
+            memc.disconnect_all()
+
+    def test_report_load(self):
+        verification = verify.Verification(sampled=100, matched=90, sent=1000)
+        self.assertEqual(100, round(verification.lost()))
+        memc_load.opts.noreply = True
+        try:
+            with self.assertLogs(level='INFO') as cm:
+                memc_load.report_load('test', 1000, 0, verification=verification)
+        finally:
+            memc_load.opts.noreply = False
+        self.assertIn('Failed load', cm.output[-1])
+
+
+class HashRingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.servers = ['127.0.0.1:33013', '127.0.0.1:33014', '127.0.0.1:33015']
+        self.keys = [f'idfa:{i}' for i in range(1000)]
+
+    def test_get_node(self):
+        ring = ketama.HashRing(self.servers)
+        self.assertEqual(['127.0.0.1:33015', '127.0.0.1:33014', '127.0.0.1:33015'],  # as libketama gives
+                         [ring.get_node(key) for key in ('idfa:0', 'idfa:1', 'idfa:2')])
+        self.assertEqual(set(self.servers), {ring.get_node(key) for key in self.keys})
+
+    def test_add_node(self):
+        ring = ketama.HashRing(self.servers)
+        new_ring = ketama.HashRing(self.servers + ['127.0.0.1:33016'])
+        remapped = [key for key in self.keys if ring.get_node(key) != new_ring.get_node(key)]
+        self.assertLess(len(remapped), len(self.keys) * 0.35)
+        self.assertEqual({'127.0.0.1:33016'}, {new_ring.get_node(key) for key in remapped})
+
+    def test_route_batch(self):
+        batch_by_dev = {'idfa': {key: b'' for key in self.keys}, 'gaid': {'gaid:0': b''}}
+        device_memc = {'idfa': ','.join(self.servers), 'gaid': '127.0.0.1:33016'}
+        batch_by_addr, unknown = memc_load.route_batch(batch_by_dev, device_memc)
+        self.assertEqual(set(self.servers + ['127.0.0.1:33016']), set(batch_by_addr))
+        self.assertEqual(1001, sum(len(data) for data in batch_by_addr.values()))
+        self.assertEqual(0, unknown)
+
+    def test_route_bytes(self):
+        batch_by_addr, unknown = memc_load.route_batch({b'idfa': {b'idfa:0': b''}}, {'idfa': '127.0.0.1:33013'})
+        self.assertEqual({'127.0.0.1:33013': {b'idfa:0': b''}}, batch_by_addr)
+
+    def test_route_bytes_invalid_utf8(self):
+        batch_by_dev = {b'idfa': {b'idfa:0': b''}, b'\xffdev': {b'\xffdev:0': b''}}
+        with self.assertLogs(level='ERROR'):
+            batch_by_addr, unknown = memc_load.route_batch(batch_by_dev, {'idfa': '127.0.0.1:33013'})
+        self.assertEqual((['127.0.0.1:33013'], 1), (list(batch_by_addr), unknown))
+
+    def test_route_unknown_dev_type(self):
+        batch_by_dev = {'idfa': {'idfa:0': b''}, 'errdev': {'errdev:0': b'', 'errdev:1': b''}}
+        batch_by_addr, unknown = memc_load.route_batch(batch_by_dev, {'idfa': '127.0.0.1:33013'})
+        self.assertEqual(['127.0.0.1:33013'], list(batch_by_addr))
+        self.assertEqual(2, unknown)
+
+
+class ShmBatchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ring = shmbatch.ArenaRing(1, 1024)
+
+    def tearDown(self) -> None:
+        self.ring.close()
+
+    def test_write_read(self):
+        name = self.ring.acquire()
+        writer = shmbatch.BatchWriter(name)
+        self.assertTrue(writer.add('somedev:someid', b'1'))
+        self.assertTrue(writer.add(b'somedev:someid1', b'22'))
+        writer.close()
+        reader = self.ring.reader(name)
+        self.assertEqual({b'somedev:someid1': b'22'}, reader.batch(1, 2, copy=True))
+        batch = reader.batch(0, 2)
+        self.assertEqual(b'1', bytes(batch[b'somedev:someid']))
+        del batch
+        reader.release()
+
+    def test_arena_full(self):
+        writer = shmbatch.BatchWriter(self.ring.acquire())
+        self.assertFalse(writer.add('somedev:someid', b'1' * 1024))
+        writer.close()
+
+    def test_acquire(self):
+        name = self.ring.acquire()
+        self.assertIsNone(self.ring.acquire(timeout=0.01))
+        self.ring.release(name)
+        self.assertEqual(name, self.ring.acquire(timeout=0.01))
+
+    def test_parse_chunk(self):
+        chunk = b'somedev\tsomeid\t55.55\t42.42\t1423,43,567,3,7,23\nerrdev\t...\n'
+        name = self.ring.acquire()
+        result = memc_load.parse_chunk_shm(chunk, name, {'somedev': client_addr})
+        ranges, overflow, errors, skipped, duplicates, rejects = result
+        self.assertEqual(([(client_addr, 0, 1)], {}, 1, 0, 0), (ranges, overflow, errors, skipped, duplicates))
+        self.assertEqual({'counts': {}, 'seen': 0, 'sample': []}, rejects)  # not the validating parser
+        reader = self.ring.reader(name)
+        self.assertEqual([b'somedev:someid'], list(reader.batch(0, 1, copy=True)))
+        reader.release()
+
+    def test_chunk_lines(self):
+        chunk = 'idfa\tid\x0b1\t1\t2\t3\r\nidfa\tid\x1c2\u2028\t1\t2\t3\nidfa\tid3\t1\t2\t3\n'.encode()
+        path = Path('test_chunk_lines.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(chunk)
+        try:
+            for binary in (False, True):
+                memc_load.opts.binary = binary
+                with gzip.open(path, 'rb' if binary else 'rt') as f:
+                    self.assertEqual(list(f), list(memc_load.chunk_lines(chunk)))
+                self.assertEqual(3, len(list(memc_load.chunk_lines(chunk))))
+        finally:
+            memc_load.opts.binary = False
+            path.unlink()
+
+
+class AutoTunerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tuner = autotune.AutoTuner(20000, 2, min_batch_size=1000, max_batch_size=21000, max_inflight=3,
+                                        target_latency=0.1)
+
+    def send_window(self, seconds, errors=0):
+        for _ in range(autotune.WINDOW):
+            self.tuner.record_send('inet:127.0.0.1:33013', 1000, seconds, errors)
+
+    def test_increase(self):
+        self.tuner.record_parse(1000, 0.001)
+        with self.assertLogs(level='INFO') as cm:
+            self.send_window(0.05)
+        self.assertEqual((21000, 3), (self.tuner.batch_size, self.tuner.inflight))
+        self.assertIn('batch size 20000 -> 21000, in flight 2 -> 3', cm.output[0])
+        self.send_window(0.05)
+        self.assertEqual((21000, 3), (self.tuner.batch_size, self.tuner.inflight))  # bounds
+
+    def test_no_more_inflight_for_slow_parser(self):
+        self.tuner.record_parse(1000, 10)
+        self.send_window(0.05)
+        self.assertEqual((21000, 2), (self.tuner.batch_size, self.tuner.inflight))
+
+    def test_decrease(self):
+        self.send_window(0.2)
+        self.assertEqual((10000, 1), (self.tuner.batch_size, self.tuner.inflight))
+        self.send_window(0.01, errors=1)
+        self.assertEqual((5000, 1), (self.tuner.batch_size, self.tuner.inflight))
+
+
+class BudgetTest(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual([512 * 2 ** 20, 2 ** 30, 1536, 100], [budget.parse_size(size) for size in
+                                                               ('512M', '1g', '1.5KiB', '100')])
+        with self.assertRaises(ValueError):
+            budget.parse_size('512X')
+
+    def test_hold(self):
+        memory = budget.MemoryBudget(40 * 2 ** 20, baseline=0)
+        free = memory.limit - memory.reserve
+        release = memory.hold(free - 10)
+        done = []
+        waiter = threading.Thread(target=lambda: done.append(memory.hold(20, lambda: done.append('sent'))))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual([], done)  # the reader waits for the senders
+        release()
+        waiter.join(1)
+        self.assertEqual(1, len(done))
+        done[0]()
+        self.assertEqual((0, free - 10), (memory.inflight, memory.peak))
+        self.assertEqual('sent', done[-1])
+        memory.hold(memory.limit * 2)()  # a part larger than the budget, with nothing in flight
+
+    def test_read_batches(self):
+        lines = ['x' * 44 + '\n'] * 10
+        batches = list(memc_load.read_batches(iter(lines), batch_size=4, max_bytes=3 * (45 + budget.LINE_OVERHEAD)))
+        self.assertEqual([3, 3, 3, 1], list(map(len, batches)))
+
+
+class FakeMemcachedTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = fake_memc.FakeMemcached(seed=1).start()
+        self.memc = memcache.Client((self.server.address,))
+
+    def tearDown(self) -> None:
+        self.memc.disconnect_all()
+        self.server.stop()
+
+    def test_text_protocol(self):
+        self.assertTrue(self.memc.set('somedev:someid', b'1'))
+        self.assertEqual([], self.memc.set_multi({'somedev:someid1': b'2'}))
+        self.assertEqual({'somedev:someid': b'1', 'somedev:someid1': b'2'},
+                         self.memc.get_multi(['somedev:someid', 'somedev:someid1', 'somedev:someid2']))
+        self.assertTrue(self.memc.delete('somedev:someid'))
+        self.assertIsNone(self.memc.get('somedev:someid'))
+
+    def test_meta_protocol(self):
+        meta = memc_meta.MetaClient(self.server.address)
+        self.assertEqual([], meta.set_multi({'somedev:someid': b'1'}))
+        meta.disconnect_all()
+        self.assertEqual(b'1', self.memc.get('somedev:someid'))
+
+    def test_fail_rate(self):
+        self.server.fail_rate = 0.5
+        meta = memc_meta.MetaClient(self.server.address)
+        failed = meta.set_multi({f'somedev:{i}': b'1' for i in range(100)})
+        meta.disconnect_all()
+        self.assertTrue(0 < len(failed) < 100)
+        self.assertEqual(100, len(failed) + len(self.server.store))
+        self.assertFalse(set(failed) & {key.decode() for key in self.server.store})
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        start = time.monotonic()
+        self.memc.set('somedev:someid', b'1')
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class GenDataTest(unittest.TestCase):
+    def test_generate_lines(self):
+        lines = list(gen_data.generate_lines(100, dev_types='idfa=1', seed=1))
+        self.assertEqual(lines, list(gen_data.generate_lines(100, dev_types='idfa=1', seed=1)))
+        batch_by_dev, errors = fastpack.split_by_dev(lines)
+        self.assertEqual((['idfa'], 100, 0), (list(batch_by_dev), len(batch_by_dev['idfa']), errors))
+
+    def test_dirty_rate(self):
+        batch_by_dev, errors = fastpack.split_by_dev(list(gen_data.generate_lines(100, dirty_rate=1, seed=1)))
+        self.assertGreater(errors, 0)
+
+
+class MetricsTest(unittest.TestCase):
+    def tearDown(self) -> None:
+        metrics.current = metrics.NullMetrics()
+
+    def test_disabled(self):
+        memc_load.split_next_batch(iter([["idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43"]]))
+        self.assertEqual({'stages': {}, 'events': {}}, metrics.current.snapshot())
+
+    def test_stages(self):
+        metrics.enable()
+        lines = ["idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43", "gaid\t7rfw452y52g2gq4g"]
+        batch_by_dev, _, _ = memc_load.split_next_batch(iter([lines]))
+        memc_load.route_batch(batch_by_dev, memc_load.device_memc)
+        snapshot = metrics.current.snapshot()
+        self.assertEqual({'read', 'parse', 'route'}, set(snapshot['stages']) - {'pack'})
+        self.assertEqual(1, snapshot['stages']['parse'][1])
+        self.assertEqual({'records': 2, 'parse_errors': 1, 'duplicates': 0}, snapshot['events'])
+
+    def test_collector(self):
+        metrics.enable().observe('parse', 1.0)
+        collector = metrics.Collector(queue.Queue())
+        collector.queue.put((1, {'stages': {'parse': [0.5, 1]}, 'events': {'records': 3}}))
+        collector.queue.put((1, {'stages': {'parse': [2.0, 2]}, 'events': {'records': 5}}))  # the latest one counts
+        collector.queue.put((2, {'stages': {}, 'events': {'records': 1}}))
+        port = collector.serve(0, '127.0.0.1')
+        try:
+            while len(collector.snapshots) < 2:
+                time.sleep(0.01)
+            self.assertEqual({'stages': {'parse': [3.0, 3]}, 'events': {'records': 6}}, collector.total())
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                text = response.read().decode()
+        finally:
+            collector.close()
+        self.assertIn('memc_load_stage_seconds_total{stage="parse"} 3.000000', text)
+        self.assertIn('memc_load_events_total{event="records"} 6', text)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # three gzip members, the line of 250-th id is split between the second and the third
+        self.lines = [f"idfa\tid{i}\t55.55\t42.42\t{i}" for i in range(300)]
+        data = ('\n'.join(self.lines) + '\n').encode()
+        split = data.index(b'id250') + 2
+        os.makedirs('test', exist_ok=True)
+        self.path = 'test/members.tsv.gz'
+        with open(self.path, 'wb') as f:
+            start = data.index(b'idfa\tid100\t')
+            for part in (data[:start], data[start:split], data[split:]):
+                f.write(gzip.compress(part))
+
+    def tearDown(self) -> None:
+        os.remove(self.path)
+        os.rmdir('test')
+
+    def test_lines(self):
+        with checkpoint.GzipLines(self.path, text=False) as f:
+            self.assertEqual([line.encode() for line in self.lines], list(f))
+            self.assertEqual(300, f.position()['line'])
+
+    def test_universal_newlines(self):
+        with open(self.path, 'wb') as f:
+            f.write(gzip.compress(b'a\rb\r\nc\n\r\r\nd\r'))
+        with gzip.open(self.path, 'rt') as f:
+            expected = [line.rstrip('\n') for line in f]
+        for block_size in (1, 2, 3, 1024):  # line ends split between blocks
+            with checkpoint.GzipLines(self.path, block_size=block_size) as f:
+                self.assertEqual(expected, list(f))
+                self.assertEqual(len(expected), f.position()['line'])
+
+    def test_resume(self):
+        with checkpoint.GzipLines(self.path) as f:
+            positions = [f.position() for _ in f]
+        self.assertEqual(0, positions[99]['member_offset'])
+        self.assertEqual((101, 1), (positions[100]['line'], positions[100]['member_line']))
+        self.assertNotEqual(positions[249]['member_offset'], positions[250]['member_offset'])
+        for i in (0, 99, 100, 150, 249, 250, 299):
+            with checkpoint.GzipLines(self.path, positions[i]) as f:
+                self.assertEqual(self.lines[i + 1:], list(f))
+                self.assertEqual(300, f.position()['line'])
+
+    def test_tracker(self):
+        with checkpoint.GzipLines(self.path) as f:
+            tracker = checkpoint.Tracker(self.path, f, interval=0)
+            counter = memc_load.LoadCounter()
+            batches = []
+            for lines in memc_load.read_batches(f, 100):
+                batches.append(tracker.batch(counter))
+                batches[-1].expect(2)
+            batches[1].part_done()
+            batches[1].part_done()
+            batches[0].part_done()
+            self.assertEqual(0, tracker.state['line'])  # the first batch is not stored yet
+            batches[0].add(1, 10)
+            batches[0].part_done()
+            self.assertEqual((200, 9, 1), (tracker.state['line'], tracker.state['processed'], tracker.state['errors']))
+        self.assertEqual(200, checkpoint.load_state(self.path)['line'])
+        checkpoint.remove_state(self.path)
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self) -> None:
+        os.makedirs('test', exist_ok=True)
+        self.path = 'test/delta.idx'
+
+    def tearDown(self) -> None:
+        for path in [self.path] + [os.path.join('test', fn) for fn in os.listdir('test') if fn.endswith('.log')]:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir('test')
+
+    def test_empty(self):
+        index = delta.DeltaIndex(self.path)
+        data = {'idfa:1': b'1'}
+        self.assertEqual(0, index.drop_unchanged(data))
+        self.assertEqual({'idfa:1': b'1'}, data)
+
+    def test_drop_unchanged(self):
+        log = delta.UpdateLog(self.path)
+        log.record({'idfa:1': b'1', 'idfa:2': b'2', b'idfa:3': b'3'}, failed=['idfa:2'])
+        log.flush()
+        self.assertEqual(2, delta.merge(self.path))
+        self.assertFalse(os.path.exists(log.path))
+        index = delta.DeltaIndex(self.path)
+        data = {'idfa:1': b'1', 'idfa:2': b'2', 'idfa:3': memoryview(b'3'), 'idfa:4': b'4'}
+        self.assertEqual(2, index.drop_unchanged(data))  # idfa:2 was not stored
+        self.assertEqual({'idfa:2', 'idfa:4'}, set(data))
+        index.close()
+
+    def test_merge(self):
+        log = delta.UpdateLog(self.path)
+        n = delta.MIN_SLOTS  # more than fit into the smallest table
+        log.record({f'idfa:{i}': b'1' for i in range(n)})
+        log.flush()
+        delta.merge(self.path)
+        log.record({'idfa:0': b'2'})
+        log.flush()
+        other = delta.UpdateLog(self.path)
+        other.path = f"{self.path}.0.log"  # as if written by another process
+        other.record({'idfa:1': b'2'})
+        other.flush()
+        log.record({'idfa:1': b'3'})
+        log.flush()
+        delta.merge(self.path)
+        index = delta.DeltaIndex(self.path)
+        self.assertEqual((n, 2 * delta.MIN_SLOTS), (index.count, index.slots))
+        self.assertEqual(delta.fingerprint(b'2'), index.get(delta.fingerprint('idfa:0')))
+        self.assertEqual(0, index.get(delta.fingerprint('idfa:1')))  # set to different values, so unknown
+        self.assertEqual(delta.fingerprint(b'1'), index.get(delta.fingerprint(f'idfa:{n - 1}')))
+        index.close()
+
+
+def claim_in_worker(batch_by_dev, batch_version):
+    return memc_load._coalescer.claim(batch_by_dev, batch_version)[coalesce.SEND]
+
+
+class CoalesceTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.table = coalesce.KeyTable(64)
+
+    def tearDown(self) -> None:
+        self.table.close()
+
+    def claim(self, data, batch_version):
+        return {decision: set(records) for decision, records in self.table.claim(data, batch_version).items()
+                if records}
+
+    def test_claim(self):
+        v1, v2, v3 = coalesce.version(1, 0, 1), coalesce.version(1, 0, 2), coalesce.version(2, 0, 1)
+        self.assertEqual({coalesce.SEND: {'idfa:1', 'idfa:2'}}, self.claim({'idfa:1': b'1', 'idfa:2': b'2'}, v1))
+        # the writes of the first batch are in flight
+        self.assertEqual({coalesce.DUPLICATE: {'idfa:1'}, coalesce.DEFER: {'idfa:2'}},
+                         self.claim({'idfa:1': b'1', 'idfa:2': b'3'}, v2))
+        self.table.confirm(['idfa:1', 'idfa:2'])
+        self.assertEqual({coalesce.SEND: {'idfa:2'}}, self.claim({'idfa:2': b'4'}, v3))
+        self.table.confirm(['idfa:2'])
+        self.assertEqual({coalesce.SUPERSEDED: {'idfa:2'}}, self.claim({'idfa:2': b'3'}, v2))
+
+    def test_failed(self):
+        self.claim({'idfa:1': b'1'}, 1)
+        self.table.confirm(['idfa:1'], failed={'idfa:1'})
+        self.assertEqual({coalesce.SEND: {'idfa:1'}}, self.claim({'idfa:1': b'1'}, 2))
+
+    def test_eviction(self):
+        table = coalesce.KeyTable(coalesce.WAYS)  # a single bucket
+        try:
+            for i in range(coalesce.WAYS):
+                table.claim({f'idfa:{i}': b'1'}, i + 1)
+            self.assertEqual({coalesce.SEND: {'idfa:new': b'1'}}, {k: v for k, v in table.claim(
+                {'idfa:new': b'1'}, 100).items() if v})  # all the keys are in flight, so it is not coalesced
+            table.confirm([f'idfa:{i}' for i in range(coalesce.WAYS)])
+            table.claim({'idfa:new': b'1'}, 100)
+            self.assertEqual(1, table.evictions)
+            # the key of the lowest version is evicted
+            self.assertEqual({'idfa:1'}, set(table.claim({'idfa:1': b'1'}, 200)[coalesce.DUPLICATE]))
+            self.assertEqual({'idfa:0'}, set(table.claim({'idfa:0': b'1'}, 200)[coalesce.SEND]))
+        finally:
+            table.close()
+
+    def test_main(self):
+        from memc_load import opts, device_memc
+        os.makedirs('test', exist_ok=True)
+        for day, (value, dup) in enumerate(((1, 2), (3, 4)), 1):
+            with gzip.open(f'test/{day}.tsv.gz', 'wt') as f:
+                f.write(f"somedev\tsomeid\t55.55\t42.42\t{value}\nsomedev\tsomeid\t55.55\t42.42\t{dup}\n"
+                        f"somedev\tsomeid1\t55.55\t42.42\t1\n")
+        opts.pattern = 'test/*.tsv.gz'
+        opts.coalesce = True
+        keep_device_memc(self)
+        device_memc['somedev'] = client_addr
+        memc = memcache.Client((client_addr,))
+        try:
+            result = memc_load.main()
+            ua = appsinstalled_pb2.UserApps()
+            ua.ParseFromString(memc.get('somedev:someid'))
+        finally:
+            opts.coalesce = False
+            memc.delete('somedev:someid')
+            memc.delete('somedev:someid1')
+            memc.disconnect_all()
+            for day in (1, 2):
+                os.remove(f'test/.{day}.tsv.gz')
+            os.rmdir('test')
+        self.assertEqual([4], ua.apps)
+        # one in each file, and either someid1 of the second file has the same value as of the first one,
+        # or the second file is claimed first and supersedes both keys of the first one
+        self.assertEqual((6, 0), (result['processed'], result['errors']))
+        self.assertIn(result['duplicates'], (3, 4))
+
+    def test_spawned_worker(self):
+        import functools
+        import multiprocessing
+        # as with the default start method off Linux: the worker does not inherit the coalescer
+        spawn = multiprocessing.get_context('spawn')
+        coalesce.multiprocessing = spawn
+        try:
+            coalescer = coalesce.Coalescer(['idfa'], 64)
+        finally:
+            coalesce.multiprocessing = multiprocessing
+        executor_class = memc_load.ProcessPoolExecutor
+        memc_load.ProcessPoolExecutor = functools.partial(ProcessPoolExecutor, mp_context=spawn)
+        memc_load._coalescer = coalescer
+        try:
+            with memc_load.worker_pool() as executor:
+                sent = executor.submit(claim_in_worker, {'idfa': {'idfa:1': b'1'}}, 1).result()
+            self.assertEqual({'idfa': {'idfa:1': b'1'}}, sent)
+            # the claim of the worker is in the table of the main process
+            self.assertEqual({'idfa': {'idfa:1': b'2'}}, coalescer.claim({'idfa': {'idfa:1': b'2'}}, 2)[coalesce.DEFER])
+        finally:
+            memc_load.ProcessPoolExecutor = executor_class
+            memc_load._coalescer = None
+            coalescer.close()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Validating parser: rejected lines classified into counted categories in one pass, a bounded sample of them kept
+import os
+import random
+from collections import Counter, defaultdict
+
+from fastpack import MAX_UINT32, pack_user_apps
+
+FIELDS = 'fields'  # not 5 tab-separated fields
+IDS = 'ids'  # empty device type or id
+COORDS = 'coords'  # lat or lon which is not a decimal number, or out of range
+APPS = 'apps'  # app id out of uint32 range
+CATEGORIES = (FIELDS, IDS, COORDS, APPS)
+PARTIAL_APPS = 'partial_apps'  # stored with the app ids which are digits, the others dropped: not an error
+SAMPLE_SIZE: int = 100  # rejected lines of a file kept for the reject file
+SUFFIX = '.rejects'
+
+
+class Rejects:
+    """
+    Counts of rejected lines by category, and a uniform sample of at most `size` of them, kept by reservoir
+    sampling, so a file of any number of rejects takes bounded memory. Lines with some of the app ids dropped
+    are counted as PARTIAL_APPS, and are not sampled
+    """
+
+    def __init__(self, size=SAMPLE_SIZE, seed=None):
+        self.size = size
+        self.counts = Counter()
+        self.seen = 0  # rejected lines, the sample is drawn from
+        self.sample = []  # (category, line)
+        self._rng = random.Random(seed)
+
+    def add(self, category, line):
+        self.counts[category] += 1
+        self.seen += 1
+        if len(self.sample) < self.size:
+            self.sample.append((category, line))
+        else:
+            n = self._rng.randrange(self.seen)
+            if n < self.size:
+                self.sample[n] = category, line
+
+    def partial(self):
+        self.counts[PARTIAL_APPS] += 1
+
+    @property
+    def errors(self):
+        return sum(self.counts[category] for category in CATEGORIES)
+
+    def summary(self):
+        """Counts and sample as a dict, to be returned from a worker process"""
+        return {'counts': dict(self.counts), 'seen': self.seen, 'sample': list(self.sample)}
+
+    def merge(self, summary):
+        """
+        Add the rejects of another part of the file. The samples are merged by weighted sampling (Efraimidis-Spirakis),
+        a line of a sample weighing the number of rejects it was drawn from, so the sample stays uniform over both
+        """
+        self.counts.update(summary['counts'])
+        keyed = []
+        for seen, sample in ((self.seen, self.sample), (summary['seen'], summary['sample'])):
+            if sample:
+                exponent = len(sample) / seen  # 1 / weight
+                keyed.extend((self._rng.random() ** exponent, item) for item in sample)
+        keyed.sort(key=lambda pair: pair[0], reverse=True)
+        self.sample = [item for _, item in keyed[:self.size]]
+        self.seen += summary['seen']
+
+    def __str__(self):
+        return ', '.join(f"{category} {n}" for category, n in sorted(self.counts.items()) if n)
+
+    def __bool__(self):
+        return any(self.counts.values())
+
+
+def reject_path(directory, fn):
+    return os.path.join(directory, os.path.basename(fn) + SUFFIX)
+
+
+def write_sample(directory, fn, rejects):
+    """
+    Write the sample of rejected lines of the file into <directory>/<file name>.rejects, a `category<TAB>line`
+    per line, replacing the sample of a previous load
+    :return: path of the reject file
+    """
+    path = reject_path(directory, fn)
+    os.makedirs(directory, exist_ok=True)
+    with open(path + f'.{os.getpid()}.tmp', 'w', encoding='utf-8') as f:
+        for category, line in rejects.sample:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            line = line.rstrip('\r\n')
+            f.write(f"{category}\t{line}\n")
+    os.replace(f.name, path)
+    return path
+
+
+def split_by_dev(batch, rejects, pack=pack_user_apps):
+    """
+    The same as fastpack.split_by_dev, but each line is checked before it is converted, with no exceptions
+    on the way: a rejected line is counted into its category of `rejects` and may be sampled, and nothing is
+    logged per line. Lines of non-digit app ids are stored with the other app ids, as by the other parsers.
+    Coords must be decimal numbers, with an optional minus and point, within -90..90 and -180..180.
+    Digits are checked with isdecimal (isdigit of bytes), which is true of the strings int() and float() parse
+    :param rejects: Rejects of the file
+    :return: dict of dev_type -> {key: packed}, number of rejected lines
+    """
+    splitted_batch = defaultdict(dict)
+    errors = rejects.errors
+    if not batch:
+        return splitted_batch, 0
+    if isinstance(batch[0], bytes):
+        tab, comma, colon, point, minus, empty, is_digit = b'\t', b',', b':', b'.', b'-', b'', bytes.isdigit
+    else:
+        tab, comma, colon, point, minus, empty, is_digit = '\t', ',', ':', '.', '-', '', str.isdecimal
+    double_comma = comma + comma
+    for line in batch:
+        parts = line.strip().split(tab)
+        if len(parts) != 5:
+            rejects.add(FIELDS, line)
+            continue
+        dev_type, dev_id, lat, lon, raw_apps = parts
+        if not dev_type or not dev_id:
+            rejects.add(IDS, line)
+            continue
+        if not (is_digit(lat.replace(point, empty, 1).removeprefix(minus))
+                and is_digit(lon.replace(point, empty, 1).removeprefix(minus))):
+            rejects.add(COORDS, line)
+            continue
+        lat, lon = float(lat), float(lon)
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            rejects.add(COORDS, line)
+            continue
+        # all the app ids are digits, and none is empty: no comma at an end, nor two in a row
+        if is_digit(raw_apps.replace(comma, empty)) and double_comma not in comma + raw_apps + comma:
+            apps = list(map(int, raw_apps.split(comma)))
+        else:
+            apps = [int(a) for a in raw_apps.split(comma) if is_digit(a)]
+            rejects.partial()
+        if apps and max(apps) > MAX_UINT32:
+            rejects.add(APPS, line)
+            continue
+        splitted_batch[dev_type][dev_type + colon + dev_id] = pack(apps, lat, lon)
+    return splitted_batch, rejects.errors - errors
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Read-back verification of a load: a uniform sample of the records sent, checked with get_multi after the load
+import math
+import random
+import sys
+from itertools import islice
+
+Z_95: float = 1.96  # normal quantile of a 95% confidence interval
+VERIFY_BATCH: int = 1000  # keys of a get_multi
+
+
+def wilson(successes, n, z=Z_95):
+    """Wilson score interval of a proportion, which holds for small samples and proportions close to 0 or 1"""
+    if not n:
+        return 0.0, 1.0
+    p = successes / n
+    center = p + z * z / (2 * n)
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+    denominator = 1 + z * z / n
+    return max(0.0, (center - margin) / denominator), min(1.0, (center + margin) / denominator)
+
+
+class Reservoir:
+    """
+    Uniform sample of `size` records of all the batches added, by Algorithm L: the number of records to skip
+    before the next one sampled is drawn at once, so records which are not sampled cost nothing.
+    A sampled key sent again keeps its slot and takes the latest value
+    """
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = {}  # key -> packed
+        self.keys = []  # key of each slot
+        self.seen = 0
+        self.w = math.exp(math.log(self._random()) / size)
+        self.next = size + self._skip()  # number of the record to be sampled next
+
+    def _random(self):
+        return max(self.rng.random(), sys.float_info.min)
+
+    def _skip(self):
+        return math.floor(math.log(self._random()) / math.log(1 - self.w))
+
+    def _put(self, key, packed, slot=None):
+        if key in self.items:
+            self.items[key] = packed
+            return
+        if slot is None:
+            self.keys.append(key)
+        else:
+            del self.items[self.keys[slot]]
+            self.keys[slot] = key
+        self.items[key] = packed
+
+    def add(self, data):
+        """:param data: dict of key -> packed value of a batch"""
+        if len(self.items) < len(data):
+            for key in [key for key in self.items if key in data]:
+                self.items[key] = data[key]
+        else:
+            for key in [key for key in data if key in self.items]:
+                self.items[key] = data[key]
+        end = self.seen + len(data)
+        records = iter(data.items())
+        pos = self.seen  # number of the next record of the iterator
+        while len(self.keys) < self.size and pos < end:
+            self._put(*next(records))
+            pos += 1
+        while self.next < end:
+            key, packed = next(islice(records, self.next - pos, None))
+            pos = self.next + 1
+            self._put(key, packed, self.rng.randrange(self.size))
+            self.w *= math.exp(math.log(self._random()) / self.size)
+            self.next += self._skip() + 1
+        self.seen = end
+
+
+class Sampler:
+    """
+    Reservoir of the records sent to each memcached instance, which is per device type unless it is sharded
+    :param size: records sampled per instance
+    """
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.reservoirs = {}
+
+    def add(self, batch_by_addr):
+        """:param batch_by_addr: dict of address -> {key: packed} of the records sent"""
+        for addr, data in batch_by_addr.items():
+            reservoir = self.reservoirs.get(addr)
+            if reservoir is None:
+                reservoir = self.reservoirs[addr] = Reservoir(self.size, self.rng)
+            reservoir.add(data)
+
+    def samples(self):
+        """:return: dict of address -> {key: packed}"""
+        return {addr: dict(reservoir.items) for addr, reservoir in self.reservoirs.items()}
+
+    @property
+    def sent(self):
+        return sum(reservoir.seen for reservoir in self.reservoirs.values())
+
+
+def check(memc, sample, batch_size=VERIFY_BATCH):
+    """
+    Read the sampled keys back from the memcached instance
+    :param memc: memcache.Client
+    :param sample: dict of key -> packed value which was sent
+    :return: number of keys read with the value sent
+    """
+    matched = 0
+    keys = list(sample)
+    for start in range(0, len(keys), batch_size):
+        fetched = memc.get_multi(keys[start:start + batch_size])
+        matched += sum(fetched.get(key) == sample[key] for key in keys[start:start + batch_size])
+    return matched
+
+
+class Verification:
+    """
+    Share of the sent records which are stored, estimated from the sample read back, with a confidence interval
+    :param sampled: records of the sample
+    :param matched: records of the sample read back with the value sent
+    :param sent: records sent, the sample is taken of
+    """
+
+    def __init__(self, sampled, matched, sent, z=Z_95):
+        self.sampled = sampled
+        self.matched = matched
+        self.sent = sent
+        self.rate = matched / sampled if sampled else 1.0
+        self.low, self.high = wilson(matched, sampled, z)
+
+    def lost(self, rate=None):
+        """Estimated number of sent records which are not stored, at the success rate, or at the one given"""
+        return (1 - (self.rate if rate is None else rate)) * self.sent
+
+    def __str__(self):
+        return (f"verified {self.matched} of {self.sampled} sampled records, success rate {self.rate:.2%} "
+                f"(95% CI {self.low:.2%}..{self.high:.2%}), about {self.lost():.0f} of {self.sent} sent records lost")